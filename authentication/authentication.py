@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
+import threading
+import time
+
+
+class UserCache:
+    """
+    Bounded LRU of the users resolved by this process, by id, whose entries expire after
+    AUTH_USER_CACHE_TTL seconds. Saving or deleting a user bumps its generation in the
+    shared Django cache (see authentication.signals), and an entry is only used while the
+    generation it was loaded under is current, so every process drops it on its next hit.
+    Changes made with queryset updates are picked up once the entry expires.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # str(user id), as carried by the tokens -> (expires at, generation, user)
+        self._users = OrderedDict()
+
+    def generation_key(self, user_id):
+        return f'auth:user:{user_id}:generation'
+
+    def generation(self, user_id):
+        """Current generation of a user, read before loading it so that a change made in between is noticed"""
+        return cache.get(self.generation_key(user_id))
+
+    def get(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._users[user_id]
+                return None
+        # One lookup in the shared cache per hit, still far cheaper than loading the user
+        if self.generation(user_id) != entry[1]:
+            self.discard(user_id)
+            return None
+        with self._lock:
+            if user_id in self._users:
+                self._users.move_to_end(user_id)
+        return entry[2]
+
+    def set(self, user_id, user, generation=None):
+        if settings.AUTH_USER_CACHE_TTL <= 0:
+            return
+        user_id = str(user_id)
+        with self._lock:
+            self._users[user_id] = (time.monotonic() + settings.AUTH_USER_CACHE_TTL, generation, user)
+            self._users.move_to_end(user_id)
+            while len(self._users) > settings.AUTH_USER_CACHE_SIZE:
+                self._users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Drop the user from the cache of every process"""
+        key = self.generation_key(user_id)
+        # Entries loaded before the bump expire within the TTL, so the generation does not
+        # have to outlive it; a missing generation never matches one loaded after a bump
+        timeout = max(settings.AUTH_USER_CACHE_TTL, 1)
+        if not cache.add(key, 1, timeout=timeout):
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, 1, timeout=timeout)
+        self.discard(user_id)
+
+    def discard(self, user_id):
+        """Drop the user from the cache of this process"""
+        with self._lock:
+            self._users.pop(str(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+
+
+user_cache = UserCache()
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that trusts the user id of the signed token and resolves the user
+    through `user_cache`, so authenticated requests only query the user table on a miss.
+    Cached users go through the same active and revoked-token checks as loaded ones.
+    """
+
+    def get_user(self, validated_token):
+        user = self.get_cached_user(validated_token)
+        if user is None:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+            generation = user_cache.generation(user_id)
+            user = super().get_user(validated_token)
+            user_cache.set(user_id, user, generation)
+        return user
+
+    def get_cached_user(self, validated_token):
+        """The user of the token from the cache, or None on a miss"""
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError as e:
+            raise InvalidToken(_("Token contained no recognizable user identification")) from e
+
+        user = user_cache.get(user_id)
+        if user is None:
+            return None
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_("User is inactive"), code="user_inactive")
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code="password_changed")
+        return user
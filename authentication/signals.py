@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from .authentication import user_cache
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_user(sender, instance, using, **kwargs):
+    # Deactivations and password changes take effect on the next request. Dropped once
+    # committed, a request reading the old row in between would cache it again otherwise
+    user_id = instance.pk
+    transaction.on_commit(lambda: user_cache.invalidate(user_id), using=using)
@@ -1,5 +1,9 @@
-from django.test import TestCase
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.tokens import AccessToken
+from .authentication import CachedJWTAuthentication, UserCache, user_cache
+from django.core.cache import cache
 from rest_framework.test import APIClient
 from django.contrib.auth import get_user_model
 from rest_framework import status
@@ -60,3 +64,76 @@ class AuthenticationTests(TestCase):
         
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertIn('access', response.data)
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user_cache.clear()
+        self.users = [User.objects.create_user(username=f'user{i}', password='TestPass123!') for i in range(2)]
+
+    def authenticate(self, user):
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+        return CachedJWTAuthentication().authenticate(request)[0]
+
+    def test_user_is_loaded_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate(self.users[0]), self.users[0])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.authenticate(self.users[0]), self.users[0])
+
+    def test_deactivation_and_password_change_invalidate(self):
+        self.authenticate(self.users[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users[0].set_password('OtherPass123!')
+            self.users[0].save()
+        with self.assertNumQueries(1):
+            self.authenticate(self.users[0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.users[0].is_active = False
+            self.users[0].save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(self.users[0])
+
+    def test_user_is_invalidated_once_the_change_is_committed(self):
+        stale = User.objects.get(pk=self.users[0].pk)
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.users[0].is_active = False
+            self.users[0].save()
+            # A concurrent request still reads the committed row and caches it
+            user_cache.set(stale.pk, stale)
+        for callback in callbacks:
+            callback()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(self.users[0])
+
+    def test_invalidation_reaches_every_process(self):
+        # One cache per process, sharing the Django cache
+        caches = [UserCache(), UserCache()]
+        user = self.users[0]
+        for process_cache in caches:
+            process_cache.set(user.pk, user, process_cache.generation(user.pk))
+            self.assertEqual(process_cache.get(user.pk), user)
+
+        caches[0].invalidate(user.pk)
+        self.assertEqual([process_cache.get(user.pk) for process_cache in caches], [None, None])
+
+        caches[1].set(user.pk, user, caches[1].generation(user.pk))
+        self.assertEqual(caches[1].get(user.pk), user)
+        # Loaded under the previous generation, before the invalidation
+        caches[0].set(user.pk, user, None)
+        self.assertIsNone(caches[0].get(user.pk))
+
+    @override_settings(AUTH_USER_CACHE_SIZE=1)
+    def test_least_recently_used_users_are_evicted(self):
+        self.authenticate(self.users[0])
+        self.authenticate(self.users[1])
+        with self.assertNumQueries(1):
+            self.authenticate(self.users[0])
+
+    @override_settings(AUTH_USER_CACHE_TTL=0)
+    def test_cache_can_be_disabled(self):
+        self.authenticate(self.users[0])
+        with self.assertNumQueries(1):
+            self.authenticate(self.users[0])
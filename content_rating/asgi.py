@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'content_rating.settings')
+# The hot endpoints have async views, which only pay off under an ASGI server
+os.environ.setdefault('ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
@@ -0,0 +1,51 @@
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+import functools
+import os
+import threading
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor():
+    """The database threads of the process, created on first use so they never cross a fork"""
+    with _executors_lock:
+        if os.getpid() not in _executors:
+            _executors[os.getpid()] = ThreadPoolExecutor(
+                max_workers=settings.ASYNC_DB_THREADS, thread_name_prefix='async-db',
+            )
+        return _executors[os.getpid()]
+
+
+def _run(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # The connections of a database thread stay open between calls, broken ones are dropped
+        for connection in connections.all(initialized_only=True):
+            if connection.errors_occurred:
+                if connection.is_usable():
+                    connection.errors_occurred = False
+                else:
+                    connection.close()
+
+
+def database_sync_to_async(func):
+    """
+    sync_to_async for database work of async views.
+
+    Django runs the sync code of each ASGI request, async ORM calls included, in a thread of
+    its own, so every request opens and closes its own connection and a burst of in-flight
+    requests opens as many connections. Calls wrapped here run instead on a pool of
+    ASYNC_DB_THREADS threads that keep their connections open: the process never holds more
+    connections than that, they are reused like the ones of a WSGI worker, and requests
+    waiting for a thread only cost a queued callable. With ASYNC_DB_THREADS=0 calls run in
+    the request's thread like the async ORM does, which tests rely on to share their
+    transaction.
+    """
+    if not settings.ASYNC_DB_THREADS:
+        return sync_to_async(func)
+    return sync_to_async(functools.partial(_run, func), thread_sensitive=False, executor=get_executor())
@@ -0,0 +1,150 @@
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DatabaseError, connections
+from .database import database_sync_to_async
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = 'default'
+
+# Database that reads go to in the current request or task, None for the primary
+_read_alias = ContextVar('read_alias', default=None)
+
+LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class ReplicaRouter:
+    """
+    Writes, and reads that are not explicitly allowed on a replica, go to the primary.
+    Replica reads are opted into with `replicas.reads()`, see ReplicaSet.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # Replicas hold the same data as the primary
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
+
+
+class ReplicaSet:
+    """
+    Picks the read replica for read-only endpoints.
+
+    A replica is only used while its replay lag, checked at most every REPLICA_STATUS_TTL
+    seconds, is below REPLICA_MAX_LAG_SECONDS. Writes pin a scope (a user, a content, the
+    content lists) to the primary for REPLICA_PIN_SECONDS; as long as that is longer than
+    the tolerated lag plus the check interval, a pinned reader can only be moved back to a
+    replica once the replica has replayed the write, which gives read-your-writes.
+    Pins live in the content cache, so they are shared by every process when it is Redis.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lags = {}  # alias -> (checked at, lag in seconds or None when unreachable)
+
+    @property
+    def aliases(self):
+        return settings.DATABASE_REPLICAS
+
+    @property
+    def cache(self):
+        return caches[settings.CONTENT_CACHE_ALIAS]
+
+    def pin_key(self, scope):
+        return f'db:pin:{scope}'
+
+    def pin(self, *scopes):
+        """Send the reads of the given scopes to the primary for a while, after writing to them"""
+        if self.aliases and scopes:
+            self.cache.set_many({self.pin_key(scope): 1 for scope in scopes}, timeout=settings.REPLICA_PIN_SECONDS)
+
+    async def apin(self, *scopes):
+        if self.aliases and scopes:
+            await self.cache.aset_many({self.pin_key(scope): 1 for scope in scopes}, timeout=settings.REPLICA_PIN_SECONDS)
+
+    def is_pinned(self, *scopes):
+        return bool(scopes) and bool(self.cache.get_many([self.pin_key(scope) for scope in scopes]))
+
+    def lag(self, alias):
+        now = time.monotonic()
+        with self._lock:
+            checked_at, lag = self._lags.get(alias, (None, None))
+        if checked_at is not None and now - checked_at < settings.REPLICA_STATUS_TTL:
+            return lag
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(LAG_QUERY)
+                lag = float(cursor.fetchone()[0])
+        except DatabaseError as e:
+            logger.warning(f"Replica {alias} is unavailable: {str(e)}")
+            connections[alias].close()
+            lag = None
+        with self._lock:
+            self._lags[alias] = (now, lag)
+        return lag
+
+    def choose(self):
+        """A random replica whose lag is acceptable, or None"""
+        candidates = list(self.aliases)
+        random.shuffle(candidates)
+        for alias in candidates:
+            lag = self.lag(alias)
+            if lag is not None and lag <= settings.REPLICA_MAX_LAG_SECONDS:
+                return alias
+        return None
+
+    @contextmanager
+    def reads(self, *scopes):
+        """
+        Route the reads of the block to a replica unless one of the scopes is pinned or a
+        transaction is open on the primary. Nested blocks can fall back to the primary but
+        never leave it.
+        """
+        alias = self._alias_for(scopes)
+        token = _read_alias.set(alias)
+        try:
+            yield alias
+        finally:
+            _read_alias.reset(token)
+
+    @asynccontextmanager
+    async def areads(self, *scopes):
+        """reads() for async views, the ORM calls of the block see the chosen alias"""
+        if not self.aliases or _read_alias.get() == PRIMARY:
+            alias = PRIMARY
+        else:
+            # Checks the transaction state and the lag where the queries of the block run
+            alias = await database_sync_to_async(self._alias_for)(scopes)
+        token = _read_alias.set(alias)
+        try:
+            yield alias
+        finally:
+            _read_alias.reset(token)
+
+    def _alias_for(self, scopes):
+        # A transaction on the primary reads its own writes
+        if (not self.aliases or _read_alias.get() == PRIMARY or connections[PRIMARY].in_atomic_block
+                or self.is_pinned(*scopes)):
+            return PRIMARY
+        return _read_alias.get() or self.choose() or PRIMARY
+
+
+replicas = ReplicaSet()
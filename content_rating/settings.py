@@ -50,8 +50,15 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'authentication.authentication.CachedJWTAuthentication',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'contents.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    # Reverse proxies in front of the app (nginx); client IPs are read from the X-Forwarded-For
+    # entry the last of them appended, the entries before it are sent by the client
+    'NUM_PROXIES': int(os.getenv("NUM_PROXIES", '1')),
 }
 
 SIMPLE_JWT = {
@@ -65,6 +72,11 @@ SIMPLE_JWT = {
     'AUTH_HEADER_TYPES': ('Bearer',),
 }
 
+# Users resolved by the JWT authentication are kept per process for this many seconds (0
+# disables it), at most AUTH_USER_CACHE_SIZE of them, see authentication.authentication
+AUTH_USER_CACHE_TTL = int(os.getenv('AUTH_USER_CACHE_TTL', '60'))
+AUTH_USER_CACHE_SIZE = int(os.getenv('AUTH_USER_CACHE_SIZE', '10000'))
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -112,6 +124,43 @@ DATABASES = {
     }
 }
 
+# Read replicas: streaming replicas of the default database, given as comma separated hosts.
+# Read-only endpoints use them, see content_rating.routers. In tests they mirror the default database.
+DATABASE_REPLICAS = []
+for index, host in enumerate(filter(None, os.getenv('DATABASE_REPLICA_HOSTS', '').split(','))):
+    DATABASES[f'replica_{index}'] = {**DATABASES['default'], 'HOST': host, 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica_{index}')
+
+DATABASE_ROUTERS = ['content_rating.routers.ReplicaRouter']
+# Replicas lagging behind by more than this are not read from
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '1'))
+# How often each process checks the lag of the replicas
+REPLICA_STATUS_TTL = float(os.getenv('REPLICA_STATUS_TTL', '1'))
+# How long reads go to the primary after a write, must exceed the two values above
+REPLICA_PIN_SECONDS = float(os.getenv('REPLICA_PIN_SECONDS', '5'))
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Serialized content responses, see contents.services.cache
+CONTENT_CACHE_ALIAS = 'default'
+CONTENT_CACHE_TIMEOUT = int(os.getenv('CONTENT_CACHE_TIMEOUT', '300'))
+CONTENT_CACHE_LOCK_TIMEOUT = int(os.getenv('CONTENT_CACHE_LOCK_TIMEOUT', '5'))
+
 # Logging
 LOGGING = {
     'version': 1,
@@ -190,10 +239,56 @@ STATICFILES_DIRS = [
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # Rating Processor Policies
+# Ratings a user, and a client IP, can send per sliding hour; 0 disables the limit
 RATE_LIMIT_PER_HOUR = int(os.getenv("RATE_LIMIT_PER_HOUR", '10000'))
+RATE_LIMIT_PER_IP_PER_HOUR = int(os.getenv("RATE_LIMIT_PER_IP_PER_HOUR", '50000'))
 MIN_RATE_COUNT = int(os.getenv("MIN_RATE_COUNT", '10'))
+BULK_RATING_MAX_ITEMS = int(os.getenv("BULK_RATING_MAX_ITEMS", '5000'))
 ANOMALY_THRESHOLD = float(os.getenv("ANOMALY_THRESHOLD", '0.85'))
+ANOMALY_WINDOW_MINUTES = int(os.getenv("ANOMALY_WINDOW_MINUTES", '60'))
+# Maximum number of contents whose sliding windows the processor keeps in memory
+ANOMALY_WINDOW_MAX_CONTENTS = int(os.getenv("ANOMALY_WINDOW_MAX_CONTENTS", '10000'))
+
+# Serve the list, detail and rate endpoints with async views (contents.async_views), on by
+# default under ASGI, see content_rating/asgi.py
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', '0') == '1'
+# Threads, each with a persistent connection, running the database work of the async views
+# of a process, see content_rating/database.py
+ASYNC_DB_THREADS = int(os.getenv('ASYNC_DB_THREADS', '16'))
+
+# Contents served by /api/contents/top/ per leaderboard, and how often the processor rebuilds
+# the leaderboards from the database to correct drift
+LEADERBOARD_SIZE = int(os.getenv('LEADERBOARD_SIZE', '100'))
+LEADERBOARD_RECONCILE_SECONDS = int(os.getenv('LEADERBOARD_RECONCILE_SECONDS', '300'))
+
+# Share of the search rank that depends on the score of a content rather than on text
+# relevance, between 0 (text only) and 1, see contents.services.search
+SEARCH_RATING_WEIGHT = float(os.getenv('SEARCH_RATING_WEIGHT', '0.3'))
+
+# Longest time series, in hours, served by /api/contents/<id>/stats/
+CONTENT_STATS_MAX_HOURS = int(os.getenv('CONTENT_STATS_MAX_HOURS', '2160'))
+
+# How rating messages reach the processor: 'kafka', or 'embedded' for an in-process queue
+# consumed by a processor thread of every web worker (single-node setups, no broker needed)
+RATING_TRANSPORT = os.getenv('RATING_TRANSPORT', 'kafka')
 
 # Kafka settings
 KAFKA_BOOTSTRAP_SERVERS = os.getenv('KAFKA_BOOTSTRAP_SERVERS', 'localhost:9092').split(',')
+KAFKA_PRODUCER_LINGER_MS = int(os.getenv('KAFKA_PRODUCER_LINGER_MS', '5'))
+KAFKA_PRODUCER_BATCH_SIZE = int(os.getenv('KAFKA_PRODUCER_BATCH_SIZE', '65536'))
+KAFKA_PRODUCER_COMPRESSION = os.getenv('KAFKA_PRODUCER_COMPRESSION') or None  # gzip, snappy, lz4, zstd
+KAFKA_PRODUCER_MAX_BLOCK_MS = int(os.getenv('KAFKA_PRODUCER_MAX_BLOCK_MS', '100'))
+KAFKA_PRODUCER_RETRY_SECONDS = int(os.getenv('KAFKA_PRODUCER_RETRY_SECONDS', '10'))
+KAFKA_PRODUCER_CLOSE_TIMEOUT = int(os.getenv('KAFKA_PRODUCER_CLOSE_TIMEOUT', '10'))
+# Maximum number of rating messages kept locally while Kafka is unreachable
+RATING_SPOOL_MAX_SIZE = int(os.getenv('RATING_SPOOL_MAX_SIZE', '10000'))
 ANOMALY_WEIGHT_PENALTY = 0.001
+
+# Rating processor batching: ratings are polled in batches of up to RATING_BATCH_MAX_RECORDS,
+# waiting at most RATING_BATCH_MAX_WAIT_MS for a batch to fill up
+RATING_BATCH_MAX_RECORDS = int(os.getenv('RATING_BATCH_MAX_RECORDS', '500'))
+RATING_BATCH_MAX_WAIT_MS = int(os.getenv('RATING_BATCH_MAX_WAIT_MS', '1000'))
+# Number of consumer processes started by run_rating_processor; the ratings topic needs at least as many partitions
+RATING_PROCESSOR_WORKERS = int(os.getenv('RATING_PROCESSOR_WORKERS', '1'))
+# Port of the processor's Prometheus endpoint, 0 disables it
+RATING_PROCESSOR_METRICS_PORT = int(os.getenv('RATING_PROCESSOR_METRICS_PORT', '9100'))
@@ -0,0 +1,184 @@
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.utils.decorators import classonlymethod
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import AuthenticationFailed, Throttled
+from rest_framework.request import Request
+from authentication.authentication import CachedJWTAuthentication
+from .models import Rating
+from .renderers import FastJSONRenderer
+from .services.producer import rating_producer
+from .services.cache import content_cache
+from .services.ratelimit import rating_limiter
+from . import views
+from content_rating.database import database_sync_to_async
+from content_rating.routers import replicas
+import json
+
+
+def json_response(data, status=status.HTTP_200_OK, headers=None):
+    return HttpResponse(FastJSONRenderer().render(data), status=status, headers=headers,
+                        content_type='application/json')
+
+
+def not_modified_response(etag):
+    return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+
+async def aratings_generation(request):
+    # Like views.ratings_generation
+    if not request.user.is_authenticated:
+        return None
+    return await content_cache.aratings_generation(request.user.pk)
+
+
+class AsyncAPIView(View):
+    """
+    Minimal async counterpart of APIView for the hot endpoints served under ASGI.
+
+    Requests are authenticated with the same JWT settings as the DRF views and responses
+    are rendered with FastJSONRenderer. Handlers never block the event loop: cache calls
+    use the async cache API, database work runs on the database threads (see
+    content_rating.database) and rating messages go through the producer's async methods.
+    The response bodies are the ones of the DRF views, whose read helpers are reused.
+    """
+    authentication_required = False
+    rate_limited = False
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        # Token authenticated like the DRF views, so no CSRF check either
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        if self.rate_limited:
+            # Before authentication, like RatingRateLimitMixin
+            wait = await rating_limiter.acheck(request)
+            if wait is not None:
+                exc = Throttled(wait=wait)
+                return json_response({'detail': exc.detail}, status=exc.status_code,
+                                     headers={'Retry-After': str(wait)})
+        try:
+            request.user = await self.authenticate(request)
+        except AuthenticationFailed as exc:
+            return self.authentication_failed(exc)
+        if self.authentication_required and not request.user.is_authenticated:
+            return self.authentication_failed(AuthenticationFailed('Authentication credentials were not provided.'))
+        return await super().dispatch(request, *args, **kwargs)
+
+    async def authenticate(self, request):
+        authentication = CachedJWTAuthentication()
+        header = authentication.get_header(request)
+        raw_token = authentication.get_raw_token(header) if header is not None else None
+        if raw_token is None:
+            return AnonymousUser()
+        validated_token = authentication.get_validated_token(raw_token)
+        # Same user checks as the DRF views, only a cache miss goes to the database threads
+        user = authentication.get_cached_user(validated_token)
+        if user is None:
+            user = await database_sync_to_async(authentication.get_user)(validated_token)
+        return user
+
+    def authentication_failed(self, exc):
+        detail = exc.detail if isinstance(exc.detail, dict) else {'detail': exc.detail}
+        return json_response(detail, status=status.HTTP_401_UNAUTHORIZED,
+                             headers={'WWW-Authenticate': 'Bearer realm="api"'})
+
+
+class ContentListView(AsyncAPIView):
+    async def get(self, request):
+        try:
+            views.parse_list_filters(request.GET)
+        except ValueError as e:
+            return json_response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        params = [(key, request.GET.getlist(key)) for key in request.GET]
+        params.append(('host', request.get_host()))
+        generation = await content_cache.alist_generation()
+        etag = content_cache.list_etag(params, generation, request.user.pk, await aratings_generation(request))
+        if views.is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+        async with replicas.areads(*views.user_scopes(request)):
+            data = await content_cache.aget_list_page(params, lambda: self.load_page(request), generation=generation)
+            results = await database_sync_to_async(views.with_user_ratings)(request, data['results'])
+        return json_response({**data, 'results': results}, headers={'ETag': etag, 'Vary': 'Authorization'})
+
+    async def load_page(self, request):
+        view = views.ContentListView(request=Request(request), args=(), kwargs={}, format_kwarg=None, action='list')
+        return await database_sync_to_async(view.load_page)()
+
+
+class ContentDetailView(AsyncAPIView):
+    async def get(self, request, content_id):
+        version = await content_cache.adetail_version(content_id)
+        etag = content_cache.detail_etag(content_id, version, request.user.pk, await aratings_generation(request))
+        if views.is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+        async with replicas.areads(*views.user_scopes(request)):
+            data = await content_cache.aget_detail(content_id, lambda: self.load(content_id), version=version)
+            if data is None:
+                return json_response({'error': 'Content not found'}, status=status.HTTP_404_NOT_FOUND)
+            data = (await database_sync_to_async(views.with_user_ratings)(request, [data]))[0]
+        return json_response(data, headers={'ETag': etag, 'Vary': 'Authorization'})
+
+    async def load(self, content_id):
+        return await database_sync_to_async(views.ContentDetailView().load)(content_id)
+
+
+class ContentRatingView(AsyncAPIView):
+    authentication_required = True
+    rate_limited = True
+
+    async def post(self, request):
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body or b'{}')
+            except ValueError:
+                return json_response({'error': 'Invalid JSON body'}, status=status.HTTP_400_BAD_REQUEST)
+            if not isinstance(data, dict):
+                data = {}
+        else:
+            data = request.POST
+        content_id = data.get('content_id')
+        rating_value = data.get('rating')
+        user = request.user
+
+        if content_id is None or rating_value is None:
+            return json_response({'error': 'Missing required fields'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            content_id = views.parse_content_id(content_id)
+        except ValueError:
+            return json_response({'error': 'content_id must be an integer id'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            rating_value = int(rating_value)
+            if not (0 <= rating_value <= 5):
+                return json_response({'error': 'Rating must be between 0 and 5'}, status=status.HTTP_400_BAD_REQUEST)
+        except (TypeError, ValueError, OverflowError):
+            return json_response({'error': 'Rating must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+
+        result = await database_sync_to_async(Rating.objects.upsert)(content_id, user.id, rating_value)
+        if result is None:
+            return json_response({'error': 'Content not found'}, status=status.HTTP_404_NOT_FOUND)
+        rating_id, created = result
+        await replicas.apin(f'user:{user.id}')
+        await content_cache.auser_ratings_changed(user.id)
+        action = 'created' if created else 'updated'
+
+        # Queued without waiting on the broker, like the sync view
+        await rating_producer.asend('ratings', {
+            'content_id': content_id,
+            'rating_id': rating_id,
+            'user_id': user.id,
+            'rating': rating_value
+        }, key=content_id)
+
+        return json_response({
+            'status': 'success',
+            'message': f'Rating {action}',
+            'rating': rating_value
+        })
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max, Min
+from contents.models import Content
+from contents.services.rollups import backfill_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the hourly rating rollups of the contents from their applied ratings, in chunks of contents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Contents rebuilt per transaction, by id range')
+        parser.add_argument('--start-id', type=int, default=None,
+                            help='Resume from the given content id')
+
+    def handle(self, *args, **options):
+        bounds = Content.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('No contents to backfill')
+            return
+        start = max(bounds['min_id'], options['start_id'] or 0)
+
+        rows = 0
+        for min_id in range(start, bounds['max_id'] + 1, options['chunk_size']):
+            max_id = min_id + options['chunk_size']
+            rows += backfill_rollups(min_id, max_id)
+            self.stdout.write(f'Contents {min_id} to {max_id - 1}: {rows} rollup rows written so far')
+
+        self.stdout.write(self.style.SUCCESS(f'Backfilled {rows} rollup rows'))
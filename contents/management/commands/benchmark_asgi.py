@@ -0,0 +1,181 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.urls import reverse
+from rest_framework_simplejwt.tokens import AccessToken
+from authentication.models import User
+from contents.models import Content
+from contents.services.benchmark import HttpLoad, process_tree_rss
+from io import StringIO
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+HOST = '127.0.0.1'
+
+SERVERS = {
+    # The deployed WSGI setup: one gunicorn sync worker per process
+    'wsgi': lambda port, options: [
+        sys.executable, '-m', 'gunicorn', '--bind', f'{HOST}:{port}', '--workers', '1',
+        '--threads', str(options['wsgi_threads']), '--backlog', '4096', '--log-level', 'warning',
+        'content_rating.wsgi:application',
+    ],
+    'asgi': lambda port, options: [
+        sys.executable, '-m', 'uvicorn', '--host', HOST, '--port', str(port), '--backlog', '4096',
+        '--no-access-log', '--log-level', 'warning', 'content_rating.asgi:application',
+    ],
+}
+
+
+class Command(BaseCommand):
+    help = ('Compares one WSGI (gunicorn) and one ASGI (uvicorn) server process under increasing '
+            'numbers of concurrent in-flight requests, reporting throughput, latency and memory')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', choices=sorted(SERVERS), default=['wsgi', 'asgi'])
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[16, 128, 512],
+                            help='Concurrent in-flight requests to measure at')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds per concurrency level')
+        parser.add_argument('--warmup', type=float, default=2, help='Seconds of load before each server is measured')
+        parser.add_argument('--timeout', type=float, default=10, help='Requests slower than this count as errors')
+        parser.add_argument('--rate-share', type=float, default=0.25,
+                            help='Fraction of the requests that are ratings, the rest are detail reads')
+        parser.add_argument('--contents', type=int, default=10000)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--wsgi-threads', type=int, default=1,
+                            help='gunicorn threads, above 1 the worker becomes a gthread worker')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', default='asgi-benchmark-results.json', help='Where to write the results')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database between runs')
+
+    def handle(self, *args, **options):
+        # Runs against a throwaway test database, never the configured one
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            self.stdout.write(f"Populating {options['contents']} contents...")
+            call_command(
+                'populate_db', users=options['users'], contents=options['contents'], ratings=options['contents'],
+                seed=options['seed'], workers=1, stdout=StringIO(),
+            )
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            tokens = [str(AccessToken.for_user(user)) for user in User.objects.order_by('id')[:options['users']]]
+            content_ids = list(Content.objects.values_list('id', flat=True))
+            make_request = self.request_mix(tokens, content_ids, options['rate_share'])
+            # Settings of the server processes, the database being the one created above
+            env = {
+                **os.environ,
+                'POSTGRES_DB': settings.DATABASES['default']['NAME'],
+                'RATING_TRANSPORT': 'embedded',
+                'DEBUG': '0',
+            }
+            env.pop('REDIS_URL', None)  # Each process caches on its own, the same for both servers
+
+            results = {}
+            for name in options['servers']:
+                results[name] = self.measure(name, env, make_request, options)
+        finally:
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        output = {
+            'environment': {
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+            },
+            'parameters': {
+                key: options[key] for key in ('concurrency', 'duration', 'rate_share', 'contents', 'wsgi_threads')
+            },
+            'servers': results,
+        }
+        with open(options['output'], 'w') as output_file:
+            json.dump(output, output_file, indent=2)
+
+        self.stdout.write(f"{'server':<6} {'in flight':>9} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>9} {'errors':>7} {'peak RSS MB':>12}")
+        for name, levels in results.items():
+            for concurrency, level in levels.items():
+                self.stdout.write(
+                    f"{name:<6} {concurrency:>9} {level['requests_per_second']:>8} {level['latency_ms']['p50']:>8} "
+                    f"{level['latency_ms']['p99']:>9} {level['errors']:>7} {level['peak_rss_mb']:>12}"
+                )
+        self.stdout.write(f"Results written to {options['output']}")
+
+    def request_mix(self, tokens, content_ids, rate_share):
+        rate_path = reverse('content-rate')
+
+        def make_request(rng):
+            headers = {'Authorization': f'Bearer {rng.choice(tokens)}'}
+            content_id = rng.choice(content_ids)
+            if rng.random() < rate_share:
+                body = json.dumps({'content_id': content_id, 'rating': rng.randint(0, 5)}).encode()
+                return 'POST', rate_path, {**headers, 'Content-Type': 'application/json'}, body
+            return 'GET', reverse('content-detail', args=[content_id]), headers, b''
+
+        return make_request
+
+    def measure(self, name, env, make_request, options):
+        port = options['port']
+        env = {**env, 'ASYNC_VIEWS': '1' if name == 'asgi' else '0'}
+        self.stdout.write(f'Starting the {name} server...')
+        # The embedded processor logs every batch, the server output is not kept
+        server = subprocess.Popen(
+            SERVERS[name](port, options), env=env, cwd=settings.BASE_DIR,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            self.wait_until_listening(server, port)
+            HttpLoad(HOST, port, make_request, min(options['concurrency']), options['warmup'],
+                     options['timeout'], options['seed']).run()
+            idle_rss = process_tree_rss(server.pid)
+
+            levels = {}
+            for concurrency in options['concurrency']:
+                self.stdout.write(f'{name}: {concurrency} requests in flight for {options["duration"]:g}s...')
+                peak_rss = [idle_rss]
+                stop = threading.Event()
+
+                def sample_memory():
+                    while not stop.wait(0.25):
+                        peak_rss.append(process_tree_rss(server.pid))
+
+                sampler = threading.Thread(target=sample_memory, name='benchmark-rss')
+                sampler.start()
+                try:
+                    level = HttpLoad(HOST, port, make_request, concurrency, options['duration'],
+                                     options['timeout'], options['seed']).run()
+                finally:
+                    stop.set()
+                    sampler.join()
+                level['idle_rss_mb'] = round(idle_rss / 2 ** 20, 1)
+                level['peak_rss_mb'] = round(max(peak_rss) / 2 ** 20, 1)
+                levels[str(concurrency)] = level
+            return levels
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+
+    def wait_until_listening(self, server, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                raise CommandError(f'The server exited with code {server.returncode}, start it by hand to see why')
+            try:
+                socket.create_connection((HOST, port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f'The server did not listen on port {port} within {timeout}s')
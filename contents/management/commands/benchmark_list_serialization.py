@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from contents.models import Content
+from contents.renderers import FastJSONRenderer
+from contents.serializers import ContentSerializer, CONTENT_LIST_VALUES, serialize_content_rows
+from datetime import timedelta
+import timeit
+
+
+class Command(BaseCommand):
+    help = 'Compares the CPU cost of serializing and rendering a content list page on both read paths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--iterations', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        # Rows are built in memory so only serialization and rendering are measured
+        now = timezone.now()
+        contents = [
+            Content(id=i, title=f'Content title number {i}', text='', rating_count=i * 7,
+                    average_rating=(i % 50) / 10, created_at=now - timedelta(minutes=i))
+            for i in range(1, options['page_size'] + 1)
+        ]
+        rows = [{field: getattr(content, field) for field in CONTENT_LIST_VALUES} for content in contents]
+
+        model_renderer = JSONRenderer()
+        fast_renderer = FastJSONRenderer()
+
+        def model_path():
+            return model_renderer.render({'results': ContentSerializer(contents, many=True).data})
+
+        def lean_path():
+            return fast_renderer.render({'results': serialize_content_rows(rows)})
+
+        if model_path() != lean_path():
+            self.stdout.write(self.style.ERROR('The two read paths render different bytes'))
+            return
+
+        iterations = options['iterations']
+        results = {}
+        for name, path in [('ModelSerializer + JSONRenderer', model_path), ('values rows + FastJSONRenderer', lean_path)]:
+            seconds = min(timeit.repeat(path, number=iterations, repeat=5))
+            results[name] = seconds / iterations * 1e6
+            self.stdout.write(f'{name}: {results[name]:.1f} us per {options["page_size"]}-item page')
+
+        model_cost, lean_cost = results.values()
+        self.stdout.write(self.style.SUCCESS(f'Lean read path is {model_cost / lean_cost:.1f}x faster'))
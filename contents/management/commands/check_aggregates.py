@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from contents.models import Content
+from contents.services.aggregates import AGGREGATE_FIELDS, find_aggregate_drift, recompute_aggregates
+
+
+class Command(BaseCommand):
+    help = 'Compares the incrementally maintained content aggregates against a full recompute'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--content-id', type=int, action='append', dest='content_ids',
+                            help='Only check the given content (can be repeated)')
+        parser.add_argument('--tolerance', type=float, default=1e-6)
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--fix', action='store_true',
+                            help='Overwrite drifted contents with the recomputed values')
+
+    def handle(self, *args, **options):
+        queryset = Content.objects.order_by('id').only('id', *AGGREGATE_FIELDS)
+        if options['content_ids']:
+            queryset = queryset.filter(id__in=options['content_ids'])
+
+        drifted = 0
+        last_id = 0
+        while True:
+            chunk = list(queryset.filter(id__gt=last_id)[:options['chunk_size']])
+            if not chunk:
+                break
+            last_id = chunk[-1].id
+
+            drift = find_aggregate_drift(chunk, tolerance=options['tolerance'])
+            for content, field, stored, expected in drift:
+                self.stdout.write(f'Content {content.id}: {field} is {stored}, expected {expected}')
+
+            contents = {content.id: content for content, *_ in drift}
+            drifted += len(contents)
+            if options['fix'] and contents:
+                expected = recompute_aggregates(list(contents))
+                for content_id, content in contents.items():
+                    for field, value in expected[content_id].items():
+                        setattr(content, field, value)
+                Content.objects.bulk_update(contents.values(), AGGREGATE_FIELDS)
+
+        if drifted:
+            action = 'Fixed' if options['fix'] else 'Found'
+            self.stdout.write(self.style.WARNING(f'{action} {drifted} contents with drifted aggregates'))
+        else:
+            self.stdout.write(self.style.SUCCESS('All content aggregates are consistent'))
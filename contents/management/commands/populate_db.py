@@ -1,79 +1,258 @@
 from django.core.management.base import BaseCommand
-from django.contrib.auth import get_user_model
-from faker import Faker
-from random import randint, uniform, choice
+from django.contrib.auth.hashers import make_password
+from django.db import connection, connections, transaction
 from django.utils import timezone
+from faker import Faker
+from array import array
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import accumulate
+import csv
+import io
+import multiprocessing
+import os
+import random
+import time
 
 from authentication.models import User
 from contents.models import Content, Rating
+from contents.services.aggregates import refresh_aggregates
+from contents.services.rollups import backfill_rollups
+
+RATING_COLUMNS = ('content_id', 'user_id', 'rating', 'weight', 'created_at', 'updated_at', 'processed', 'applied_rating')
+CONTENT_COLUMNS = ('title', 'text', 'created_at', 'rating_count', 'average_rating', 'weighted_sum', 'weight_sum')
+
+# Inherited by the forked worker processes
+_state = {}
+
+
+def copy_rows(cursor, table, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def generate_contents(task):
+    """Insert `count` fake contents with COPY"""
+    seed, count = task
+    rng = random.Random(seed)
+    texts, titles, now = _state['texts'], _state['titles'], _state['now']
+    year = 365 * 24 * 3600
+
+    rows = []
+    for _ in range(count):
+        created_at = now - timedelta(seconds=rng.random() * year)
+        rows.append((rng.choice(titles), rng.choice(texts), created_at.isoformat(), 0, 0.0, 0.0, 0.0))
+    with connection.cursor() as cursor:
+        copy_rows(cursor, Content._meta.db_table, CONTENT_COLUMNS, rows)
+    return count
+
+
+def generate_ratings(task):
+    """
+    Insert the ratings of a slice of users. Every user rates distinct contents picked with
+    the Zipfian popularity, so the slices never collide with each other. A user with more
+    ratings than fit in a chunk is split into `parts` tasks, each picking from its own
+    stripe of the contents (every `parts`-th one), so the parts cannot collide either. An
+    empty table is loaded with a plain COPY, otherwise rows go through a staging table so
+    collisions with existing ratings are skipped.
+    """
+    seed, user_ids, per_user, part, parts = task
+    rng = random.Random(seed)
+    content_ids, content_created, quality = _state['content_ids'], _state['content_created'], _state['quality']
+    now = _state['now']
+    population = range(part, len(content_ids), parts)
+    if parts == 1:
+        cum_weights = _state['cum_weights']
+    else:
+        # Popularity ranks follow the content order, the stripe keeps the shape of the distribution
+        cum_weights = array('d', accumulate(1 / (index + 1) ** _state['zipf'] for index in population))
+    # The ratings of a user are spread over its parts, with the extra one in the first
+    share = per_user // parts + (1 if part < per_user % parts else 0)
+    now_ts = now.timestamp()
+
+    rows = []
+    for user_id in user_ids:
+        extra = 1 if part == 0 and rng.random() < _state['extra_probability'] else 0
+        count = min(share + extra, len(population))
+        picked = set()
+        for _ in range(4):  # Popular contents get picked repeatedly, top up a few times
+            picked.update(rng.choices(population, cum_weights=cum_weights, k=count - len(picked)))
+            if len(picked) >= count:
+                break
+        while len(picked) < count:
+            picked.add(rng.choice(population))
+
+        for index in picked:
+            value = min(5, max(0, round(rng.gauss(quality[index], 1.2))))
+            created = content_created[index]
+            created_at = datetime.fromtimestamp(created + rng.random() * (now_ts - created), dt_timezone.utc).isoformat()
+            rows.append((content_ids[index], user_id, value, 1.0, created_at, created_at, 't', value))
+
+    # Sorted rows keep the (content, user) index inserts local
+    rows.sort()
+    with transaction.atomic(), connection.cursor() as cursor:
+        if _state['skip_triggers']:
+            # Content and user ids come from the database, the FK checks can be skipped
+            cursor.execute("SET LOCAL session_replication_role = replica")
+        inserted = load_ratings(cursor, rows)
+        if _state['skip_triggers']:
+            # In case this runs inside an outer transaction
+            cursor.execute("SET LOCAL session_replication_role = DEFAULT")
+        return inserted
+
+
+def load_ratings(cursor, rows):
+    if _state['fresh']:
+        copy_rows(cursor, Rating._meta.db_table, RATING_COLUMNS, rows)
+        return len(rows)
+
+    cursor.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS rating_staging ("
+        "content_id bigint, user_id bigint, rating integer, weight double precision, "
+        "created_at timestamptz, updated_at timestamptz, processed boolean, applied_rating integer)"
+    )
+    cursor.execute("TRUNCATE rating_staging")
+    copy_rows(cursor, 'rating_staging', RATING_COLUMNS, rows)
+    columns = ', '.join(RATING_COLUMNS)
+    cursor.execute(
+        f"INSERT INTO {Rating._meta.db_table} ({columns}) SELECT {columns} FROM rating_staging "
+        "ON CONFLICT (content_id, user_id) DO NOTHING"
+    )
+    return cursor.rowcount
+
 
 class Command(BaseCommand):
     help = 'Populate database with fake data'
 
-    def handle(self, *args, **kwargs):
-        
-        # Create the simple user with username 'user' and password 'password'
-        User.objects.get_or_create(username='user', password='password')
-        
-        users_min_count = 20
-        contents_min_count = 100
-        ratings_min_count = 1000
-        
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=20, help='Minimum number of users')
+        parser.add_argument('--contents', type=int, default=100, help='Minimum number of contents')
+        parser.add_argument('--ratings', type=int, default=1000, help='Minimum number of ratings')
+        parser.add_argument('--seed', type=int, help='Seed for reproducible datasets')
+        parser.add_argument('--zipf', type=float, default=1.1,
+                            help='Exponent of the Zipfian content popularity distribution')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of processes generating and loading rows')
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Rows per COPY')
+
+    def handle(self, *args, **options):
+        seed = options['seed'] if options['seed'] is not None else random.randrange(2 ** 32)
+        rng = random.Random(seed)
         fake = Faker()
+        fake.seed_instance(seed)
+        _state['now'] = timezone.now()
 
-        all_users_count = User.objects.all().count()
-        
-        for _ in range(users_min_count - all_users_count):
-            username = fake.user_name()
-            email = fake.email()
-            user, _ = User.objects.get_or_create(
-                username=username,
-                password='password',
-                defaults={'email': email}
-            )
+        # Create the simple user with username 'user' and password 'password'
+        if not User.objects.filter(username='user').exists():
+            User.objects.create_user(username='user', password='password')
+
+        self.create_users(options['users'], fake)
+
+        missing_contents = options['contents'] - Content.objects.count()
+        if missing_contents > 0:
+            # A pool of fake texts is reused, generating one per row does not scale
+            _state['titles'] = [fake.sentence(nb_words=6) for _ in range(1000)]
+            _state['texts'] = [fake.text(max_nb_chars=1000) for _ in range(1000)]
+            tasks = [(rng.randrange(2 ** 32), size) for size in self.split(missing_contents, options['chunk_size'])]
+            self.run_tasks('Contents', generate_contents, tasks, missing_contents, options['workers'])
+
+        existing_ratings = Rating.objects.count()
+        missing_ratings = options['ratings'] - existing_ratings
+        if missing_ratings > 0:
+            _state['fresh'] = existing_ratings == 0
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT rolsuper FROM pg_roles WHERE rolname = current_user")
+                _state['skip_triggers'] = cursor.fetchone()[0]
+            self.prepare_ratings(rng, options['zipf'])
+            user_ids = list(User.objects.order_by('id').values_list('id', flat=True))
+            per_user, extra = divmod(missing_ratings, len(user_ids))
+            _state['extra_probability'] = extra / len(user_ids)
 
+            # Every task holds at most chunk_size rows in memory, counting a user's extra rating
+            chunk_size = options['chunk_size']
+            if per_user + 1 > chunk_size:
+                parts = -(-(per_user + 1) // chunk_size)
+                tasks = [
+                    (rng.randrange(2 ** 32), [user_id], per_user, part, parts)
+                    for user_id in user_ids for part in range(parts)
+                ]
+            else:
+                users_per_task = chunk_size // (per_user + 1)
+                tasks = [
+                    (rng.randrange(2 ** 32), user_ids[start:start + users_per_task], per_user, 0, 1)
+                    for start in range(0, len(user_ids), users_per_task)
+                ]
+            self.run_tasks('Ratings', generate_ratings, tasks, missing_ratings, options['workers'])
 
-        all_contents_count = Content.objects.all().count()
-        for _ in range(contents_min_count - all_contents_count):
-            content = Content.objects.create(
-                title=fake.sentence(nb_words=6),
-                text=fake.text(max_nb_chars=1000),
-                created_at=fake.date_time_between(
-                    start_date='-1y',
-                    end_date='now',
-                    tzinfo=timezone.get_current_timezone()
-                )
+            self.stdout.write('Refreshing content aggregates and rating rollups...')
+            last_id = Content.objects.order_by('-id').values_list('id', flat=True).first() or 0
+            for min_id in range(0, last_id + 1, 100000):
+                refresh_aggregates(min_id, min_id + 100000)
+                # The stats endpoint and later re-rates rely on the rollups of applied ratings
+                backfill_rollups(min_id, min_id + 100000)
+
+        self.stdout.write(self.style.SUCCESS('Successfully populated database'))
+
+    def create_users(self, users_count, fake):
+        missing = users_count - User.objects.count()
+        if missing <= 0:
+            return
+        # Hashing is deliberately slow, every fake user shares the hash of 'password'
+        password = make_password('password')
+        offset = User.objects.count()
+        for size in self.split(missing, 10000):
+            User.objects.bulk_create(
+                [
+                    User(username=f'{fake.user_name()}{offset + index}', email=fake.email(), password=password)
+                    for index in range(size)
+                ],
+                ignore_conflicts=True,
             )
-            self.stdout.write(f'Created content: {content.title}')
-
-        users = list(User.objects.all())
-        contents = list(Content.objects.all())
-
-
-        all_ratings_count = Rating.objects.all().count()
-        # Create 1000 ratings
-        for _ in range(ratings_min_count - all_ratings_count):
-            content = choice(contents)
-            user = choice(users)
-            
-            # Try to create rating, skip if user already rated this content
-            try:
-                rating = randint(0, 5)
-                weight = uniform(0.0, 1.0)
-                Rating.objects.create(
-                    content=content,
-                    user=user,
-                    rating=rating,
-                    weight=weight,
-                    created_at=fake.date_time_between(
-                        start_date=content.created_at,
-                        end_date='now',
-                        tzinfo=timezone.get_current_timezone()
-                    )
-                )
-                self.stdout.write(f'User with {user.username} username rated the content with title {content.title} {rating}/5')
-            except Exception as e:
-                self.stdout.write(f'An error occured while saving a rating: {str(e)}')
-                continue
-
-        self.stdout.write(self.style.SUCCESS('Successfully populated database'))
\ No newline at end of file
+            offset += size
+        self.stdout.write(f'Users: {User.objects.count()}')
+
+    def prepare_ratings(self, rng, zipf):
+        contents = Content.objects.order_by('id').values_list('id', 'created_at')
+        _state['content_ids'] = content_ids = array('q')
+        _state['content_created'] = content_created = array('d')
+        for content_id, created_at in contents.iterator(chunk_size=100000):
+            content_ids.append(content_id)
+            content_created.append(created_at.timestamp())
+
+        # Shuffle so that popularity is unrelated to the id, and give each content a typical rating
+        order = list(range(len(content_ids)))
+        rng.shuffle(order)
+        _state['content_ids'] = array('q', (content_ids[index] for index in order))
+        _state['content_created'] = array('d', (content_created[index] for index in order))
+        _state['quality'] = array('d', (rng.uniform(0.5, 4.5) for _ in order))
+        _state['cum_weights'] = array('d', accumulate(1 / rank ** zipf for rank in range(1, len(order) + 1)))
+        _state['zipf'] = zipf
+
+    def split(self, total, size):
+        return [min(size, total - start) for start in range(0, total, size)]
+
+    def run_tasks(self, name, function, tasks, total, workers):
+        started = last_report = time.monotonic()
+        done = 0
+
+        def report(force=False):
+            nonlocal last_report
+            now = time.monotonic()
+            if force or now - last_report >= 1:
+                last_report = now
+                rate = done / max(now - started, 1e-9)
+                self.stdout.write(f'{name}: {done}/{total} ({rate:,.0f} rows/s)')
+
+        if workers <= 1:
+            for task in tasks:
+                done += function(task)
+                report()
+        else:
+            # Every worker opens its own database connection
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(workers) as pool:
+                for count in pool.imap_unordered(function, tasks):
+                    done += count
+                    report()
+        report(force=True)
@@ -0,0 +1,155 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+from django.db.models import Max, Min
+import json
+import multiprocessing
+import os
+import time
+
+from contents.models import Content
+from contents.services.aggregates import refresh_aggregates, rescore_anomalies
+from contents.services.cache import content_cache
+from contents.services.leaderboard import leaderboard
+from contents.services.rollups import backfill_rollups
+
+# Inherited by the forked worker processes
+_state = {}
+
+
+class DryRun(Exception):
+    """Rolls the chunk back once its changes have been collected"""
+
+
+def rebuild_chunk(min_id):
+    """
+    Rebuild the aggregates of one range of contents in a single transaction. The contents
+    are locked first, so the processor cannot apply ratings to them in between. Returns
+    (min_id, re-weighted ratings, changes) where changes come from refresh_aggregates.
+    """
+    max_id = min_id + _state['chunk_size']
+    using = router.db_for_write(Content)
+    result = None
+    try:
+        with transaction.atomic(using=using), connections[using].cursor() as cursor:
+            cursor.execute(
+                f'SELECT id FROM {Content._meta.db_table} WHERE id >= %s AND id < %s ORDER BY id FOR UPDATE',
+                [min_id, max_id],
+            )
+            rescored = rescore_anomalies(min_id, max_id) if _state['rescore'] else 0
+            changes = refresh_aggregates(min_id, max_id, tolerance=_state['tolerance'])
+            if rescored:
+                # The rollups sum up the weights as well
+                backfill_rollups(min_id, max_id)
+            result = (min_id, rescored, changes)
+            if _state['dry_run']:
+                raise DryRun
+    except DryRun:
+        pass
+    return result
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the content aggregates from the ratings with one GROUP BY per range of contents, '
+            'in parallel worker processes, and writes back the contents that drifted')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='Contents rebuilt per transaction, by id range')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of processes rebuilding chunks')
+        parser.add_argument('--tolerance', type=float, default=1e-6)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report the contents that would change and roll every chunk back')
+        parser.add_argument('--show', type=int, default=20,
+                            help='Number of changed contents listed, the ones whose average moved most')
+        parser.add_argument('--rescore-anomalies', action='store_true',
+                            help='Recompute the anomaly weights of the ratings with the current settings first')
+        parser.add_argument('--state-file',
+                            help='Records the finished chunks, so an interrupted run resumes where it stopped')
+
+    def handle(self, *args, **options):
+        bounds = Content.objects.aggregate(min_id=Min('id'), max_id=Max('id'))
+        if bounds['min_id'] is None:
+            self.stdout.write('No contents to rebuild')
+            return
+
+        chunk_size = options['chunk_size']
+        _state.update(chunk_size=chunk_size, tolerance=options['tolerance'],
+                      dry_run=options['dry_run'], rescore=options['rescore_anomalies'])
+        first = bounds['min_id'] - bounds['min_id'] % chunk_size
+        done = self.load_state(options['state_file'], chunk_size)
+        chunks = [min_id for min_id in range(first, bounds['max_id'] + 1, chunk_size) if min_id not in done]
+        if done:
+            self.stdout.write(f'Resuming, {len(done)} chunks already rebuilt')
+
+        started = last_report = time.monotonic()
+        finished = rescored = 0
+        changes = []
+
+        def report(force=False):
+            nonlocal last_report
+            now = time.monotonic()
+            if force or now - last_report >= 1:
+                last_report = now
+                rate = finished / max(now - started, 1e-9)
+                self.stdout.write(f'Chunks: {finished}/{len(chunks)} ({rate:,.1f} chunks/s), '
+                                  f'{len(changes)} contents changed')
+
+        for min_id, chunk_rescored, chunk_changes in self.run_chunks(chunks, options['workers']):
+            finished += 1
+            rescored += chunk_rescored
+            changes.extend(chunk_changes)
+            if not options['dry_run']:
+                content_cache.contents_changed([row[0] for row in chunk_changes])
+                if options['state_file']:
+                    done.add(min_id)
+                    self.save_state(options['state_file'], chunk_size, done)
+            report()
+        report(force=True)
+
+        self.show_changes(changes, options['show'])
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING(
+                f'Dry run: {len(changes)} contents would change, {rescored} ratings would be re-weighted'))
+            return
+
+        if changes:
+            leaderboard.reconcile()
+        if options['state_file'] and os.path.exists(options['state_file']):
+            os.remove(options['state_file'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt the aggregates: {len(changes)} contents changed, {rescored} ratings re-weighted'))
+
+    def run_chunks(self, chunks, workers):
+        if workers <= 1:
+            for min_id in chunks:
+                yield rebuild_chunk(min_id)
+            return
+        # Every worker opens its own database connection
+        connections.close_all()
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            yield from pool.imap_unordered(rebuild_chunk, chunks)
+
+    def show_changes(self, changes, limit):
+        changes = sorted(changes, key=lambda row: abs(row[4] - row[3]), reverse=True)
+        for content_id, stored_count, rating_count, stored_average, average in changes[:limit]:
+            self.stdout.write(f'Content {content_id}: rating_count {stored_count} -> {rating_count}, '
+                              f'average_rating {stored_average:.6f} -> {average:.6f}')
+        if changes:
+            largest = abs(changes[0][4] - changes[0][3])
+            self.stdout.write(f'{len(changes)} contents changed, largest average change {largest:.6f}')
+
+    def load_state(self, path, chunk_size):
+        if not path or not os.path.exists(path):
+            return set()
+        with open(path) as file:
+            state = json.load(file)
+        if state['chunk_size'] != chunk_size:
+            raise CommandError(f"{path} was written with --chunk-size {state['chunk_size']}")
+        return set(state['done'])
+
+    def save_state(self, path, chunk_size, done):
+        # Replaced atomically, an interruption leaves either the old or the new state
+        with open(f'{path}.tmp', 'w') as file:
+            json.dump({'chunk_size': chunk_size, 'done': sorted(done)}, file)
+        os.replace(f'{path}.tmp', path)
@@ -0,0 +1,313 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from authentication.models import User
+from contents.models import Content
+from contents.services.benchmark import compare_to_baseline, percentiles
+from contents.services.cache import content_cache
+from contents.services.memory_kafka import InMemoryBroker
+from contents.services.producer import RatingProducer
+from contents.services.rating_processor import RatingProcessor
+from contents.services.transport import EmbeddedTransport
+from io import StringIO
+from unittest import mock
+import django
+import json
+import logging
+import os
+import platform
+import random
+import threading
+import time
+
+TOPIC = 'ratings'
+GROUP_ID = 'rating_processor_group'
+
+
+class PipelineBenchmark:
+    """
+    Measures the rating pipeline and the read endpoints in-process, against whatever database
+    is configured (the benchmark command points it at a throwaway test database) and with
+    Kafka replaced by the embedded transport, so the numbers only depend on Django and Postgres.
+    The processor is driven by the benchmark rather than by the transport's own thread.
+    """
+
+    def __init__(self, requests=2000, read_requests=200, e2e_rate=200, users=100, workers=1, seed=42, stdout=None):
+        self.requests = requests
+        self.read_requests = read_requests
+        self.e2e_rate = e2e_rate
+        self.users = users
+        self.workers = workers
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.stdout = stdout or StringIO()
+        self.broker = InMemoryBroker(track_latency=True)
+        self.transport = EmbeddedTransport(self.broker, run_processor=False)
+
+    def run(self, sizes):
+        metrics = {'reads': {}}
+        for index, size in enumerate(sorted(sizes)):
+            self.populate(size)
+            if index == 0:
+                metrics.update(self.run_pipeline())
+            metrics['reads'][str(size)] = self.run_reads()
+        return metrics
+
+    def populate(self, size):
+        self.stdout.write(f'Populating {size} contents...')
+        call_command(
+            'populate_db', users=self.users, contents=size, ratings=size, seed=self.seed,
+            workers=self.workers, stdout=StringIO(),
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.content_range = (
+            Content.objects.order_by('id').values_list('id', flat=True).first(),
+            Content.objects.order_by('-id').values_list('id', flat=True).first(),
+        )
+
+    def random_content_id(self):
+        return self.rng.randint(*self.content_range)
+
+    def rating_clients(self):
+        clients = []
+        for user in User.objects.order_by('id')[:self.users]:
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}')
+            clients.append(client)
+        return clients
+
+    def post_rating(self, client):
+        started = time.perf_counter()
+        response = client.post(
+            reverse('content-rate'),
+            {'content_id': self.random_content_id(), 'rating': self.rng.randint(0, 5)},
+            format='json',
+        )
+        elapsed = (time.perf_counter() - started) * 1000
+        if response.status_code != 200:
+            raise RuntimeError(f'Rating request failed with {response.status_code}: {response.content!r}')
+        return elapsed
+
+    def wait_for_messages(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        while self.broker.pending(TOPIC, GROUP_ID) < count:
+            if time.monotonic() > deadline:
+                raise RuntimeError('Rating messages did not reach the broker')
+            time.sleep(0.01)
+
+    def drain(self, processor):
+        processed = 0
+        while self.broker.pending(TOPIC, GROUP_ID):
+            processed += processor.poll_once()
+        return processed
+
+    def run_pipeline(self):
+        clients = self.rating_clients()
+        producer = RatingProducer(transport=self.transport)
+        with mock.patch('contents.views.rating_producer', producer):
+            processor = RatingProcessor(transport=self.transport)
+
+            # Warm up: connects the producer and fills the connection and anomaly window caches
+            for client in clients:
+                self.post_rating(client)
+            self.wait_for_messages(len(clients))
+            self.drain(processor)
+
+            self.stdout.write(f'Posting {self.requests} ratings...')
+            latencies = []
+            started = time.perf_counter()
+            for index in range(self.requests):
+                latencies.append(self.post_rating(clients[index % len(clients)]))
+            post_seconds = time.perf_counter() - started
+            self.wait_for_messages(self.requests)
+
+            self.stdout.write(f'Processing {self.requests} queued ratings...')
+            started = time.perf_counter()
+            processed = self.drain(processor)
+            process_seconds = time.perf_counter() - started
+
+            end_to_end = self.run_end_to_end(processor, clients)
+            processor.consumer.close(autocommit=False)
+            producer.close()
+
+        return {
+            'rating_post': {
+                'requests_per_second': round(self.requests / post_seconds, 1),
+                'latency_ms': percentiles(latencies),
+            },
+            'processor': {
+                'messages_per_second': round(processed / process_seconds, 1),
+                'end_to_end_ms': end_to_end,
+            },
+        }
+
+    def run_end_to_end(self, processor, clients):
+        """Vote-to-aggregate latency with the processor consuming while ratings arrive at a steady rate"""
+        count = max(self.requests // 4, 1)
+        self.stdout.write(f'Measuring end-to-end latency over {count} ratings at {self.e2e_rate}/s...')
+        self.broker.commit_latencies = []
+        stop = threading.Event()
+
+        def consume():
+            try:
+                while not stop.is_set():
+                    processor.poll_once()
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=consume, name='benchmark-processor')
+        thread.start()
+        try:
+            interval = 1 / self.e2e_rate
+            next_at = time.perf_counter()
+            for index in range(count):
+                time.sleep(max(0, next_at - time.perf_counter()))
+                next_at += interval
+                self.post_rating(clients[index % len(clients)])
+
+            deadline = time.monotonic() + 30
+            while len(self.broker.commit_latencies) < count and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            stop.set()
+            thread.join()
+        return percentiles(self.broker.commit_latencies)
+
+    def run_reads(self):
+        client = APIClient()
+        list_url = f"{reverse('content-list')}?sort_by=rating_average"
+
+        def get(url):
+            started = time.perf_counter()
+            response = client.get(url)
+            elapsed = (time.perf_counter() - started) * 1000
+            if response.status_code != 200:
+                raise RuntimeError(f'{url} failed with {response.status_code}')
+            return elapsed, response
+
+        # Bumping the cache versions makes a request miss the cache without flushing it
+        def cold_list():
+            content_cache.lists_changed()
+            return get(list_url)[0]
+
+        cursor_url = f'{list_url}&pagination=cursor'
+
+        def cold_cursor_page():
+            # Walks consecutive keyset pages, starting over after the last one
+            nonlocal cursor_url
+            content_cache.lists_changed()
+            elapsed, response = get(cursor_url)
+            cursor_url = response.json()['next'] or f'{list_url}&pagination=cursor'
+            return elapsed
+
+        def cold_detail():
+            content_id = self.random_content_id()
+            content_cache.contents_changed([content_id])
+            return get(reverse('content-detail', args=[content_id]))[0]
+
+        hot_detail_url = reverse('content-detail', args=[self.random_content_id()])
+
+        def measure(request):
+            return percentiles([request() for _ in range(self.read_requests)])
+
+        return {
+            'list': measure(cold_list),
+            'list_cursor': measure(cold_cursor_page),
+            'detail': measure(cold_detail),
+            'list_cached': measure(lambda: get(list_url)[0]),
+            'detail_cached': measure(lambda: get(hot_detail_url)[0]),
+        }
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the rating pipeline and the read endpoints against a stored baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='Content table sizes to measure the read endpoints at, e.g. 1000 ... 10000000')
+        parser.add_argument('--requests', type=int, default=2000, help='Number of rating POSTs')
+        parser.add_argument('--read-requests', type=int, default=200, help='Requests per read scenario and size')
+        parser.add_argument('--e2e-rate', type=int, default=200,
+                            help='Ratings per second sent while measuring end-to-end latency')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Processes populating the database')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', default='benchmark-results.json', help='Where to write the results')
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR, 'benchmarks', 'baseline.json'))
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Allowed regression against the baseline, as a fraction')
+        parser.add_argument('--min-delta-ms', type=float, default=2.0,
+                            help='Latency increases below this are never reported as regressions')
+        parser.add_argument('--update-baseline', action='store_true', help='Store the results as the new baseline')
+        parser.add_argument('--keepdb', action='store_true', help='Keep the benchmark database between runs')
+
+    def handle(self, *args, **options):
+        benchmark = PipelineBenchmark(
+            requests=options['requests'],
+            read_requests=options['read_requests'],
+            e2e_rate=options['e2e_rate'],
+            workers=options['workers'],
+            seed=options['seed'],
+            stdout=self.stdout,
+        )
+
+        # Runs against a throwaway test database, never the configured one
+        setup_test_environment(debug=False)
+        old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+        logger = logging.getLogger('contents')
+        level = logger.level
+        logger.setLevel(logging.WARNING)  # The processor logs every batch
+        try:
+            metrics = benchmark.run(options['sizes'])
+            with connection.cursor() as cursor:
+                cursor.execute('SHOW server_version')
+                postgres_version = cursor.fetchone()[0]
+        finally:
+            logger.setLevel(level)
+            teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+
+        results = {
+            'environment': {
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'postgres': postgres_version,
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+            },
+            'parameters': {
+                key: options[key] for key in ('sizes', 'requests', 'read_requests', 'e2e_rate', 'seed')
+            },
+            'metrics': metrics,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2)
+        self.stdout.write(json.dumps(metrics, indent=2))
+        self.stdout.write(f"Results written to {options['output']}")
+
+        if options['update_baseline']:
+            os.makedirs(os.path.dirname(options['baseline']) or '.', exist_ok=True)
+            with open(options['baseline'], 'w') as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Baseline updated: {options['baseline']}"))
+            return
+
+        if not os.path.exists(options['baseline']):
+            self.stdout.write(self.style.WARNING('No baseline to compare against, run with --update-baseline'))
+            return
+
+        with open(options['baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_to_baseline(
+            metrics, baseline['metrics'], options['tolerance'], options['min_delta_ms'],
+        )
+        for name, expected, value in regressions:
+            self.stdout.write(self.style.ERROR(f'{name}: {value} (baseline {expected})'))
+        if regressions:
+            raise CommandError(f'{len(regressions)} metrics regressed by more than {options["tolerance"]:.0%}')
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
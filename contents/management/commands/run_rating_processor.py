@@ -1,10 +1,94 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connections
 from contents.services.rating_processor import RatingProcessor
+from contents.metrics import start_metrics_server
+from prometheus_client import multiprocess
+import multiprocessing
+import os
+import signal
+import sys
+
+
+def run_worker(max_records, max_wait_ms, metrics_port=None):
+    # Exit through the normal path so the consumer leaves the group cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    processor = RatingProcessor(max_records=max_records, max_wait_ms=max_wait_ms)
+    processor.run()
+
 
 class Command(BaseCommand):
     help = 'Runs the rating processor service'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--max-records', type=int, help='Maximum number of ratings per batch')
+        parser.add_argument('--max-wait-ms', type=int, help='Maximum time to wait for a batch to fill up')
+        parser.add_argument('--workers', type=int, default=settings.RATING_PROCESSOR_WORKERS,
+                            help='Number of consumer processes, each owning a share of the partitions')
+        parser.add_argument('--metrics-port', type=int, default=settings.RATING_PROCESSOR_METRICS_PORT,
+                            help='Port of the Prometheus metrics endpoint, 0 to disable it')
+
     def handle(self, *args, **options):
-        self.stdout.write('Starting rating processor service...')
-        processor = RatingProcessor()
-        processor.run()
\ No newline at end of file
+        if settings.RATING_TRANSPORT == 'embedded':
+            raise CommandError('With RATING_TRANSPORT=embedded the ratings are processed inside the web workers')
+        workers = options['workers']
+        metrics_port = options['metrics_port']
+        shared_metrics = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+        if workers <= 1:
+            self.stdout.write('Starting rating processor service...')
+            if metrics_port:
+                start_metrics_server(metrics_port)
+            processor = RatingProcessor(
+                max_records=options['max_records'],
+                max_wait_ms=options['max_wait_ms'],
+            )
+            processor.run()
+            return
+
+        self.stdout.write(f'Starting rating processor service with {workers} workers...')
+        # Every worker opens its own database connection and joins the consumer group on its own
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [
+            context.Process(
+                target=run_worker,
+                args=(
+                    options['max_records'],
+                    options['max_wait_ms'],
+                    metrics_port + index if metrics_port and not shared_metrics else None,
+                ),
+                name=f'rating-processor-{index}',
+            )
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+
+        if metrics_port and shared_metrics:
+            # Started after forking so the workers do not inherit the socket; serves every worker's values
+            start_metrics_server(metrics_port)
+        elif metrics_port:
+            self.stdout.write(self.style.WARNING(
+                f'PROMETHEUS_MULTIPROC_DIR is not set, every worker serves its own metrics on ports '
+                f'{metrics_port} to {metrics_port + workers - 1}'
+            ))
+
+        def stop(signum, frame):
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            stop(signal.SIGINT, None)
+            for process in processes:
+                process.join()
+        if shared_metrics:
+            for process in processes:
+                multiprocess.mark_process_dead(process.pid)
@@ -0,0 +1,57 @@
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, multiprocess, start_http_server
+import os
+
+# Rating producer (web workers)
+RATING_MESSAGES_SENT = Counter(
+    'rating_messages_sent_total', 'Rating messages acknowledged by Kafka')
+RATING_MESSAGES_FAILED = Counter(
+    'rating_messages_failed_total', 'Rating messages whose delivery to Kafka failed')
+RATING_MESSAGES_SPOOLED = Counter(
+    'rating_messages_spooled_total', 'Rating messages kept in the local spool while Kafka was unavailable')
+RATING_MESSAGES_DROPPED = Counter(
+    'rating_messages_dropped_total', 'Rating messages dropped because the local spool was full')
+RATING_REQUESTS_RATE_LIMITED = Counter(
+    'rating_requests_rate_limited_total', 'Rating requests rejected for exceeding an hourly limit, by limited scope',
+    ['scope'])
+
+# Rating processor. The lag gauge is summed over the live processes in multiprocess mode
+# (PROMETHEUS_MULTIPROC_DIR), where every partition is owned by a single worker.
+RATING_PROCESSOR_MESSAGES = Counter(
+    'rating_processor_messages_total', 'Rating messages consumed by the processor')
+RATING_PROCESSOR_LAG = Gauge(
+    'rating_processor_consumer_lag', 'Rating messages waiting to be consumed, per partition',
+    ['partition'], multiprocess_mode='livesum')
+RATING_PROCESSOR_BATCH_SIZE = Histogram(
+    'rating_processor_batch_size', 'Rating messages per processed batch',
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000))
+RATING_PROCESSOR_STAGE_SECONDS = Histogram(
+    'rating_processor_stage_seconds', 'Time spent per batch in each processing stage',
+    ['stage'], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+RATING_PROCESSOR_PENALTIES = Counter(
+    'rating_processor_anomaly_penalties_total', 'Ratings whose weight was penalized as anomalous')
+RATING_PROCESSOR_RECONNECTS = Counter(
+    'rating_processor_reconnects_total', 'Times the processor reconnected after a consumer error')
+
+# Leaderboards (rating processor)
+LEADERBOARD_DRIFT = Counter(
+    'leaderboard_reconcile_drift_total', 'Contents found misplaced in a leaderboard by the periodic reconciliation',
+    ['board'])
+
+# Bound once, the processor observes every stage of every batch
+PROCESSOR_STAGES = {
+    stage: RATING_PROCESSOR_STAGE_SECONDS.labels(stage=stage)
+    for stage in ('load', 'anomaly_check', 'aggregate', 'db_write')
+}
+
+
+def start_metrics_server(port):
+    """
+    Serve the metrics of this process over HTTP. In multiprocess mode (PROMETHEUS_MULTIPROC_DIR
+    set before start-up) the values written by every process sharing the directory are served.
+    """
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    start_http_server(port, registry=registry)
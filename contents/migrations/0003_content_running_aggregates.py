@@ -0,0 +1,65 @@
+# Generated by Django 4.2.18 on 2026-10-17 08:01
+
+from django.db import migrations, models
+from django.db.models import Case, Count, F, FloatField, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+
+def backfill_running_aggregates(apps, schema_editor):
+    Content = apps.get_model('contents', 'Content')
+    Rating = apps.get_model('contents', 'Rating')
+
+    Rating.objects.filter(processed=True).update(applied_rating=F('rating'))
+
+    processed = Rating.objects.filter(content=OuterRef('pk'), processed=True).values('content')
+    Content.objects.update(
+        weighted_sum=Coalesce(
+            Subquery(processed.annotate(s=Sum(F('rating') * F('weight'))).values('s'), output_field=FloatField()),
+            Value(0.0),
+        ),
+        weight_sum=Coalesce(
+            Subquery(processed.annotate(s=Sum('weight')).values('s'), output_field=FloatField()),
+            Value(0.0),
+        ),
+        rating_count=Coalesce(
+            Subquery(processed.annotate(c=Count('id')).values('c'), output_field=IntegerField()),
+            Value(0),
+        ),
+    )
+    Content.objects.update(
+        average_rating=Case(
+            When(weight_sum__gt=0, then=F('weighted_sum') / F('weight_sum')),
+            default=Value(0.0),
+            output_field=FloatField(),
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contents', '0002_content_average_rating_content_rating_count_and_more'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='content',
+            name='rating_distribution',
+        ),
+        migrations.AddField(
+            model_name='content',
+            name='weight_sum',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='content',
+            name='weighted_sum',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='rating',
+            name='applied_rating',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_running_aggregates, migrations.RunPython.noop),
+    ]
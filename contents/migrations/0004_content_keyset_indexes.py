@@ -0,0 +1,33 @@
+# Generated by Django 4.2.18 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contents', '0003_content_running_aggregates'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='content',
+            name='contents_co_rating__8193a4_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='content',
+            name='contents_co_average_e560cb_idx',
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['rating_count', 'id'], name='content_count_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['average_rating', 'id'], name='content_average_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['created_at', 'id'], name='content_created_id_idx'),
+        ),
+    ]
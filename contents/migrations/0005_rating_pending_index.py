@@ -0,0 +1,19 @@
+# Generated by Django 4.2.18 on 2026-10-17 09:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contents', '0004_content_keyset_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rating',
+            index=models.Index(condition=models.Q(('processed', False)), fields=['content'], name='rating_pending_idx'),
+        ),
+    ]
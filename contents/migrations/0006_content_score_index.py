@@ -0,0 +1,18 @@
+# Generated by Django 4.2.18 on 2026-10-17 10:05
+
+import django.db.models.expressions
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contents', '0005_rating_pending_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(django.db.models.expressions.CombinedExpression(django.db.models.expressions.CombinedExpression(models.F('weighted_sum'), '+', models.Value(12.5)), '/', django.db.models.expressions.CombinedExpression(models.F('weight_sum'), '+', models.Value(5.0))), models.F('id'), name='content_score_id_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.18 on 2026-10-17 10:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contents', '0006_content_score_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('count_0', models.IntegerField(default=0)),
+                ('count_1', models.IntegerField(default=0)),
+                ('count_2', models.IntegerField(default=0)),
+                ('count_3', models.IntegerField(default=0)),
+                ('count_4', models.IntegerField(default=0)),
+                ('count_5', models.IntegerField(default=0)),
+                ('votes', models.IntegerField(default=0)),
+                ('weighted_sum', models.FloatField(default=0.0)),
+                ('weight_sum', models.FloatField(default=0.0)),
+                ('content', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='contents.content')),
+            ],
+            options={
+                'unique_together': {('content', 'hour')},
+            },
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 4.2.18 on 2026-10-17 11:00
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+# Title lexemes weigh more than text ones in the ranking, the configuration must match
+# contents.services.search.SEARCH_CONFIG
+SEARCH_VECTOR = """
+    setweight(to_tsvector('english', coalesce({row}title, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce({row}text, '')), 'B')
+"""
+
+CREATE_TRIGGER = f"""
+CREATE FUNCTION contents_content_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := {SEARCH_VECTOR.format(row='NEW.')};
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER contents_content_search_vector_update
+    BEFORE INSERT OR UPDATE OF title, text ON contents_content
+    FOR EACH ROW EXECUTE FUNCTION contents_content_search_vector_update();
+
+UPDATE contents_content SET search_vector = {SEARCH_VECTOR.format(row='')};
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER contents_content_search_vector_update ON contents_content;
+DROP FUNCTION contents_content_search_vector_update();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contents', '0007_rating_rollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='content',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+        migrations.AddIndex(
+            model_name='content',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='content_search_idx'),
+        ),
+    ]
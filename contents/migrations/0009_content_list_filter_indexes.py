@@ -0,0 +1,37 @@
+# Generated by Django 4.2.18 on 2026-10-17 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contents', '0008_content_search'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='content',
+            name='content_count_id_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='content',
+            name='content_average_id_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='content',
+            name='content_created_id_idx',
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['rating_count', 'id'], include=('average_rating', 'created_at'), name='content_count_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['average_rating', 'id'], include=('rating_count', 'created_at'), name='content_average_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['created_at', 'id'], include=('average_rating', 'rating_count'), name='content_created_id_idx'),
+        ),
+    ]
@@ -1,10 +1,23 @@
-from django.db import models
+from django.db import models, connections, router
+from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.contrib.auth import get_user_model
 from django.conf import settings
-from django.db.models import Avg, Count
+from django.db.models import Avg, Count, F
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 import json
 
+# Score ranking the leaderboard: the weighted average pulled towards the middle of the scale
+# until a content has gathered enough rating weight, so a single 5 does not top the board
+SCORE_PRIOR_MEAN = 2.5
+SCORE_PRIOR_WEIGHT = 5.0
+
+
+def score_expression():
+    return (F('weighted_sum') + SCORE_PRIOR_MEAN * SCORE_PRIOR_WEIGHT) / (F('weight_sum') + SCORE_PRIOR_WEIGHT)
+
+
 class Content(models.Model):
     title = models.CharField(max_length=200)
     text = models.TextField()
@@ -13,12 +26,70 @@ class Content(models.Model):
     rating_count = models.IntegerField(default=0)
     average_rating = models.FloatField(default=0.0)
     
+    # Running aggregates maintained incrementally by the rating processor
+    weighted_sum = models.FloatField(default=0.0)
+    weight_sum = models.FloatField(default=0.0)
+    
+    # Weighted title and text lexemes, written by a database trigger on every insert and on
+    # updates of title or text (see migration 0008), so COPY loads are covered too
+    search_vector = SearchVectorField(null=True, editable=False)
+    
     class Meta:
+        # (sort field, id) indexes back every sort mode of the content list, including
+        # the keyset pagination that seeks on both columns. Each one also carries the other
+        # filterable columns of the list, so counts of any filter combination are index-only
         indexes = [
-            models.Index(fields=['rating_count']),
-            models.Index(fields=['average_rating']),
+            models.Index(fields=['rating_count', 'id'], include=['average_rating', 'created_at'],
+                         name='content_count_id_idx'),
+            models.Index(fields=['average_rating', 'id'], include=['rating_count', 'created_at'],
+                         name='content_average_id_idx'),
+            models.Index(fields=['created_at', 'id'], include=['average_rating', 'rating_count'],
+                         name='content_created_id_idx'),
+            # Rebuilds of the score leaderboard, the query must use the same expression
+            models.Index(score_expression(), F('id'), name='content_score_id_idx'),
+            GinIndex(fields=['search_vector'], name='content_search_idx'),
         ]
 
+    @property
+    def score(self):
+        """score_expression() computed in Python, with the same float operations"""
+        return (self.weighted_sum + SCORE_PRIOR_MEAN * SCORE_PRIOR_WEIGHT) / (self.weight_sum + SCORE_PRIOR_WEIGHT)
+
+class RatingManager(models.Manager):
+    def upsert(self, content_id, user_id, rating):
+        """
+        Create or update the rating of a user for a content in a single statement.
+        Returns (rating_id, created), or None if the content does not exist.
+        """
+        return self.bulk_upsert(user_id, {content_id: rating}).get(content_id)
+
+    def bulk_upsert(self, user_id, ratings):
+        """
+        Create or update the ratings of a user, given as {content_id: rating}, in a single
+        set-based statement. The contents are resolved in the same statement, so nothing is
+        written for contents that do not exist.
+        Returns {content_id: (rating_id, created)} for every rating that was written.
+        """
+        if not ratings:
+            return {}
+        now = timezone.now()
+        with connections[router.db_for_write(self.model)].cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {self.model._meta.db_table}
+                    (content_id, user_id, rating, weight, created_at, updated_at, processed)
+                SELECT content.id, %s, item.rating, 1.0, %s, %s, false
+                FROM unnest(%s::bigint[], %s::integer[]) AS item(content_id, rating)
+                JOIN {Content._meta.db_table} content ON content.id = item.content_id
+                ON CONFLICT (content_id, user_id) DO UPDATE
+                SET rating = EXCLUDED.rating, updated_at = EXCLUDED.updated_at, processed = false
+                RETURNING content_id, id, xmax = 0
+                """,
+                [user_id, now, now, list(ratings.keys()), list(ratings.values())],
+            )
+            return {content_id: (rating_id, created) for content_id, rating_id, created in cursor.fetchall()}
+
+
 class Rating(models.Model):
     content = models.ForeignKey(Content, related_name='ratings', on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -32,6 +103,69 @@ class Rating(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     processed = models.BooleanField(default=False)
+    # Rating value currently reflected in the content aggregates (None until first processed)
+    applied_rating = models.IntegerField(null=True, blank=True)
     
+    objects = RatingManager()
+    
+    class Meta:
+        unique_together = ['content', 'user']
+        indexes = [
+            # Only covers the few ratings waiting for the processor
+            models.Index(fields=['content'], condition=models.Q(processed=False), name='rating_pending_idx'),
+        ]
+
+class RatingRollupManager(models.Manager):
+    def add(self, deltas):
+        """
+        Add deltas, given as {(content_id, hour): [count_0, ..., count_5, votes, weighted_sum,
+        weight_sum]}, to the rollup rows in a single set-based upsert.
+        """
+        if not deltas:
+            return
+        columns = list(zip(*(values for values in deltas.values())))
+        content_ids, hours = zip(*deltas.keys())
+        counts = ', '.join(f'count_{star}' for star in RatingRollup.STARS)
+        sums = ', '.join(f'{field} = rollup.{field} + EXCLUDED.{field}' for field in RatingRollup.SUM_FIELDS)
+        with connections[router.db_for_write(self.model)].cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {self.model._meta.db_table} AS rollup
+                    (content_id, hour, {counts}, votes, weighted_sum, weight_sum)
+                SELECT * FROM unnest(
+                    %s::bigint[], %s::timestamptz[], {', '.join(['%s::integer[]'] * 7)}, %s::float8[], %s::float8[]
+                )
+                ON CONFLICT (content_id, hour) DO UPDATE SET {sums}
+                """,
+                [list(content_ids), list(hours), *(list(column) for column in columns)],
+            )
+
+
+class RatingRollup(models.Model):
+    """
+    Net change of the applied ratings of a content during an hour, maintained by the rating
+    processor in the transaction that updates the content aggregates. Re-rates move a vote
+    from its previous star to the new one within the hour of the re-rate, so the rows of a
+    content sum up to its current histogram and aggregates; `votes` counts the ratings cast
+    (new or changed) in the hour.
+    """
+    STARS = range(6)
+    SUM_FIELDS = (*(f'count_{star}' for star in STARS), 'votes', 'weighted_sum', 'weight_sum')
+
+    content = models.ForeignKey(Content, related_name='rollups', on_delete=models.CASCADE)
+    hour = models.DateTimeField()
+    count_0 = models.IntegerField(default=0)
+    count_1 = models.IntegerField(default=0)
+    count_2 = models.IntegerField(default=0)
+    count_3 = models.IntegerField(default=0)
+    count_4 = models.IntegerField(default=0)
+    count_5 = models.IntegerField(default=0)
+    votes = models.IntegerField(default=0)
+    weighted_sum = models.FloatField(default=0.0)
+    weight_sum = models.FloatField(default=0.0)
+
+    objects = RatingRollupManager()
+
     class Meta:
-        unique_together = ['content', 'user']
\ No newline at end of file
+        # Also the index of the per-content time series
+        unique_together = ['content', 'hour']
@@ -1,7 +1,153 @@
-from rest_framework.pagination import PageNumberPagination
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+import datetime
+import json
 
 
 class ContentsPagination(PageNumberPagination):
     page_size = 20
     page_size_query_param = 'page_size'
-    max_page_size = 100
\ No newline at end of file
+    max_page_size = 100
+
+
+class ContentsCursorPagination(BasePagination):
+    """
+    Keyset pagination over a queryset ordered by (sort_field, id), both in the same direction.
+    Each page seeks past the last row of the previous one with a row comparison that the
+    matching (sort_field, id) index can serve, so deep pages cost the same as the first one
+    and no total count is needed. Works on model instances as well as on .values() rows.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.field, self.descending = self.get_ordering(queryset)
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor['reverse']
+        descending = self.descending != reverse
+
+        if cursor is not None:
+            queryset = self.seek(queryset, cursor, descending)
+        prefix = '-' if descending else ''
+        queryset = queryset.order_by(f'{prefix}{self.field}', f'{prefix}id')
+
+        page = list(queryset[:self.page_size + 1])
+        has_more = len(page) > self.page_size
+        page = page[:self.page_size]
+        if reverse:
+            page.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+
+        self.page = page
+        return page
+
+    def seek(self, queryset, cursor, descending):
+        column = queryset.model._meta.get_field(self.field).column
+        operator = '<' if descending else '>'
+        return queryset.filter(RawSQL(
+            f'("{column}", "id") {operator} (%s, %s)',
+            (cursor['value'], cursor['id']),
+            output_field=BooleanField(),
+        ))
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_ordering(self, queryset):
+        order_by = queryset.query.order_by[0]
+        return order_by.lstrip('-'), order_by.startswith('-')
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            cursor = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            value = cursor['v']
+            if self.field == 'created_at':
+                value = parse_datetime(value)
+                if value is None:
+                    raise ValueError
+            elif isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError
+            return {'value': value, 'id': int(cursor['i']), 'reverse': bool(cursor.get('r'))}
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, row, reverse):
+        if isinstance(row, dict):
+            value, row_id = row[self.field], row['id']
+        else:
+            value, row_id = getattr(row, self.field), row.id
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        cursor = {'v': value, 'i': row_id}
+        if reverse:
+            cursor['r'] = 1
+        encoded = urlsafe_b64encode(json.dumps(cursor, separators=(',', ':')).encode('ascii')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ContentSearchPagination(ContentsCursorPagination):
+    """
+    Keyset pagination of search results ordered by (rank, id). The rank is computed per
+    query, so the seek compares it in plain SQL: pages cost the same at any depth without
+    an index on it.
+    """
+
+    def seek(self, queryset, cursor, descending):
+        lookup = 'lt' if descending else 'gt'
+        return queryset.filter(
+            Q(**{f'{self.field}__{lookup}': cursor['value']})
+            | Q(**{self.field: cursor['value'], f'id__{lookup}': cursor['id']})
+        )
@@ -0,0 +1,53 @@
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the standard renderer
+    orjson = None
+
+
+def formats_like_json(data):
+    """
+    Whether orjson writes every float of `data` as json.dumps does: both give the shortest
+    round-tripping digits, but orjson never uses the exponent notation of repr() below 1e-4
+    and writes 1e16 rather than 1e+16 from there on, and it turns NaN and infinities into
+    null where JSONRenderer refuses them.
+    """
+    pending = [[data]]
+    while pending:
+        value = pending.pop()
+        for item in (value.values() if isinstance(value, dict) else value):
+            if isinstance(item, float):
+                if not (1e-4 <= abs(item) < 1e16 or item == 0):  # NaN fails every comparison
+                    return False
+            elif isinstance(item, (dict, list, tuple)):
+                pending.append(item)
+    return True
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Drop-in JSONRenderer that encodes with orjson when it is installed.
+    The output is byte-identical to JSONRenderer for compact, non-ASCII-escaped responses;
+    anything else (indented output, ensure_ascii, floats orjson formats differently) is left
+    to the standard renderer.
+    """
+    if orjson is not None:
+        # Datetimes and dataclasses go through the DRF encoder so they are formatted the same way.
+        # Non-str keys are refused rather than converted, json.dumps formats them differently
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if (orjson is None or self.ensure_ascii or not self.compact
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+                or not formats_like_json(data)):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Same escaping of \u2028 and \u2029 as JSONRenderer
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
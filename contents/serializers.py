@@ -1,4 +1,5 @@
 from rest_framework import serializers
+from django.utils import timezone
 from .models import Content, Rating
 
 class ContentSerializer(serializers.ModelSerializer):
@@ -9,3 +10,30 @@ class ContentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Content
         fields = ['id', 'title', 'user_rating', 'average_rating', 'rating_count', 'created_at']
+
+
+# Model fields read by the lean list path, in the order of ContentSerializer.Meta.fields
+CONTENT_LIST_VALUES = ('id', 'title', 'average_rating', 'rating_count', 'created_at')
+
+
+def serialize_content_rows(rows):
+    """
+    Lean equivalent of ContentSerializer(many=True).data for rows fetched with
+    .values(*CONTENT_LIST_VALUES), producing the same dicts without field-by-field serialization.
+    """
+    current_timezone = timezone.get_current_timezone()
+    items = []
+    for row in rows:
+        # Same ISO 8601 formatting as serializers.DateTimeField
+        created_at = row['created_at'].astimezone(current_timezone).isoformat()
+        if created_at.endswith('+00:00'):
+            created_at = created_at[:-6] + 'Z'
+        items.append({
+            'id': row['id'],
+            'title': str(row['title']),
+            'user_rating': None,
+            'average_rating': float(row['average_rating']),
+            'rating_count': int(row['rating_count']),
+            'created_at': created_at,
+        })
+    return items
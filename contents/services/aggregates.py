@@ -0,0 +1,154 @@
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Count, F, FloatField, Sum
+from ..models import Rating, Content
+from .anomaly import RATING_VALUES
+
+AGGREGATE_FIELDS = ('rating_count', 'weighted_sum', 'weight_sum', 'average_rating')
+
+
+def average_of(weighted_sum, weight_sum):
+    return weighted_sum / weight_sum if weight_sum > 0 else 0
+
+
+def recompute_aggregates(content_ids):
+    """Recompute the aggregates of the given contents from their applied ratings"""
+    rows = (
+        Rating.objects
+        .filter(content_id__in=content_ids, applied_rating__isnull=False)
+        .values('content_id')
+        .annotate(
+            rating_count=Count('id'),
+            weighted_sum=Sum(F('applied_rating') * F('weight'), output_field=FloatField()),
+            weight_sum=Sum('weight'),
+        )
+    )
+
+    aggregates = {
+        content_id: {'rating_count': 0, 'weighted_sum': 0.0, 'weight_sum': 0.0, 'average_rating': 0}
+        for content_id in content_ids
+    }
+    for row in rows:
+        aggregates[row['content_id']] = {
+            'rating_count': row['rating_count'],
+            'weighted_sum': row['weighted_sum'],
+            'weight_sum': row['weight_sum'],
+            'average_rating': average_of(row['weighted_sum'], row['weight_sum']),
+        }
+    return aggregates
+
+
+def find_aggregate_drift(contents, tolerance=1e-6):
+    """
+    Compare the incrementally maintained aggregates of `contents` against a full recompute.
+    Returns a list of (content, field, stored, expected) for every field that drifted.
+    """
+    contents = list(contents)
+    expected = recompute_aggregates([content.id for content in contents])
+
+    drift = []
+    for content in contents:
+        for field in AGGREGATE_FIELDS:
+            stored = getattr(content, field)
+            value = expected[content.id][field]
+            if abs(stored - value) > tolerance:
+                drift.append((content, field, stored, value))
+    return drift
+
+
+def refresh_aggregates(min_id, max_id, tolerance=1e-6):
+    """
+    Overwrite the aggregates of the contents with min_id <= id < max_id from their applied
+    ratings, with one GROUP BY and one UPDATE ... FROM. Only contents that drifted by more
+    than `tolerance` are written, so a consistent range costs no row versions. Returns
+    (content id, stored count, new count, stored average, new average) per updated content.
+    """
+    content_table = Content._meta.db_table
+    rating_table = Rating._meta.db_table
+    with connections[router.db_for_write(Content)].cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE {content_table} content
+            SET rating_count = fresh.rating_count,
+                weighted_sum = fresh.weighted_sum,
+                weight_sum = fresh.weight_sum,
+                average_rating = fresh.average_rating
+            FROM (
+                SELECT target.id,
+                       target.rating_count AS stored_count,
+                       target.average_rating AS stored_average,
+                       COALESCE(totals.rating_count, 0) AS rating_count,
+                       COALESCE(totals.weighted_sum, 0) AS weighted_sum,
+                       COALESCE(totals.weight_sum, 0) AS weight_sum,
+                       CASE WHEN totals.weight_sum > 0
+                            THEN totals.weighted_sum / totals.weight_sum ELSE 0 END AS average_rating
+                FROM {content_table} target
+                LEFT JOIN (
+                    SELECT content_id,
+                           COUNT(*) AS rating_count,
+                           SUM(applied_rating * weight) AS weighted_sum,
+                           SUM(weight) AS weight_sum
+                    FROM {rating_table}
+                    WHERE applied_rating IS NOT NULL AND content_id >= %(min_id)s AND content_id < %(max_id)s
+                    GROUP BY content_id
+                ) totals ON totals.content_id = target.id
+                WHERE target.id >= %(min_id)s AND target.id < %(max_id)s
+            ) fresh
+            WHERE content.id = fresh.id
+              AND (content.rating_count <> fresh.rating_count
+                   OR abs(content.weighted_sum - fresh.weighted_sum) > %(tolerance)s
+                   OR abs(content.weight_sum - fresh.weight_sum) > %(tolerance)s
+                   OR abs(content.average_rating - fresh.average_rating) > %(tolerance)s)
+            RETURNING content.id, fresh.stored_count, content.rating_count,
+                      fresh.stored_average, content.average_rating
+            """,
+            {'min_id': min_id, 'max_id': max_id, 'tolerance': tolerance},
+        )
+        return cursor.fetchall()
+
+
+def rescore_anomalies(min_id, max_id):
+    """
+    Recompute the anomaly weights of the applied ratings of the contents with
+    min_id <= id < max_id with the current ANOMALY_* settings, in one UPDATE. Each rating
+    is judged against the ratings of its content created in the ANOMALY_WINDOW_MINUTES up
+    to it, as the processor would have when it arrived; the processor counts per minute
+    and only sees the current value of re-rated ratings, so the two can disagree for
+    ratings near the edge of a window. Returns the number of ratings whose weight changed.
+    """
+    rating_table = Rating._meta.db_table
+    # Counting every value over a single window keeps it to one sort of the ratings
+    value_counts = ' '.join(
+        f'WHEN {value} THEN COUNT(*) FILTER (WHERE applied_rating = {value}) OVER recent'
+        for value in range(RATING_VALUES)
+    )
+    with connections[router.db_for_write(Rating)].cursor() as cursor:
+        cursor.execute(
+            f"""
+            UPDATE {rating_table} rating
+            SET weight = scored.weight
+            FROM (
+                SELECT id,
+                       weight AS stored_weight,
+                       CASE WHEN COUNT(*) OVER recent >= %(min_count)s
+                                 AND (CASE applied_rating {value_counts} END)::float
+                                     / COUNT(*) OVER recent > %(threshold)s
+                            THEN %(penalty)s ELSE 1.0 END AS weight
+                FROM {rating_table}
+                WHERE applied_rating IS NOT NULL AND content_id >= %(min_id)s AND content_id < %(max_id)s
+                WINDOW recent AS (PARTITION BY content_id ORDER BY created_at
+                                  RANGE BETWEEN make_interval(mins => %(window)s) PRECEDING AND CURRENT ROW)
+            ) scored
+            WHERE rating.id = scored.id AND scored.weight <> scored.stored_weight
+              AND rating.content_id >= %(min_id)s AND rating.content_id < %(max_id)s
+            """,
+            {
+                'min_id': min_id,
+                'max_id': max_id,
+                'window': settings.ANOMALY_WINDOW_MINUTES,
+                'min_count': settings.MIN_RATE_COUNT,
+                'threshold': settings.ANOMALY_THRESHOLD,
+                'penalty': settings.ANOMALY_WEIGHT_PENALTY,
+            },
+        )
+        return cursor.rowcount
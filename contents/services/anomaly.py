@@ -0,0 +1,130 @@
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from ..models import Rating
+
+RATING_VALUES = 6  # Ratings are integers between 0 and 5
+
+
+def to_minute(moment):
+    return int(moment.timestamp() // 60)
+
+
+class RatingWindow:
+    """
+    Ring buffer of per-minute rating counts for one content.
+    Each slot holds the counts of every rating value for one minute, and running totals
+    over the whole window are kept so that a lookup never has to scan the buckets.
+    """
+    __slots__ = ('size', 'head', 'buckets', 'totals', 'total')
+
+    def __init__(self, size):
+        self.size = size
+        self.head = None  # Latest minute the window has been advanced to
+        self.buckets = [0] * (size * RATING_VALUES)
+        self.totals = [0] * RATING_VALUES
+        self.total = 0
+
+    def advance(self, minute):
+        """Move the window forward to `minute`, expiring the buckets that fall out of it"""
+        if self.head is not None and minute <= self.head:
+            return
+        start = minute - self.size + 1
+        if self.head is not None:
+            start = max(start, self.head + 1)
+        for expired in range(start, minute + 1):
+            offset = (expired % self.size) * RATING_VALUES
+            for value in range(RATING_VALUES):
+                count = self.buckets[offset + value]
+                if count:
+                    self.totals[value] -= count
+                    self.total -= count
+                    self.buckets[offset + value] = 0
+        self.head = minute
+
+    def add(self, minute, value, count=1):
+        self.advance(minute)
+        if minute <= self.head - self.size:
+            return  # Older than the window
+        self.buckets[(minute % self.size) * RATING_VALUES + value] += count
+        self.totals[value] += count
+        self.total += count
+
+
+class AnomalyDetector:
+    """
+    Sliding-window rating spike detector kept in memory by the rating processor.
+    Windows are rebuilt lazily from the database for contents that have not been seen yet
+    and evicted in LRU order, or once they went stale, to bound memory.
+    """
+
+    def __init__(self, window_minutes=None, max_contents=None):
+        self.window_minutes = window_minutes or settings.ANOMALY_WINDOW_MINUTES
+        self.max_contents = max_contents or settings.ANOMALY_WINDOW_MAX_CONTENTS
+        self.windows = OrderedDict()
+
+    def observe(self, ratings_by_content, now):
+        """
+        Record a batch of unprocessed ratings in the windows of their contents.
+        Re-rated ratings are moved from their previously applied value to the new one.
+        """
+        now_minute = to_minute(now)
+        self.load([content_id for content_id in ratings_by_content if content_id not in self.windows], now)
+
+        for content_id, ratings in ratings_by_content.items():
+            window = self.windows[content_id]
+            self.windows.move_to_end(content_id)
+            window.advance(now_minute)
+            for rating in ratings:
+                minute = to_minute(rating.created_at)
+                if rating.applied_rating is not None:
+                    window.add(minute, rating.applied_rating, -1)
+                window.add(minute, rating.rating)
+
+    def load(self, content_ids, now):
+        """Rebuild the windows of the given contents from their already applied ratings"""
+        if not content_ids:
+            return
+        windows = {content_id: RatingWindow(self.window_minutes) for content_id in content_ids}
+        for window in windows.values():
+            window.advance(to_minute(now))
+
+        rows = (
+            Rating.objects
+            .filter(
+                content_id__in=content_ids,
+                applied_rating__isnull=False,
+                created_at__gte=now - timedelta(minutes=self.window_minutes),
+            )
+            .values_list('content_id', 'created_at', 'applied_rating')
+        )
+        for content_id, created_at, value in rows:
+            windows[content_id].add(to_minute(created_at), value)
+        self.windows.update(windows)
+
+    def evict(self, now):
+        """Drop least recently used windows above the cap and windows without recent ratings"""
+        now_minute = to_minute(now)
+        while self.windows:
+            content_id, window = next(iter(self.windows.items()))
+            if len(self.windows) <= self.max_contents and window.head > now_minute - self.window_minutes:
+                break
+            del self.windows[content_id]
+
+    def forget(self, content_ids):
+        """Discard windows whose observed ratings were never committed"""
+        for content_id in content_ids:
+            self.windows.pop(content_id, None)
+
+    def clear(self):
+        self.windows.clear()
+
+    def is_anomalous(self, content_id, rating_value, now):
+        """Check if there's an unusual spike in specific rating value"""
+        if content_id not in self.windows:
+            self.load([content_id], now)
+        window = self.windows[content_id]
+        window.advance(to_minute(now))
+        if window.total < settings.MIN_RATE_COUNT:  # Not enough data to detect anomaly
+            return False
+        return (window.totals[rating_value] / window.total) > settings.ANOMALY_THRESHOLD
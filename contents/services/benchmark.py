@@ -0,0 +1,160 @@
+import asyncio
+import os
+import random
+import statistics
+import time
+
+# Only these are gated against the baseline, tail percentiles of a few hundred samples are too noisy
+COMPARED_METRICS = ('per_second', 'p50')
+
+
+def percentiles(samples):
+    """Summarize latency samples given in milliseconds"""
+    if not samples:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'mean': 0.0}
+    if len(samples) == 1:
+        cuts = samples * 99
+    else:
+        cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return {
+        'p50': round(cuts[49], 3),
+        'p95': round(cuts[94], 3),
+        'p99': round(cuts[98], 3),
+        'mean': round(statistics.fmean(samples), 3),
+    }
+
+
+def flatten(metrics, prefix=''):
+    """Turn nested metrics into {'reads.1000.list.p95': value}"""
+    flat = {}
+    for key, value in metrics.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{name}.'))
+        else:
+            flat[name] = value
+    return flat
+
+
+def compare_to_baseline(metrics, baseline, tolerance, min_delta_ms=0):
+    """
+    Return the metrics that regressed by more than `tolerance` (a fraction) against the
+    baseline, as (name, baseline value, current value) tuples. Throughputs (`*_per_second`)
+    must not drop, latencies must not grow, by more than `min_delta_ms` as well so that
+    jitter on sub-millisecond timings is not reported; metrics missing on either side are ignored.
+    """
+    current, previous = flatten(metrics), flatten(baseline)
+    regressions = []
+    for name, value in current.items():
+        if name not in previous or not name.endswith(COMPARED_METRICS):
+            continue
+        expected = previous[name]
+        if name.endswith('per_second'):
+            regressed = value < expected * (1 - tolerance)
+        else:
+            regressed = value > expected * (1 + tolerance) and value - expected > min_delta_ms
+        if regressed:
+            regressions.append((name, expected, value))
+    return regressions
+
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of a process and all of its descendants, read from /proc"""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                # The command name can contain spaces, the fields after it cannot
+                parents[int(entry)] = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    tree, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        tree.append(current)
+        pending.extend(child for child, parent in parents.items() if parent == current)
+    rss = 0
+    for member in tree:
+        try:
+            with open(f'/proc/{member}/statm') as statm:
+                rss += int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            continue
+    return rss
+
+
+class HttpLoad:
+    """
+    Closed-loop HTTP/1.1 load: `concurrency` connections each send a request, wait for its
+    response and send the next one for `duration` seconds, so exactly `concurrency` requests
+    are in flight at any time. Requests come from `make_request(rng)`, which returns
+    (method, path, headers, body). Connections are kept alive unless the server closes them
+    (gunicorn's sync workers do after every response).
+    """
+
+    def __init__(self, host, port, make_request, concurrency, duration, timeout=10, seed=42):
+        self.host = host
+        self.port = port
+        self.make_request = make_request
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+        self.seed = seed
+
+    def run(self):
+        return asyncio.run(self._run())
+
+    async def _run(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.deadline = time.monotonic() + self.duration
+        started = time.perf_counter()
+        await asyncio.gather(*(self._client(random.Random(self.seed + index)) for index in range(self.concurrency)))
+        elapsed = time.perf_counter() - started
+        return {
+            'requests_per_second': round(len(self.latencies) / elapsed, 1),
+            'latency_ms': percentiles(self.latencies),
+            'statuses': {str(code): count for code, count in sorted(self.statuses.items())},
+            'errors': self.errors,
+        }
+
+    async def _client(self, rng):
+        reader = writer = None
+        while time.monotonic() < self.deadline:
+            method, path, headers, body = self.make_request(rng)
+            started = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+                code, keep_alive = await asyncio.wait_for(
+                    self._exchange(reader, writer, method, path, headers, body), self.timeout,
+                )
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+                self.errors += 1
+                keep_alive = False
+            else:
+                self.latencies.append((time.perf_counter() - started) * 1000)
+                self.statuses[code] = self.statuses.get(code, 0) + 1
+            if not keep_alive and writer is not None:
+                writer.close()
+                reader = writer = None
+        if writer is not None:
+            writer.close()
+
+    async def _exchange(self, reader, writer, method, path, headers, body):
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}', 'Connection: keep-alive',
+                 f'Content-Length: {len(body)}']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+        head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        code = int(head[0].split()[1])
+        response_headers = dict(
+            (name.strip().lower(), value.strip()) for name, value in (line.split(':', 1) for line in head[1:] if line)
+        )
+        await reader.readexactly(int(response_headers.get('content-length', 0)))
+        return code, response_headers.get('connection', '').lower() != 'close'
@@ -0,0 +1,200 @@
+from django.conf import settings
+from django.core.cache import caches
+from content_rating.routers import replicas
+from hashlib import sha1
+import asyncio
+import time
+
+MISSING = object()
+
+
+class ContentCache:
+    """
+    Versioned cache of serialized content responses.
+
+    Every content has a version and the list has a global generation; both are part of the
+    cache keys, so bumping them (which the rating processor does after committing new
+    aggregates) makes stale entries unreachable without having to find and delete them.
+    Misses are computed by a single caller at a time, the others wait for its result.
+    The same counters give the ETags of the responses, so conditional requests can be
+    answered without querying the database.
+
+    The a-prefixed methods are the same for async views, with an async `load`.
+
+    Works with any Django cache backend. With the local-memory backend every process has
+    its own cache, so invalidations from the processor only reach the web workers through
+    CONTENT_CACHE_TIMEOUT; configure REDIS_URL for a cache shared by all processes.
+    """
+    generation_key = 'contents:generation'
+
+    @property
+    def cache(self):
+        return caches[settings.CONTENT_CACHE_ALIAS]
+
+    def version_key(self, content_id):
+        return f'content:{content_id}:version'
+
+    def detail_version(self, content_id):
+        return self._get_counter(self.version_key(content_id))
+
+    def list_generation(self):
+        return self._get_counter(self.generation_key)
+
+    async def adetail_version(self, content_id):
+        return await self._aget_counter(self.version_key(content_id))
+
+    async def alist_generation(self):
+        return await self._aget_counter(self.generation_key)
+
+    def params_digest(self, params):
+        return sha1(repr(sorted(params)).encode('utf-8')).hexdigest()
+
+    def ratings_key(self, user_id):
+        return f'user:{user_id}:ratings:generation'
+
+    def ratings_generation(self, user_id):
+        """Generation of the ratings of a user, bumped by the views writing them"""
+        return self._get_counter(self.ratings_key(user_id))
+
+    async def aratings_generation(self, user_id):
+        return await self._aget_counter(self.ratings_key(user_id))
+
+    def user_ratings_changed(self, user_id):
+        self._bump_counter(self.ratings_key(user_id))
+
+    async def auser_ratings_changed(self, user_id):
+        await self._abump_counter(self.ratings_key(user_id))
+
+    def detail_etag(self, content_id, version, user_id=None, ratings_generation=None):
+        # Responses to authenticated users include their own ratings, so they get their own
+        # ETags, which change with the ratings of the user as well
+        suffix = f'-u{user_id}.{ratings_generation}' if user_id is not None else ''
+        return f'"c{content_id}-{version}{suffix}"'
+
+    def list_etag(self, params, generation, user_id=None, ratings_generation=None):
+        suffix = f'-u{user_id}.{ratings_generation}' if user_id is not None else ''
+        return f'"l{generation}-{self.params_digest(params)[:16]}{suffix}"'
+
+    def get_detail(self, content_id, load, version=None):
+        """Return the serialized content, calling `load` on a miss; None is never cached"""
+        if version is None:
+            version = self.detail_version(content_id)
+        return self._get_or_load(f'content:{content_id}:v{version}', load)
+
+    def get_list_page(self, params, load, generation=None):
+        """Return a serialized list page for the given request parameters"""
+        if generation is None:
+            generation = self.list_generation()
+        return self._get_or_load(f'contents:list:g{generation}:{self.params_digest(params)}', load)
+
+    def get_stats(self, content_id, hours, hour, load):
+        """Return the serialized stats of a content over the `hours` hours ending with `hour`"""
+        version = self.detail_version(content_id)
+        return self._get_or_load(f'content:{content_id}:v{version}:stats:{hours}:{hour:%Y%m%d%H}', load)
+
+    async def aget_detail(self, content_id, load, version=None):
+        if version is None:
+            version = await self.adetail_version(content_id)
+        return await self._aget_or_load(f'content:{content_id}:v{version}', load)
+
+    async def aget_list_page(self, params, load, generation=None):
+        if generation is None:
+            generation = await self.alist_generation()
+        return await self._aget_or_load(f'contents:list:g{generation}:{self.params_digest(params)}', load)
+
+    def contents_changed(self, content_ids):
+        """Invalidate the details of the given contents and every list page"""
+        # Refills must not read the old values back from a lagging replica
+        replicas.pin(*[f'content:{content_id}' for content_id in content_ids])
+        for content_id in content_ids:
+            self._bump_counter(self.version_key(content_id))
+        self.lists_changed()
+
+    def lists_changed(self):
+        replicas.pin('contents:list')
+        self._bump_counter(self.generation_key)
+
+    def _get_counter(self, key):
+        value = self.cache.get(key)
+        if value is None:
+            # Start from the clock rather than zero, entries cached under a lost counter
+            # must not become reachable again. Counters expire like the entries: bumps made
+            # by other processes never reach a local-memory cache, and the ETags must not
+            # outlive CONTENT_CACHE_TIMEOUT either
+            self.cache.add(key, time.time_ns(), timeout=settings.CONTENT_CACHE_TIMEOUT)
+            value = self.cache.get(key)
+        return value
+
+    def _bump_counter(self, key):
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            self.cache.set(key, time.time_ns(), timeout=settings.CONTENT_CACHE_TIMEOUT)
+
+    def _get_or_load(self, key, load):
+        value = self.cache.get(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        lock_key = f'{key}:lock'
+        if not self.cache.add(lock_key, 1, timeout=settings.CONTENT_CACHE_LOCK_TIMEOUT):
+            # Another caller is computing the value, wait for it rather than stampeding the database
+            deadline = time.monotonic() + settings.CONTENT_CACHE_LOCK_TIMEOUT
+            while time.monotonic() < deadline:
+                time.sleep(0.01)
+                value = self.cache.get(key, MISSING)
+                if value is not MISSING:
+                    return value
+                if self.cache.get(lock_key) is None:
+                    break  # Released without caching anything
+            return load()
+
+        try:
+            value = load()
+            if value is not None:
+                self.cache.set(key, value, timeout=settings.CONTENT_CACHE_TIMEOUT)
+            return value
+        finally:
+            self.cache.delete(lock_key)
+
+
+    async def _abump_counter(self, key):
+        try:
+            await self.cache.aincr(key)
+        except ValueError:
+            await self.cache.aset(key, time.time_ns(), timeout=settings.CONTENT_CACHE_TIMEOUT)
+
+    async def _aget_counter(self, key):
+        value = await self.cache.aget(key)
+        if value is None:
+            await self.cache.aadd(key, time.time_ns(), timeout=settings.CONTENT_CACHE_TIMEOUT)
+            value = await self.cache.aget(key)
+        return value
+
+    async def _aget_or_load(self, key, load):
+        value = await self.cache.aget(key, MISSING)
+        if value is not MISSING:
+            return value
+
+        lock_key = f'{key}:lock'
+        if not await self.cache.aadd(lock_key, 1, timeout=settings.CONTENT_CACHE_LOCK_TIMEOUT):
+            deadline = time.monotonic() + settings.CONTENT_CACHE_LOCK_TIMEOUT
+            while time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+                value = await self.cache.aget(key, MISSING)
+                if value is not MISSING:
+                    return value
+                if await self.cache.aget(lock_key) is None:
+                    break
+            return await load()
+
+        try:
+            value = await load()
+            if value is not None:
+                await self.cache.aset(key, value, timeout=settings.CONTENT_CACHE_TIMEOUT)
+            return value
+        finally:
+            await self.cache.adelete(lock_key)
+
+
+content_cache = ContentCache()
@@ -0,0 +1,151 @@
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import caches
+from ..models import Content, score_expression
+from ..serializers import CONTENT_LIST_VALUES, serialize_content_rows
+from .. import metrics
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Board name -> (annotation the database orders by, attribute of a Content giving the same value)
+BOARDS = {
+    'rating_average': ('average_rating', 'average_rating'),
+    'rating_count': ('rating_count', 'rating_count'),
+    'score': (score_expression, 'score'),
+}
+
+
+class Leaderboard:
+    """
+    Top contents by average rating, by rating count and by score, kept in the content cache
+    so the top endpoint reads one entry instead of sorting the table.
+
+    Each board stores up to twice LEADERBOARD_SIZE serialized contents in (value, id)
+    descending order, matching the (field, id) indexes. The rating processor merges the
+    contents it has just written into every board: a board being the exact top N, and
+    every content outside it ranking below its last entry, a changed content belongs to the
+    board iff it still ranks above that entry. Contents falling out of a board are dropped;
+    once fewer than LEADERBOARD_SIZE remain the board is deleted, and rebuilt from the
+    database by the next read with one index scan. `reconcile` rebuilds every board
+    periodically, correcting whatever a lost update (an evicted entry, a failed write)
+    left behind, and reports how many contents were misplaced.
+    """
+
+    @property
+    def cache(self):
+        return caches[settings.CONTENT_CACHE_ALIAS]
+
+    @property
+    def capacity(self):
+        return settings.LEADERBOARD_SIZE * 2
+
+    def key(self, board):
+        return f'leaderboard:{board}'
+
+    def top(self, board, limit):
+        """The first `limit` serialized contents of the board"""
+        entries = self.cache.get(self.key(board))
+        if entries is None:
+            entries = self.rebuild(board)
+        return [item for _, item in entries['items'][:limit]]
+
+    def contents_changed(self, contents):
+        """Merge contents whose aggregates were just written (committed) into the boards"""
+        if not contents:
+            return
+        items = {content.id: item for content, item in zip(contents, self.serialize(contents))}
+        for board, (_, attribute) in BOARDS.items():
+            changed = [((getattr(content, attribute), content.id), items[content.id]) for content in contents]
+            with self.locked(board) as locked:
+                if not locked:
+                    self.cache.delete(self.key(board))  # Rebuilt by the next read
+                    continue
+                entries = self.cache.get(self.key(board))
+                if entries is not None:
+                    self.merge(board, entries, changed)
+
+    def merge(self, board, entries, changed):
+        ids = {item['id'] for _, item in changed}
+        kept = [entry for entry in entries['items'] if entry[1]['id'] not in ids]
+        if entries['complete']:
+            # The board holds every content, all of them stay candidates
+            candidates = kept + changed
+        else:
+            # Contents outside the board rank below its last entry, so anything ranking below it
+            # now can be outranked by contents the board knows nothing about
+            floor = entries['items'][-1][0]
+            candidates = kept + [entry for entry in changed if entry[0] >= floor]
+        candidates.sort(key=lambda entry: entry[0], reverse=True)
+        complete = entries['complete'] and len(candidates) <= self.capacity
+        if len(candidates) < settings.LEADERBOARD_SIZE and not complete:
+            self.cache.delete(self.key(board))
+            return
+        self.store(board, candidates[:self.capacity], complete)
+
+    def rebuild(self, board):
+        """Load the board from the database, and store it unless an update holds the board"""
+        with self.locked(board, wait=False) as locked:
+            entries = self.load(board)
+            if locked:
+                self.store(board, entries['items'], entries['complete'])
+        return entries
+
+    def load(self, board):
+        order, _ = BOARDS[board]
+        queryset = Content.objects.all()
+        if callable(order):
+            queryset = queryset.annotate(board_value=order())
+            order = 'board_value'
+        fields = CONTENT_LIST_VALUES if order in CONTENT_LIST_VALUES else (*CONTENT_LIST_VALUES, order)
+        rows = list(queryset.order_by(f'-{order}', '-id').values(*fields)[:self.capacity])
+        items = [((row[order], row['id']), item) for row, item in zip(rows, serialize_content_rows(rows))]
+        return {'items': items, 'complete': len(items) < self.capacity}
+
+    def reconcile(self):
+        """
+        Rebuild every board from the database. Returns {board: misplaced}, the number of
+        contents served in the top LEADERBOARD_SIZE that should not have been there.
+        """
+        drift = {}
+        for board in BOARDS:
+            with self.locked(board) as locked:
+                stored = self.cache.get(self.key(board))
+                entries = self.load(board)
+                if locked:
+                    self.store(board, entries['items'], entries['complete'])
+            if stored is None:
+                continue
+            expected = {item['id'] for _, item in entries['items'][:settings.LEADERBOARD_SIZE]}
+            served = {item['id'] for _, item in stored['items'][:settings.LEADERBOARD_SIZE]}
+            drift[board] = len(served - expected)
+            if drift[board]:
+                metrics.LEADERBOARD_DRIFT.labels(board=board).inc(drift[board])
+                logger.warning(f"Leaderboard {board} had drifted: {drift[board]} contents misplaced")
+        return drift
+
+    def serialize(self, contents):
+        return serialize_content_rows({field: getattr(content, field) for field in CONTENT_LIST_VALUES}
+                                      for content in contents)
+
+    def store(self, board, items, complete):
+        self.cache.set(self.key(board), {'items': items, 'complete': complete}, timeout=None)
+
+    @contextmanager
+    def locked(self, board, wait=True):
+        """Cache lock serializing the read-modify-write of a board across processes, yields whether it was acquired"""
+        key = f'{self.key(board)}:lock'
+        deadline = time.monotonic() + (settings.CONTENT_CACHE_LOCK_TIMEOUT if wait else 0)
+        while not (acquired := self.cache.add(key, 1, timeout=settings.CONTENT_CACHE_LOCK_TIMEOUT)):
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.01)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.cache.delete(key)
+
+
+leaderboard = Leaderboard()
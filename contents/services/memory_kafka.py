@@ -0,0 +1,174 @@
+from collections import defaultdict, namedtuple
+from kafka import TopicPartition
+import threading
+import time
+import zlib
+
+ConsumerRecord = namedtuple('ConsumerRecord', ['topic', 'partition', 'offset', 'timestamp', 'key', 'value'])
+RecordMetadata = namedtuple('RecordMetadata', ['topic', 'partition', 'offset', 'timestamp'])
+
+
+class InMemoryBroker:
+    """
+    In-process stand-in for a Kafka cluster, backing the embedded rating transport and the
+    benchmarks. It implements the part of the kafka-python API that RatingProducer and
+    RatingProcessor use: keyed partitioning, polling with max_records, and committed offsets
+    per consumer group. Consumers of a group share every partition, there is no rebalancing.
+    Records are dropped once every group has committed past them.
+
+    With `track_latency`, every committed record is also timed from the moment it was
+    produced, which gives the end-to-end latency of the pipeline.
+    """
+
+    def __init__(self, partitions=8, track_latency=False):
+        self.partitions = partitions
+        self.logs = defaultdict(list)  # TopicPartition -> retained records
+        self.base_offsets = defaultdict(int)  # TopicPartition -> offset of the first retained record
+        self.committed = defaultdict(int)  # (group, TopicPartition) -> next offset
+        self.groups = set()
+        self.commit_latencies = [] if track_latency else None
+        self.condition = threading.Condition()
+
+    def producer(self, **configs):
+        return InMemoryProducer(self, **configs)
+
+    def consumer(self, *topics, **configs):
+        return InMemoryConsumer(self, *topics, **configs)
+
+    def partition_for(self, key):
+        if key is None:
+            return 0
+        return zlib.crc32(key) % self.partitions
+
+    def append(self, topic, key, value):
+        with self.condition:
+            tp = TopicPartition(topic, self.partition_for(key))
+            log = self.logs[tp]
+            offset = self.base_offsets[tp] + len(log)
+            record = ConsumerRecord(topic, tp.partition, offset, int(time.time() * 1000), key, value)
+            log.append(record)
+            self.condition.notify_all()
+        return record
+
+    def read(self, tp, offset, max_records):
+        start = max(offset - self.base_offsets[tp], 0)
+        return self.logs[tp][start:start + max_records]
+
+    def commit(self, group_id, positions):
+        self.committed.update({(group_id, tp): position for tp, position in positions.items()})
+        for tp in positions:
+            retained = min(self.committed[(group, tp)] for group in self.groups)
+            del self.logs[tp][:retained - self.base_offsets[tp]]
+            self.base_offsets[tp] = max(retained, self.base_offsets[tp])
+
+    def pending(self, topic, group_id):
+        """Number of records of the topic not committed by the group yet"""
+        with self.condition:
+            return sum(
+                self.base_offsets[tp] + len(log) - self.committed[(group_id, tp)]
+                for tp, log in self.logs.items() if tp.topic == topic
+            )
+
+
+class Future:
+    """Already completed send, callbacks run right away like on a resolved kafka-python future"""
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+    def add_callback(self, callback, *args):
+        callback(*args, self.metadata)
+        return self
+
+    def add_errback(self, errback, *args):
+        return self
+
+    def get(self, timeout=None):
+        return self.metadata
+
+
+class InMemoryProducer:
+    def __init__(self, broker, value_serializer=None, key_serializer=None, **configs):
+        self.broker = broker
+        self.value_serializer = value_serializer or (lambda value: value)
+        self.key_serializer = key_serializer or (lambda key: key)
+
+    def send(self, topic, value=None, key=None):
+        key = self.key_serializer(key) if key is not None else None
+        record = self.broker.append(topic, key, self.value_serializer(value))
+        return Future(RecordMetadata(topic, record.partition, record.offset, record.timestamp))
+
+    def flush(self, timeout=None):
+        pass
+
+    def close(self, timeout=None):
+        pass
+
+
+class InMemoryConsumer:
+    def __init__(self, broker, *topics, group_id=None, value_deserializer=None, max_poll_records=500, **configs):
+        self.broker = broker
+        self.group_id = group_id
+        self.value_deserializer = value_deserializer or (lambda value: value)
+        self.max_poll_records = max_poll_records
+        self.topics = set(topics)
+        self.positions = {}
+        self.uncommitted = []
+        with broker.condition:
+            broker.groups.add(group_id)
+
+    def subscribe(self, topics, listener=None):
+        self.topics = set(topics)
+
+    def assignment(self):
+        with self.broker.condition:
+            return {tp for tp in self.broker.logs if tp.topic in self.topics}
+
+    def highwater(self, tp):
+        with self.broker.condition:
+            return self.broker.base_offsets[tp] + len(self.broker.logs[tp])
+
+    def position(self, tp, timeout_ms=None):
+        with self.broker.condition:
+            return self.positions.get(tp, self.broker.committed[(self.group_id, tp)])
+
+    def poll(self, timeout_ms=0, max_records=None):
+        max_records = max_records or self.max_poll_records
+        deadline = time.monotonic() + timeout_ms / 1000
+        with self.broker.condition:
+            while True:
+                batch = self._fetch(max_records)
+                remaining = deadline - time.monotonic()
+                if batch or remaining <= 0:
+                    return batch
+                self.broker.condition.wait(remaining)
+
+    def _fetch(self, max_records):
+        batch = {}
+        for tp in list(self.broker.logs):
+            if tp.topic not in self.topics or max_records <= 0:
+                continue
+            position = self.positions.setdefault(tp, self.broker.committed[(self.group_id, tp)])
+            records = self.broker.read(tp, position, max_records)
+            if not records:
+                continue
+            self.positions[tp] = records[-1].offset + 1
+            if self.broker.commit_latencies is not None:
+                self.uncommitted.extend(records)
+            max_records -= len(records)
+            batch[tp] = [record._replace(value=self.value_deserializer(record.value)) for record in records]
+        return batch
+
+    def commit(self):
+        now = time.time() * 1000
+        with self.broker.condition:
+            self.broker.commit(self.group_id, self.positions)
+            if self.uncommitted:
+                self.broker.commit_latencies.extend(now - record.timestamp for record in self.uncommitted)
+                self.uncommitted = []
+
+    def close(self, autocommit=True):
+        if autocommit:
+            self.commit()
+        self.positions = {}
+        self.uncommitted = []
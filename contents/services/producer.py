@@ -0,0 +1,156 @@
+from asgiref.sync import sync_to_async
+from kafka.errors import KafkaError
+from django.conf import settings
+from collections import deque
+from .. import metrics
+from .transport import get_transport
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RatingProducer:
+    """
+    Process-wide rating producer shared by every request of a web worker.
+
+    The underlying producer of the rating transport (a KafkaProducer unless the embedded
+    transport is configured) is created lazily in a background thread and re-created
+    after a fork, so each gunicorn worker owns exactly one connection pool. Messages are
+    sent asynchronously; while the broker is unreachable they are kept in a bounded local
+    spool and replayed once the producer is available, so the request path never waits
+    on Kafka; async views use `asend` and `asend_many`, which run the send in a worker
+    thread so a full producer buffer never blocks the event loop. Spooled messages only live in memory: the ratings themselves are already in
+    the database (unprocessed), so a lost message can be recovered from there.
+    """
+
+    def __init__(self, transport=None):
+        self._transport = transport
+        self._lock = threading.Lock()
+        self._pid = None
+        atexit.register(self.close)
+
+    def _reset(self):
+        # Never touch a producer inherited from the parent process, its sockets are shared
+        self._pid = os.getpid()
+        self._producer = None
+        self._connecting = False
+        self._retry_at = 0
+        self._spool = deque(maxlen=settings.RATING_SPOOL_MAX_SIZE)
+
+    def _get_producer(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if self._producer is None and not self._connecting and time.monotonic() >= self._retry_at:
+                self._connecting = True
+                threading.Thread(target=self._connect, name='rating-producer-connect', daemon=True).start()
+            return self._producer
+
+    def _connect(self):
+        try:
+            transport = self._transport or get_transport()
+            producer = transport.producer(
+                value_serializer=lambda m: json.dumps(m).encode('utf-8'),
+                key_serializer=lambda k: str(k).encode('utf-8'),
+                linger_ms=settings.KAFKA_PRODUCER_LINGER_MS,
+                batch_size=settings.KAFKA_PRODUCER_BATCH_SIZE,
+                compression_type=settings.KAFKA_PRODUCER_COMPRESSION,
+                max_block_ms=settings.KAFKA_PRODUCER_MAX_BLOCK_MS,
+            )
+        except KafkaError as e:
+            logger.warning(f"Kafka producer unavailable, spooling rating messages: {str(e)}")
+            with self._lock:
+                self._connecting = False
+                self._retry_at = time.monotonic() + settings.KAFKA_PRODUCER_RETRY_SECONDS
+            return
+
+        with self._lock:
+            self._producer = producer
+            self._connecting = False
+        self._drain_spool(producer)
+
+    def send(self, topic, value, key=None):
+        """Queue a message for delivery without blocking on the broker"""
+        producer = self._get_producer()
+        if producer is None:
+            self._spool_message(topic, value, key)
+            return
+        self._drain_spool(producer)
+        self._send(producer, topic, value, key)
+
+    def send_many(self, topic, messages):
+        """Queue several (key, value) messages at once, they are batched by the producer"""
+        producer = self._get_producer()
+        if producer is None:
+            for key, value in messages:
+                self._spool_message(topic, value, key)
+            return
+        self._drain_spool(producer)
+        for key, value in messages:
+            self._send(producer, topic, value, key)
+
+    async def asend(self, topic, value, key=None):
+        await sync_to_async(self.send, thread_sensitive=False)(topic, value, key=key)
+
+    async def asend_many(self, topic, messages):
+        await sync_to_async(self.send_many, thread_sensitive=False)(topic, messages)
+
+    def _send(self, producer, topic, value, key):
+        try:
+            future = producer.send(topic, value=value, key=key)
+        except KafkaError as e:
+            logger.warning(f"Failed to queue rating message: {str(e)}")
+            self._spool_message(topic, value, key)
+            return False
+        future.add_callback(self._on_delivered)
+        future.add_errback(self._on_failed, topic, value, key)
+        return True
+
+    def _on_delivered(self, record_metadata):
+        metrics.RATING_MESSAGES_SENT.inc()
+
+    def _on_failed(self, topic, value, key, exception):
+        logger.warning(f"Rating message delivery failed: {str(exception)}")
+        metrics.RATING_MESSAGES_FAILED.inc()
+        self._spool_message(topic, value, key)
+
+    def _spool_message(self, topic, value, key):
+        if len(self._spool) == self._spool.maxlen:
+            metrics.RATING_MESSAGES_DROPPED.inc()  # The oldest message is pushed out
+        self._spool.append((topic, value, key))
+        metrics.RATING_MESSAGES_SPOOLED.inc()
+
+    def _drain_spool(self, producer):
+        while True:
+            try:
+                topic, value, key = self._spool.popleft()
+            except IndexError:
+                return
+            if not self._send(producer, topic, value, key):
+                return  # Still failing, keep the rest spooled
+
+    def flush(self, timeout=None):
+        producer = self._get_producer()
+        if producer is not None:
+            self._drain_spool(producer)
+            producer.flush(timeout=timeout)
+
+    def close(self):
+        """Deliver everything still buffered before the worker exits"""
+        with self._lock:
+            producer = self._producer if self._pid == os.getpid() else None
+            self._producer = None
+        if producer is None:
+            return
+        self._drain_spool(producer)
+        if self._spool:
+            logger.warning(f"Dropping {len(self._spool)} spooled rating messages on shutdown")
+        producer.close(timeout=settings.KAFKA_PRODUCER_CLOSE_TIMEOUT)
+
+
+rating_producer = RatingProducer()
@@ -0,0 +1,139 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.redis import RedisCache
+from rest_framework.throttling import BaseThrottle
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework_simplejwt.settings import api_settings
+from .. import metrics
+import math
+import threading
+import time
+
+WINDOW_SECONDS = 3600
+
+
+def now():
+    """Wall clock the windows are aligned on, patched by the tests"""
+    return time.time()
+
+# Checks every scope of a request against its limit and, only if all of them allow it, counts
+# the request in each. KEYS are (current window, previous window) pairs, one per scope; ARGV
+# holds the weight of the previous window, the cost of the request, the TTL of the counters
+# and the limit of each scope. Returns whether the request is allowed then the current and
+# previous count of each scope.
+CHECK_SCRIPT = """
+local weight, cost, ttl = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local result = {1}
+for i = 1, #KEYS, 2 do
+    local current = tonumber(redis.call('GET', KEYS[i]) or '0')
+    local previous = tonumber(redis.call('GET', KEYS[i + 1]) or '0')
+    if current + previous * weight + cost > tonumber(ARGV[3 + (i + 1) / 2]) then
+        result[1] = 0
+    end
+    table.insert(result, current)
+    table.insert(result, previous)
+end
+if result[1] == 1 then
+    for i = 1, #KEYS, 2 do
+        redis.call('INCRBY', KEYS[i], cost)
+        redis.call('EXPIRE', KEYS[i], ttl)
+    end
+end
+return result
+"""
+
+
+class RatingRateLimiter:
+    """
+    Hourly budget of ratings per user and per client IP, enforced before the rating views
+    touch the database.
+
+    Uses sliding window counters: a request is let through when the count of the current
+    hour, plus the count of the previous hour weighted by the share of it still inside the
+    last 3600 seconds, stays within the limit. Counters live in the content cache. With
+    Redis one check is a single script call, atomic across every process; with the
+    local-memory cache it is a dict lookup under a process lock. The user is taken from the
+    signed token claims, so the check needs neither authentication nor a query; requests
+    without a valid token are only limited by IP (and rejected by authentication anyway).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._script = None
+
+    @property
+    def cache(self):
+        return caches[settings.CONTENT_CACHE_ALIAS]
+
+    def scopes(self, request):
+        """{scope: limit} of the request, scopes with a limit of 0 are not enforced"""
+        limits = {f'ip:{BaseThrottle().get_ident(request)}': settings.RATE_LIMIT_PER_IP_PER_HOUR}
+        authentication = JWTAuthentication()
+        header = authentication.get_header(request)
+        raw_token = authentication.get_raw_token(header) if header is not None else None
+        if raw_token is not None:
+            try:
+                token = authentication.get_validated_token(raw_token)
+                limits[f'user:{token[api_settings.USER_ID_CLAIM]}'] = settings.RATE_LIMIT_PER_HOUR
+            except (InvalidToken, TokenError, KeyError):
+                pass
+        return {scope: limit for scope, limit in limits.items() if limit > 0}
+
+    def check(self, request, cost=1):
+        """
+        Count `cost` ratings against the caller's budgets. Returns None when allowed, otherwise
+        the seconds to wait before the request would be, without counting it.
+        """
+        limits = self.scopes(request)
+        if not limits:
+            return None
+        window, elapsed = divmod(now(), WINDOW_SECONDS)
+        weight = 1 - elapsed / WINDOW_SECONDS
+        keys = [(f'ratelimit:{scope}:{int(window)}', f'ratelimit:{scope}:{int(window) - 1}') for scope in limits]
+        allowed, counts = self._count(keys, list(limits.values()), weight, cost)
+        if allowed:
+            return None
+
+        waits = []
+        for scope, limit, (current, previous) in zip(limits, limits.values(), counts):
+            if current + previous * weight + cost > limit:
+                metrics.RATING_REQUESTS_RATE_LIMITED.labels(scope=scope.split(':', 1)[0]).inc()
+                waits.append(self.wait(limit, current, previous, elapsed, cost))
+        return max(1, math.ceil(max(waits)))
+
+    async def acheck(self, request, cost=1):
+        return await sync_to_async(self.check, thread_sensitive=False)(request, cost)
+
+    def wait(self, limit, current, previous, elapsed, cost):
+        """Seconds until the weighted count leaves room for `cost` more"""
+        if current + cost <= limit:
+            # The previous hour has to slide out far enough
+            return WINDOW_SECONDS * (1 - (limit - cost - current) / previous) - elapsed
+        # The current hour becomes the previous one, then has to slide out far enough
+        slide = WINDOW_SECONDS * (1 - (limit - cost) / current) if cost <= limit else WINDOW_SECONDS
+        return WINDOW_SECONDS - elapsed + max(slide, 0)
+
+    def _count(self, keys, limits, weight, cost):
+        ttl = WINDOW_SECONDS * 2
+        if isinstance(self.cache, RedisCache):
+            flat_keys = [self.cache.make_and_validate_key(key) for pair in keys for key in pair]
+            client = self.cache._cache.get_client(flat_keys[0], write=True)
+            if self._script is None:
+                self._script = client.register_script(CHECK_SCRIPT)
+            allowed, *counts = self._script(keys=flat_keys, args=[weight, cost, ttl, *limits], client=client)
+            return allowed == 1, [(int(current), int(previous)) for current, previous in zip(counts[::2], counts[1::2])]
+
+        with self._lock:
+            values = self.cache.get_many([key for pair in keys for key in pair])
+            counts = [(values.get(current, 0), values.get(previous, 0)) for current, previous in keys]
+            allowed = all(current + previous * weight + cost <= limit
+                          for (current, previous), limit in zip(counts, limits))
+            if allowed:
+                self.cache.set_many({current: count + cost for (current, _), (count, _) in zip(keys, counts)},
+                                    timeout=ttl)
+        return allowed, counts
+
+
+rating_limiter = RatingRateLimiter()
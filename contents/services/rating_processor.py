@@ -1,37 +1,78 @@
-from kafka import KafkaConsumer
+from kafka import ConsumerRebalanceListener
 from kafka.errors import NoBrokersAvailable
 from django.conf import settings
 from django.utils import timezone
-from datetime import timedelta
-from django.db.models import Count, Avg
-from ..models import Rating, Content
+from django.db import InterfaceError, OperationalError, close_old_connections, transaction
+from ..models import Rating, Content, RatingRollup
+from .. import metrics
+from .aggregates import AGGREGATE_FIELDS, average_of
+from .anomaly import AnomalyDetector
+from .cache import content_cache
+from .leaderboard import leaderboard
+from .transport import get_transport
+from collections import defaultdict
 import json
 import logging
 import time
 
 logger = logging.getLogger(__name__)
 
+# Positions in the rollup deltas, after the counts of the six stars (see RatingRollup.SUM_FIELDS)
+VOTES, WEIGHTED_SUM, WEIGHT_SUM = 6, 7, 8
+
+
+class RatingRebalanceListener(ConsumerRebalanceListener):
+    """Hands partitions over cleanly when the consumer group rebalances"""
+
+    def __init__(self, processor):
+        self.processor = processor
+
+    def on_partitions_revoked(self, revoked):
+        # Batches are applied synchronously between polls, so everything consumed so far is
+        # already in the database; commit it before another worker takes the partitions over
+        if revoked:
+            logger.info(f"Partitions revoked: {sorted(tp.partition for tp in revoked)}")
+            self.processor.consumer.commit()
+            for tp in revoked:
+                # Reported by the worker taking the partition over from now on
+                metrics.RATING_PROCESSOR_LAG.labels(partition=tp.partition).set(0)
+        # The contents of the revoked partitions will now be rated through another worker
+        self.processor.anomaly_detector.clear()
+
+    def on_partitions_assigned(self, assigned):
+        logger.info(f"Partitions assigned: {sorted(tp.partition for tp in assigned)}")
+
+
 class RatingProcessor:
-    def __init__(self):
+    def __init__(self, max_records=None, max_wait_ms=None, transport=None):
         self.topic_name = 'ratings'
+        self.transport = transport or get_transport()
+        self.max_records = max_records or settings.RATING_BATCH_MAX_RECORDS
+        self.max_wait_ms = max_wait_ms or settings.RATING_BATCH_MAX_WAIT_MS
+        self.anomaly_detector = AnomalyDetector()
+        self.anomaly_seconds = 0.0
+        self.lag_updated_at = 0
+        self.leaderboards_reconciled_at = float('-inf')
         self.connect_with_retry()
 
     def connect_with_retry(self, max_retries=5, retry_delay=5):
         """Attempt to connect to Kafka with retries"""
         for attempt in range(max_retries):
             try:
-                logger.info(f"Attempting to connect to Kafka brokers: {settings.KAFKA_BOOTSTRAP_SERVERS}")
-                self.consumer = KafkaConsumer(
-                    self.topic_name,
-                    bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS,
+                if not self.transport.embedded:
+                    logger.info(f"Attempting to connect to Kafka brokers: {settings.KAFKA_BOOTSTRAP_SERVERS}")
+                self.consumer = self.transport.consumer(
                     value_deserializer=lambda m: json.loads(m.decode('utf-8')),
                     group_id='rating_processor_group',
                     auto_offset_reset='earliest',
-                    enable_auto_commit=True,
+                    # Offsets are committed manually once the batch is in the database
+                    enable_auto_commit=False,
+                    max_poll_records=self.max_records,
                     session_timeout_ms=30000,
                     heartbeat_interval_ms=10000
                 )
-                logger.info("Successfully connected to Kafka")
+                self.consumer.subscribe([self.topic_name], listener=RatingRebalanceListener(self))
+                logger.info("Successfully connected to Kafka" if not self.transport.embedded else "Consuming the embedded rating queue")
                 return
             except NoBrokersAvailable:
                 if attempt < max_retries - 1:
@@ -44,71 +85,214 @@ class RatingProcessor:
     def run(self):
         """Main processing loop"""
         logger.info("Rating processor started")
-        while True:
+        try:
+            while True:
+                try:
+                    self.poll_once()
+                except Exception as e:
+                    logger.error(f"Consumer error: {str(e)}")
+                    metrics.RATING_PROCESSOR_RECONNECTS.inc()
+                    time.sleep(5)  # Wait before attempting to reconnect
+                    self.consumer.close(autocommit=False)
+                    self.anomaly_detector.clear()
+                    close_old_connections()  # Drop a database connection that may be broken
+                    self.connect_with_retry()
+        finally:
+            # Leave the group right away so the partitions are reassigned without waiting for the session timeout
+            self.consumer.close(autocommit=False)
+
+    def poll_once(self):
+        """Process one polled batch and commit its offsets, returning the number of messages"""
+        batch = self.consumer.poll(timeout_ms=self.max_wait_ms, max_records=self.max_records)
+        self.update_lag()
+        self.reconcile_leaderboards()
+        if not batch:
+            return 0
+        messages = [message for messages in batch.values() for message in messages]
+        metrics.RATING_PROCESSOR_MESSAGES.inc(len(messages))
+        metrics.RATING_PROCESSOR_BATCH_SIZE.observe(len(messages))
+        self.process_messages(messages)
+        self.consumer.commit()
+        return len(messages)
+
+    def update_lag(self):
+        """Publish the lag of every assigned partition, at most once a second"""
+        now = time.monotonic()
+        if now < self.lag_updated_at + 1:
+            return
+        self.lag_updated_at = now
+        for tp in self.consumer.assignment():
+            highwater = self.consumer.highwater(tp)
+            position = self.consumer.position(tp, timeout_ms=0)
+            if highwater is not None and position is not None:
+                metrics.RATING_PROCESSOR_LAG.labels(partition=tp.partition).set(max(highwater - position, 0))
+
+    def reconcile_leaderboards(self):
+        """Rebuild the leaderboards from the database every LEADERBOARD_RECONCILE_SECONDS"""
+        now = time.monotonic()
+        if now - self.leaderboards_reconciled_at < settings.LEADERBOARD_RECONCILE_SECONDS:
+            return
+        self.leaderboards_reconciled_at = now
+        # Done by whichever processor of the group gets there first in each period
+        if not leaderboard.cache.add('leaderboard:reconciled', 1, timeout=settings.LEADERBOARD_RECONCILE_SECONDS):
+            return
+        try:
+            leaderboard.reconcile()
+        except Exception as e:
+            logger.error(f"Error reconciling the leaderboards: {str(e)}")
+
+    def process_messages(self, messages):
+        """Process a polled batch, touching every affected content once"""
+        content_ids = set()
+        for message in messages:
             try:
-                logger.info("Waiting for messages...")
-                for message in self.consumer:
-                    try:
-                        rating_data = message.value
-                        content_id = rating_data['content_id']
-                        logger.info(f"Processing rating for content_id: {content_id}")
-                        self.process_ratings_batch(content_id)
-                    except Exception as e:
-                        logger.error(f"Error processing message: {str(e)}")
-            except Exception as e:
-                logger.error(f"Consumer error: {str(e)}")
-                time.sleep(5)  # Wait before attempting to reconnect
-                self.connect_with_retry()
+                content_ids.add(int(message.value['content_id']))
+            except (KeyError, TypeError, ValueError):
+                logger.error(f"Skipping malformed rating message: {message.value!r}")
 
+        if not content_ids:
+            return
+        logger.info(f"Processing {len(messages)} ratings for {len(content_ids)} contents")
+
+        try:
+            self.process_contents(content_ids)
+        except (OperationalError, InterfaceError):
+            raise  # Nothing reached the database, the offsets must not be committed
+        except Exception as e:
+            # Isolate the failing content so the rest of the batch still gets committed
+            logger.error(f"Error processing batch, retrying contents one by one: {str(e)}")
+            for content_id in content_ids:
+                self.process_ratings_batch(content_id)
 
     def check_rating_anomaly(self, content_id, rating_value):
         """Check if there's an unusual spike in specific rating value"""
-        time_threshold = timezone.now() - timedelta(hours=1)
-        
-        recent_ratings = Rating.objects.filter(
-            content_id=content_id,
-            created_at__gte=time_threshold
+        started = time.perf_counter()
+        anomalous = self.anomaly_detector.is_anomalous(content_id, rating_value, timezone.now())
+        self.anomaly_seconds += time.perf_counter() - started
+        return anomalous
+
+    def apply_ratings(self, content, ratings, rollup=None):
+        """
+        Fold unprocessed ratings into the running aggregates of a content.
+        New ratings are added, re-rated ones replace their previously applied value, and
+        anomaly penalties are applied in place, so the cost does not depend on how many
+        ratings the content already has. The same changes are added to `rollup`, per hour
+        of the vote, in the form RatingRollup.objects.add takes.
+        """
+        if rollup is None:
+            rollup = {}
+        for rating in ratings:
+            hour = rating.updated_at.replace(minute=0, second=0, microsecond=0)
+            deltas = rollup.setdefault((content.id, hour), [0] * len(RatingRollup.SUM_FIELDS))
+            if rating.applied_rating is None:
+                content.rating_count += 1
+            else:
+                # Remove the contribution of the previously applied rating
+                content.weighted_sum -= rating.applied_rating * rating.weight
+                content.weight_sum -= rating.weight
+                deltas[rating.applied_rating] -= 1
+                deltas[WEIGHTED_SUM] -= rating.applied_rating * rating.weight
+                deltas[WEIGHT_SUM] -= rating.weight
+
+            # Check for anomaly and adjust weight if necessary
+            if self.check_rating_anomaly(content.id, rating.rating):
+                rating.weight = settings.ANOMALY_WEIGHT_PENALTY
+                metrics.RATING_PROCESSOR_PENALTIES.inc()
+
+            content.weighted_sum += rating.rating * rating.weight
+            content.weight_sum += rating.weight
+            deltas[rating.rating] += 1
+            deltas[VOTES] += 1
+            deltas[WEIGHTED_SUM] += rating.rating * rating.weight
+            deltas[WEIGHT_SUM] += rating.weight
+            rating.applied_rating = rating.rating
+            rating.processed = True
+
+        content.average_rating = average_of(content.weighted_sum, content.weight_sum)
+
+    def process_contents(self, content_ids):
+        """
+        Apply the unprocessed ratings of several contents in one transaction.
+        Contents are locked in id order so concurrent processors cannot deadlock, and the
+        pending ratings are locked so a concurrent re-rate is not marked processed unapplied.
+        """
+        timings = {}
+        try:
+            with transaction.atomic():
+                contents, pending, rollup = self._process_contents(content_ids, timings)
+                write_started = time.perf_counter()
+                Rating.objects.bulk_update(pending, ['weight', 'applied_rating', 'processed'], batch_size=1000)
+                Content.objects.bulk_update(contents, AGGREGATE_FIELDS, batch_size=1000)
+                RatingRollup.objects.add(rollup)
+            timings['db_write'] = time.perf_counter() - write_started
+        except Exception:
+            # The windows may have observed ratings that were rolled back
+            self.anomaly_detector.forget(content_ids)
+            raise
+        for stage, seconds in timings.items():
+            metrics.PROCESSOR_STAGES[stage].observe(seconds)
+        self.anomaly_detector.evict(timezone.now())
+        content_cache.contents_changed([content.id for content in contents])
+        leaderboard.contents_changed(contents)
+        return contents
+
+    def _process_contents(self, content_ids, timings):
+        started = time.perf_counter()
+        now = timezone.now()
+        contents = list(
+            Content.objects.select_for_update().filter(id__in=content_ids).defer('search_vector').order_by('id')
         )
-        
-        total_recent = recent_ratings.count()
-        if total_recent < settings.MIN_RATE_COUNT:  # Not enough data to detect anomaly
-            return False
-            
-        rating_value_count = recent_ratings.filter(rating=rating_value).count()
-        
-        # If more than 80% of recent ratings are the same value, consider it suspicious
-        return (rating_value_count / total_recent) > settings.ANOMALY_THRESHOLD
-    
+        pending = list(
+            Rating.objects.select_for_update()
+            .filter(content_id__in=content_ids, processed=False)
+            .order_by('id')
+        )
+
+        ratings_by_content = defaultdict(list)
+        for rating in pending:
+            ratings_by_content[rating.content_id].append(rating)
+
+        loaded = time.perf_counter()
+        self.anomaly_detector.observe(ratings_by_content, now)
+        observed = time.perf_counter()
+        self.anomaly_seconds = 0.0  # Accumulated by the checks made while applying
+        rollup = {}
+        for content in contents:
+            self.apply_ratings(content, ratings_by_content[content.id], rollup)
+        applied = time.perf_counter()
+
+        timings['load'] = loaded - started
+        timings['anomaly_check'] = observed - loaded + self.anomaly_seconds
+        timings['aggregate'] = applied - observed - self.anomaly_seconds
+        return contents, pending, rollup
+
+    def process_pending(self):
+        """
+        Apply every rating still unprocessed, whatever happened to its message.
+        Used when the embedded transport starts, since its queue does not outlive the process.
+        """
+        content_ids = list(Rating.objects.filter(processed=False).values_list('content_id', flat=True).distinct())
+        if content_ids:
+            logger.info(f"Applying pending ratings of {len(content_ids)} contents")
+        for start in range(0, len(content_ids), self.max_records):
+            chunk = content_ids[start:start + self.max_records]
+            try:
+                self.process_contents(chunk)
+            except (OperationalError, InterfaceError):
+                raise
+            except Exception as e:
+                logger.error(f"Error processing pending ratings, retrying contents one by one: {str(e)}")
+                for content_id in chunk:
+                    self.process_ratings_batch(content_id)
+
     def process_ratings_batch(self, content_id):
-        """Process all unprocessed ratings for a content"""
+        """
+        Process all unprocessed ratings for a content. Errors of the data of the content are
+        logged, connection errors are raised so the batch is polled again after reconnecting.
+        """
         try:
-            content = Content.objects.get(id=content_id)
-            unprocessed_ratings = Rating.objects.filter(
-                content_id=content_id,
-                processed=False
-            )
-            
-            # Process each unprocessed rating
-            for rating in unprocessed_ratings:
-                # Check for anomaly and adjust weight if necessary
-                if self.check_rating_anomaly(content_id, rating.rating):
-                    rating.weight = settings.ANOMALY_WEIGHT_PENALTY
-                    rating.save()
-            
-            all_ratings = Rating.objects.filter(content_id=content_id)
-            
-            # Calculate weighted average
-            weighted_sum = sum(r.rating * r.weight for r in all_ratings)
-            weight_sum = sum(r.weight for r in all_ratings)
-            new_average = weighted_sum / weight_sum if weight_sum > 0 else 0
-            
-            content.average_rating = new_average
-            content.rating_count = all_ratings.count()
-            content.save()
-            
-            # Mark all processed
-            unprocessed_ratings.update(processed=True)
-            
+            self.process_contents([content_id])
+        except (OperationalError, InterfaceError):
+            raise
         except Exception as e:
             logger.error(f"Error processing ratings for content {content_id}: {str(e)}")
-    
\ No newline at end of file
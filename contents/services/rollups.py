@@ -0,0 +1,87 @@
+from datetime import timedelta
+from django.db import connections, router, transaction
+from django.db.models import Sum
+from rest_framework.fields import DateTimeField
+from ..models import Content, Rating, RatingRollup
+from .aggregates import average_of
+
+
+def current_hour(now):
+    return now.replace(minute=0, second=0, microsecond=0)
+
+
+def content_stats(content_id, hours, now):
+    """
+    Rating histogram of a content and its hourly time series over the last `hours` hours,
+    read from the rollup rows: one sum over all of them, one index range over the window.
+    Returns None when the content does not exist.
+    """
+    if not Content.objects.filter(id=content_id).exists():
+        return None
+    rollups = RatingRollup.objects.filter(content_id=content_id)
+    totals = rollups.aggregate(**{field: Sum(field) for field in RatingRollup.SUM_FIELDS})
+    totals = {field: value or 0 for field, value in totals.items()}
+    start = current_hour(now) - timedelta(hours=hours - 1)
+    rows = list(rollups.filter(hour__gte=start).order_by('hour').values('hour', *RatingRollup.SUM_FIELDS))
+
+    # Walk back from the totals to the state of the content at the end of each hour
+    running = dict(totals)
+    series = []
+    for row in reversed(rows):
+        series.append({
+            'hour': DateTimeField().to_representation(row['hour']),
+            'votes': row['votes'],
+            'rating_count': sum(running[f'count_{star}'] for star in RatingRollup.STARS),
+            'average_rating': average_of(running['weighted_sum'], running['weight_sum']),
+        })
+        for field in RatingRollup.SUM_FIELDS:
+            running[field] -= row[field]
+    series.reverse()
+
+    histogram = {str(star): totals[f'count_{star}'] for star in RatingRollup.STARS}
+    return {
+        'content_id': content_id,
+        'histogram': histogram,
+        'rating_count': sum(histogram.values()),
+        'average_rating': average_of(totals['weighted_sum'], totals['weight_sum']),
+        'hours': hours,
+        'series': series,
+    }
+
+
+def backfill_rollups(min_id, max_id):
+    """
+    Rebuild the rollup rows of the contents with min_id <= id < max_id from their applied
+    ratings, with one GROUP BY. Each rating counts in the hour it was last changed: earlier
+    values of re-rated ratings are not kept, so the series lose re-rate history but the rows
+    still sum up to the aggregates. The contents are locked for the duration, so the
+    processor cannot apply ratings to them in between. Returns the number of rows written.
+    """
+    content_table = Content._meta.db_table
+    rating_table = Rating._meta.db_table
+    rollup_table = RatingRollup._meta.db_table
+    counts = ', '.join(f'count_{star}' for star in RatingRollup.STARS)
+    count_filters = ', '.join(f'COUNT(*) FILTER (WHERE applied_rating = {star})' for star in RatingRollup.STARS)
+    using = router.db_for_write(RatingRollup)
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute(
+            f'SELECT id FROM {content_table} WHERE id >= %s AND id < %s ORDER BY id FOR UPDATE',
+            [min_id, max_id],
+        )
+        cursor.execute(f'DELETE FROM {rollup_table} WHERE content_id >= %s AND content_id < %s', [min_id, max_id])
+        cursor.execute(
+            f"""
+            INSERT INTO {rollup_table} (content_id, hour, {counts}, votes, weighted_sum, weight_sum)
+            SELECT content_id,
+                   date_trunc('hour', updated_at),
+                   {count_filters},
+                   COUNT(*),
+                   SUM(applied_rating * weight),
+                   SUM(weight)
+            FROM {rating_table}
+            WHERE applied_rating IS NOT NULL AND content_id >= %s AND content_id < %s
+            GROUP BY 1, 2
+            """,
+            [min_id, max_id],
+        )
+        return cursor.rowcount
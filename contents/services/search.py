@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import ExpressionWrapper, F, FloatField, Value
+from ..models import Content, score_expression
+
+# Text search configuration of the content search vectors, see migration 0008
+SEARCH_CONFIG = 'english'
+
+# ts_rank normalization 32 maps the relevance into [0, 1)
+RANK_NORMALIZATION = 32
+
+
+def search_contents(query):
+    """
+    Contents matching a web-search style query (quoted phrases, OR, -excluded), annotated
+    with `rank`: the text relevance (title matches weigh more than text ones) scaled by the
+    score of the content. SEARCH_RATING_WEIGHT is the share of the rank that depends on the
+    score: a content scoring 0 keeps 1 - SEARCH_RATING_WEIGHT of its relevance, one scoring
+    5 all of it; the score already discounts contents with few ratings. The GIN index
+    finds the matches, so the cost grows with the number of matching contents rather than
+    with the size of the table.
+    """
+    search_query = SearchQuery(query, config=SEARCH_CONFIG, search_type='websearch')
+    weight = settings.SEARCH_RATING_WEIGHT
+    relevance = SearchRank(F('search_vector'), search_query, normalization=Value(RANK_NORMALIZATION))
+    quality = score_expression() / 5  # Ratings go from 0 to 5
+    rank = ExpressionWrapper(relevance * (Value(1 - weight) + Value(weight) * quality), output_field=FloatField())
+    return Content.objects.filter(search_vector=search_query).annotate(rank=rank).order_by('-rank', '-id')
@@ -0,0 +1,78 @@
+from kafka import KafkaConsumer, KafkaProducer
+from django.conf import settings
+from .memory_kafka import InMemoryBroker
+import os
+import threading
+
+
+class KafkaTransport:
+    """Rating messages go through the Kafka cluster, consumed by the rating-processor service"""
+    embedded = False
+
+    def producer(self, **configs):
+        return KafkaProducer(bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS, **configs)
+
+    def consumer(self, **configs):
+        return KafkaConsumer(bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS, **configs)
+
+
+class EmbeddedTransport:
+    """
+    Rating messages go through an in-process queue, consumed by a RatingProcessor running in
+    a thread of the same process, so single-node setups need neither a broker nor a separate
+    processor service. The processor code is the same as with Kafka: messages are polled in
+    batches and only committed once the batch is in the database.
+
+    The queue lives in memory; the ratings themselves are already stored unprocessed, so the
+    ones whose messages were lost with the process are applied when the thread starts again.
+    """
+    embedded = True
+
+    def __init__(self, broker=None, run_processor=True):
+        self.broker = broker or InMemoryBroker(partitions=1)
+        self.run_processor = run_processor
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def producer(self, **configs):
+        self.start()
+        return self.broker.producer(**configs)
+
+    def consumer(self, **configs):
+        return self.broker.consumer(**configs)
+
+    def start(self):
+        """Start the processor thread, once"""
+        if not self.run_processor:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run_processor, name='rating-processor', daemon=True)
+                self._thread.start()
+
+    def _run_processor(self):
+        from .rating_processor import RatingProcessor
+        processor = RatingProcessor(transport=self)
+        processor.process_pending()
+        processor.run()
+
+
+TRANSPORTS = {
+    'kafka': KafkaTransport,
+    'embedded': EmbeddedTransport,
+}
+
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport():
+    """Transport selected by RATING_TRANSPORT, one per process so the embedded queue is never shared across a fork"""
+    key = (settings.RATING_TRANSPORT, os.getpid())
+    with _transports_lock:
+        if key not in _transports:
+            try:
+                _transports[key] = TRANSPORTS[settings.RATING_TRANSPORT]()
+            except KeyError:
+                raise ValueError(f"Unknown RATING_TRANSPORT {settings.RATING_TRANSPORT!r}, use one of {sorted(TRANSPORTS)}")
+        return _transports[key]
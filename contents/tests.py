@@ -1,8 +1,1433 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import OperationalError, connection, connections, router
+from unittest import skipUnless
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from io import StringIO
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from rest_framework import status
+from unittest import mock
+from types import SimpleNamespace
+from kafka import TopicPartition
+from .models import Content, Rating, RatingRollup
+from .services.aggregates import find_aggregate_drift
+from .services.anomaly import AnomalyDetector, RatingWindow
+from django.utils import timezone
+from django.core.cache import cache
+from django.db.models import Sum
+from datetime import timedelta
+from .services.rating_processor import RatingProcessor, RatingRebalanceListener
+from .services.producer import RatingProducer
+from .services.cache import ContentCache
+from .services.leaderboard import BOARDS, Leaderboard
+from .services.search import search_contents
+from .services.benchmark import compare_to_baseline, percentiles
+from .services.memory_kafka import InMemoryBroker
+from .services.transport import EmbeddedTransport, KafkaTransport, get_transport
+from .serializers import ContentSerializer, CONTENT_LIST_VALUES, serialize_content_rows
+from .renderers import FastJSONRenderer
+from .management.commands import populate_db
+from . import async_views
+from content_rating.database import database_sync_to_async, get_executor
+from content_rating.routers import ReplicaSet, replicas
+from authentication.authentication import user_cache
+from rest_framework.renderers import JSONRenderer
+from prometheus_client import REGISTRY
+import itertools
+import json
+import os
+import tempfile
+
+try:
+    import fakeredis
+    import lupa
+except ImportError:
+    fakeredis = lupa = None
+
+User = get_user_model()
 
 # Test all the functionalities of the contents app here
 
+@mock.patch('contents.views.rating_producer')
+class ContentRatingViewTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username='user')
+        self.client.force_authenticate(self.user)
+        self.content = Content.objects.create(title='title', text='text')
+        self.url = reverse('content-rate')
+
+    def test_rating_is_created_then_updated_in_one_query(self, producer):
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {'content_id': self.content.id, 'rating': 4})
+        self.assertEqual(response.data['message'], 'Rating created')
+
+        Rating.objects.update(processed=True, applied_rating=4)
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {'content_id': self.content.id, 'rating': 0})
+        self.assertEqual(response.data['message'], 'Rating updated')
+
+        rating = Rating.objects.get()
+        self.assertEqual((rating.rating, rating.applied_rating, rating.processed), (0, 4, False))
+        self.assertEqual(producer.send.call_count, 2)
+        self.assertEqual(producer.send.call_args.kwargs['key'], self.content.id)
+
+    def test_token_user_is_only_loaded_once(self, producer):
+        user_cache.clear()
+        self.client.force_authenticate(None)
+        auth = {'HTTP_AUTHORIZATION': f'Bearer {AccessToken.for_user(self.user)}'}
+        with self.assertNumQueries(2):
+            self.client.post(self.url, {'content_id': self.content.id, 'rating': 4}, **auth)
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {'content_id': self.content.id, 'rating': 3}, **auth)
+        self.assertEqual(response.data['message'], 'Rating updated')
+
+    def test_rating_unknown_content(self, producer):
+        response = self.client.post(self.url, {'content_id': self.content.id + 1, 'rating': 4})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(Rating.objects.exists())
+        producer.send.assert_not_called()
+
+    def test_rating_out_of_range(self, producer):
+        response = self.client.post(self.url, {'content_id': self.content.id, 'rating': 6})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rating_invalid_content_id(self, producer):
+        for content_id in ['abc', 2 ** 63, -2 ** 63 - 1]:
+            response = self.client.post(self.url, {'content_id': content_id, 'rating': 4})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post(self.url, {'content_id': -1, 'rating': 4}).status_code,
+                         status.HTTP_404_NOT_FOUND)
+        producer.send.assert_not_called()
+
+    def test_rating_infinite_numbers(self, producer):
+        # JSON numbers beyond the float range are parsed as infinity
+        for body in ['{"content_id": 1e400, "rating": 4}', f'{{"content_id": {self.content.id}, "rating": 1e400}}']:
+            response = self.client.post(self.url, body, content_type='application/json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, body)
+        producer.send.assert_not_called()
+
+
+@mock.patch('contents.views.rating_producer')
+class ContentBulkRatingViewTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create(username='user')
+        self.client.force_authenticate(self.user)
+        self.contents = [Content.objects.create(title=f'title{i}', text='text') for i in range(3)]
+        Rating.objects.create(content=self.contents[0], user=self.user, rating=1)
+        self.url = reverse('content-rate-bulk')
+
+    def test_bulk_ratings_report_per_item_status(self, producer):
+        missing_id = self.contents[-1].id + 1
+        items = [
+            {'content_id': self.contents[0].id, 'rating': 5},
+            {'content_id': self.contents[1].id, 'rating': 2},
+            {'content_id': self.contents[1].id, 'rating': 3},
+            {'content_id': missing_id, 'rating': 3},
+            {'content_id': self.contents[2].id, 'rating': 9},
+            {'content_id': 'abc'},
+            {'content_id': 2 ** 63, 'rating': 3},
+        ]
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {'ratings': items}, format='json')
+
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            ['updated', 'superseded', 'created', 'not_found', 'invalid', 'invalid', 'invalid'],
+        )
+        self.assertEqual(
+            dict(Rating.objects.values_list('content_id', 'rating')),
+            {self.contents[0].id: 5, self.contents[1].id: 3},
+        )
+        messages = producer.send_many.call_args.args[1]
+        self.assertEqual([value['content_id'] for _, value in messages], [self.contents[0].id, self.contents[1].id])
+
+    def test_bulk_ratings_with_infinite_numbers(self, producer):
+        body = (f'{{"ratings": [{{"content_id": 1e400, "rating": 4}}, {{"content_id": {self.contents[1].id}, "rating": 1e400}}, '
+                f'{{"content_id": {self.contents[2].id}, "rating": 4}}]}}')
+        response = self.client.post(self.url, body, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([result['status'] for result in response.data['results']], ['invalid', 'invalid', 'created'])
+
+    def test_bulk_ratings_require_a_list(self, producer):
+        response = self.client.post(self.url, {'ratings': 'abc'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@mock.patch('contents.views.rating_producer')
+@override_settings(RATE_LIMIT_PER_HOUR=2, RATE_LIMIT_PER_IP_PER_HOUR=0)
+class RatingRateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.users = [User.objects.create(username=f'user{i}') for i in range(2)]
+        self.content = Content.objects.create(title='title', text='text')
+        self.url = reverse('content-rate')
+
+    def rate(self, user, **extra):
+        return self.client.post(self.url, {'content_id': self.content.id, 'rating': 4},
+                                HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}', **extra)
+
+    def rejected(self, scope):
+        return REGISTRY.get_sample_value('rating_requests_rate_limited_total', {'scope': scope}) or 0
+
+    def test_user_over_the_limit_is_rejected_before_any_query(self, producer):
+        for _ in range(2):
+            self.assertEqual(self.rate(self.users[0]).status_code, status.HTTP_200_OK)
+        before = self.rejected('user')
+        with self.assertNumQueries(0):
+            response = self.rate(self.users[0])
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertEqual(self.rejected('user'), before + 1)
+        self.assertEqual(producer.send.call_count, 2)
+        self.assertEqual(self.rate(self.users[1]).status_code, status.HTTP_200_OK)
+
+    @override_settings(RATE_LIMIT_PER_HOUR=0, RATE_LIMIT_PER_IP_PER_HOUR=3)
+    def test_ip_is_limited_across_users(self, producer):
+        for user in [*self.users, self.users[0]]:
+            self.assertEqual(self.rate(user).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.rate(self.users[1]).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.rate(self.users[1], REMOTE_ADDR='10.0.0.2').status_code, status.HTTP_200_OK)
+
+    @override_settings(RATE_LIMIT_PER_HOUR=0, RATE_LIMIT_PER_IP_PER_HOUR=2)
+    def test_spoofed_forwarded_for_does_not_dodge_the_ip_limit(self, producer):
+        # nginx appends the address it saw to whatever the client sent
+        codes = [self.rate(self.users[0], HTTP_X_FORWARDED_FOR=f'203.0.113.{i}, 10.0.0.9').status_code
+                 for i in range(4)]
+        self.assertEqual(codes, [200, 200, 429, 429])
+
+    def test_bulk_ratings_count_every_item(self, producer):
+        items = [{'content_id': self.content.id, 'rating': rating} for rating in range(3)]
+        response = self.client.post(reverse('content-rate-bulk'), {'ratings': items}, format='json',
+                                    HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.users[0])}')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertFalse(Rating.objects.exists())
+
+    @override_settings(BULK_RATING_MAX_ITEMS=3)
+    def test_oversized_bulk_request_is_rejected_without_spending_the_budget(self, producer):
+        items = [{'content_id': self.content.id, 'rating': 4}] * 4
+        response = self.client.post(reverse('content-rate-bulk'), {'ratings': items}, format='json',
+                                    HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.users[0])}')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.rate(self.users[0]).status_code, status.HTTP_200_OK)
+
+    def test_previous_hour_slides_out(self, producer):
+        hour = 3600 * 1000
+        with mock.patch('contents.services.ratelimit.now', return_value=hour - 1):
+            for _ in range(2):
+                self.rate(self.users[0])
+        # Half way through the next hour, the previous one still counts for one rating
+        with mock.patch('contents.services.ratelimit.now', return_value=hour + 1800):
+            self.assertEqual(self.rate(self.users[0]).status_code, status.HTTP_200_OK)
+            response = self.rate(self.users[0])
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1800')
+
+
+@skipUnless(fakeredis and lupa, 'Install fakeredis and lupa to run the Redis limiter script')
+@mock.patch('contents.views.rating_producer')
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://fake'}},
+    RATE_LIMIT_PER_HOUR=2, RATE_LIMIT_PER_IP_PER_HOUR=3,
+)
+class RedisRatingRateLimitTests(TestCase):
+    """The limiter against Redis, where one CHECK_SCRIPT call counts every scope"""
+
+    hour = 3600 * 1000
+
+    def setUp(self):
+        # Every client of the Redis cache talks to the same in-memory server
+        redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        patcher = mock.patch('django.core.cache.backends.redis.RedisCacheClient.get_client',
+                             lambda client, key=None, write=False: redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # The script is registered on the first client it runs on
+        patcher = mock.patch('contents.services.ratelimit.rating_limiter._script', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.redis = redis
+        self.client = APIClient()
+        self.users = [User.objects.create(username=f'user{i}') for i in range(2)]
+        self.content = Content.objects.create(title='title', text='text')
+
+    def rate(self, user, at, **extra):
+        with mock.patch('contents.services.ratelimit.now', return_value=at):
+            return self.client.post(reverse('content-rate'), {'content_id': self.content.id, 'rating': 4},
+                                    HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(user)}', **extra)
+
+    def test_user_window(self, producer):
+        codes = [self.rate(self.users[0], self.hour + 1800).status_code for _ in range(2)]
+        self.assertEqual(codes, [200, 200])
+        response = self.rate(self.users[0], self.hour + 1800)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        # The current hour has to become the previous one and slide half way out
+        self.assertEqual(response['Retry-After'], '3600')
+        self.assertEqual(self.rate(self.users[1], self.hour + 1800).status_code, status.HTTP_200_OK)
+
+        # Half way through the next hour, the previous one still counts for one rating
+        self.assertEqual(self.rate(self.users[0], self.hour + 3600 + 1800).status_code, status.HTTP_200_OK)
+        response = self.rate(self.users[0], self.hour + 3600 + 1800)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '1800')
+        self.assertEqual(producer.send.call_count, 4)
+
+        # Both hours of the first user and the one of the second, counted in Redis itself
+        keys = self.redis.keys('*ratelimit:user:*')
+        self.assertEqual(len(keys), 3)
+        self.assertTrue(all(0 < self.redis.ttl(key) <= 7200 for key in keys))
+
+    def test_ip_window(self, producer):
+        for user in [*self.users, self.users[0]]:
+            self.assertEqual(self.rate(user, self.hour).status_code, status.HTTP_200_OK)
+        response = self.rate(self.users[1], self.hour + 900)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        # Full budget spent in the current hour: it slides out a third of the way into the next
+        self.assertEqual(response['Retry-After'], str(3600 - 900 + 1200))
+        self.assertEqual(self.rate(self.users[1], self.hour + 900, REMOTE_ADDR='10.0.0.2').status_code,
+                         status.HTTP_200_OK)
+
+    def test_rejected_request_is_not_counted_in_any_scope(self, producer):
+        # The IP is over its limit, so the user's own window must stay untouched
+        for user in [self.users[1]] * 2 + [self.users[0]]:
+            self.rate(user, self.hour)
+        self.assertEqual(self.rate(self.users[0], self.hour).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(self.rate(self.users[0], self.hour, REMOTE_ADDR='10.0.0.2').status_code,
+                         status.HTTP_200_OK)
+
+
+@mock.patch('contents.async_views.rating_producer', autospec=True)
+@override_settings(ASYNC_DB_THREADS=0)
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = AsyncRequestFactory()
+        self.user = User.objects.create(username='user')
+        self.auth = {'headers': {'Authorization': f'Bearer {AccessToken.for_user(self.user)}'}}
+        self.content = Content.objects.create(title='title', text='text')
+        Rating.objects.create(content=self.content, user=self.user, rating=3)
+
+    def call(self, view, request, **kwargs):
+        return async_to_sync(view.as_view())(request, **kwargs)
+
+    def test_rating_is_written_and_sent(self, producer):
+        request = self.factory.post(
+            reverse('content-rate'), {'content_id': self.content.id, 'rating': 5},
+            content_type='application/json', **self.auth,
+        )
+        response = self.call(async_views.ContentRatingView, request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['message'], 'Rating updated')
+        self.assertEqual(Rating.objects.get().rating, 5)
+        producer.asend.assert_awaited_once()
+        self.assertEqual(producer.asend.call_args.kwargs['key'], self.content.id)
+
+        request = self.factory.post(reverse('content-rate'), {'content_id': self.content.id + 1, 'rating': 5}, **self.auth)
+        self.assertEqual(self.call(async_views.ContentRatingView, request).status_code, status.HTTP_404_NOT_FOUND)
+        request = self.factory.post(reverse('content-rate'), {'content_id': 2 ** 63, 'rating': 5}, **self.auth)
+        self.assertEqual(self.call(async_views.ContentRatingView, request).status_code, status.HTTP_400_BAD_REQUEST)
+        for body in ['{"content_id": 1e400, "rating": 5}', f'{{"content_id": {self.content.id}, "rating": 1e400}}']:
+            request = self.factory.post(reverse('content-rate'), body, content_type='application/json', **self.auth)
+            self.assertEqual(self.call(async_views.ContentRatingView, request).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_rating_requires_a_valid_token(self, producer):
+        request = self.factory.post(reverse('content-rate'), {'content_id': self.content.id, 'rating': 5})
+        self.assertEqual(self.call(async_views.ContentRatingView, request).status_code, status.HTTP_401_UNAUTHORIZED)
+        request = self.factory.post(reverse('content-rate'), {'content_id': self.content.id, 'rating': 5},
+                                    headers={'Authorization': 'Bearer abc'})
+        response = self.call(async_views.ContentRatingView, request)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(json.loads(response.content)['code'], 'token_not_valid')
+        producer.asend.assert_not_called()
+
+    @override_settings(RATE_LIMIT_PER_HOUR=1)
+    def test_rating_is_rate_limited(self, producer):
+        for expected in (status.HTTP_200_OK, status.HTTP_429_TOO_MANY_REQUESTS):
+            request = self.factory.post(reverse('content-rate'), {'content_id': self.content.id, 'rating': 5},
+                                        content_type='application/json', **self.auth)
+            response = self.call(async_views.ContentRatingView, request)
+            self.assertEqual(response.status_code, expected)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        producer.asend.assert_awaited_once()
+
+    def test_read_responses_match_the_sync_views(self, producer):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=self.auth['headers']['Authorization'])
+        for url, view, kwargs in [
+            (reverse('content-list') + '?sort_by=rating_count', async_views.ContentListView, {}),
+            (reverse('content-detail', args=[self.content.id]), async_views.ContentDetailView,
+             {'content_id': self.content.id}),
+        ]:
+            expected = client.get(url)
+            response = self.call(view, self.factory.get(url, **self.auth), **kwargs)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(json.loads(response.content), json.loads(expected.content))
+            self.assertEqual(response['ETag'], expected['ETag'])
+
+            headers = {**self.auth['headers'], 'If-None-Match': response['ETag']}
+            response = self.call(view, self.factory.get(url, headers=headers), **kwargs)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_own_rating_changes_the_etags(self, producer):
+        url = reverse('content-detail', args=[self.content.id])
+        etag = self.call(async_views.ContentDetailView, self.factory.get(url, **self.auth),
+                         content_id=self.content.id)['ETag']
+        request = self.factory.post(reverse('content-rate'), {'content_id': self.content.id, 'rating': 1},
+                                    content_type='application/json', **self.auth)
+        self.call(async_views.ContentRatingView, request)
+
+        headers = {**self.auth['headers'], 'If-None-Match': etag}
+        response = self.call(async_views.ContentDetailView, self.factory.get(url, headers=headers),
+                             content_id=self.content.id)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content)['user_rating'], 1)
+
+    def test_missing_detail(self, producer):
+        request = self.factory.get(reverse('content-detail', args=[self.content.id + 1]))
+        response = self.call(async_views.ContentDetailView, request, content_id=self.content.id + 1)
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(ASYNC_DB_THREADS=1)
+class DatabaseThreadsTests(TransactionTestCase):
+    def test_calls_share_a_persistent_connection(self):
+        Content.objects.create(title='title', text='text')
+
+        def query():
+            return Content.objects.count(), connection.connection
+
+        with mock.patch.dict('content_rating.database._executors', clear=True):
+            try:
+                count, first = async_to_sync(database_sync_to_async(query))()
+                self.assertEqual(count, 1)
+                self.assertIs(async_to_sync(database_sync_to_async(query))()[1], first)
+            finally:
+                get_executor().submit(connections.close_all).result()
+                get_executor().shutdown()
+
+
+class ContentCursorPaginationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        # Plenty of ties on every sort field so the id tie-breaker matters
+        for i in range(25):
+            Content.objects.create(title=f'title{i}', text='text', rating_count=i % 3, average_rating=(i % 4) / 2)
+        self.url = reverse('content-list')
+
+    def walk(self, url, link):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids.append([item['id'] for item in response.data['results']])
+            url = response.data[link]
+        return ids
+
+    def test_pages_follow_the_list_order_in_both_directions(self):
+        for sort_by, field in [('created_at', 'created_at'), ('rating_count', 'rating_count'),
+                               ('rating_average', 'average_rating')]:
+            for order, prefix in [('desc', '-'), ('asc', '')]:
+                expected = list(Content.objects.order_by(f'{prefix}{field}', f'{prefix}id').values_list('id', flat=True))
+                url = f'{self.url}?pagination=cursor&page_size=7&sort_by={sort_by}&order={order}'
+
+                pages = self.walk(url, 'next')
+                self.assertEqual(sum(pages, []), expected, (sort_by, order))
+                self.assertEqual([len(page) for page in pages], [7, 7, 7, 4])
+
+                # Walk back from the last page
+                last = self.client.get(url)
+                while last.data['next']:
+                    last = self.client.get(last.data['next'])
+                back = self.walk(last.data['previous'], 'previous')
+                self.assertEqual(back, pages[-2::-1])
+
+    def test_cursor_page_does_not_count(self):
+        with self.assertNumQueries(1):
+            self.client.get(f'{self.url}?pagination=cursor')
+
+    def test_invalid_cursor(self):
+        response = self.client.get(f'{self.url}?cursor=abc')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class ContentListFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.url = reverse('content-list')
+        self.contents = [
+            Content.objects.create(title=f'title{i}', text='text', rating_count=i, average_rating=i / 2)
+            for i in range(6)
+        ]
+        Content.objects.filter(id=self.contents[0].id).update(created_at=timezone.now() - timedelta(days=30))
+
+    def listed(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data['results']]
+
+    def test_filters_combine_with_the_sort(self):
+        ids = [content.id for content in self.contents]
+        self.assertEqual(self.listed(min_rating=1, max_rating=2, sort_by='rating_count', order='asc'), ids[2:5])
+        self.assertEqual(self.listed(min_count=4, sort_by='rating_average'), [ids[5], ids[4]])
+        created_after = (timezone.now() - timedelta(days=1)).date().isoformat()
+        self.assertEqual(self.listed(created_after=created_after, max_rating=1, order='asc'), ids[1:3])
+        self.assertEqual(self.listed(created_before=created_after, pagination='cursor'), ids[:1])
+        self.assertEqual(self.client.get(self.url, {'min_count': 'many'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_no_combination_scans_the_table(self):
+        with connection.cursor() as cursor:
+            # Only leaves a sequential scan to queries that no index can serve, and compares
+            # index scans with index-only ones rather than with bitmap heap scans
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('SET LOCAL enable_bitmapscan = off')
+        for query, sql, plan in list_query_plans(self.client, self.url):
+            self.assertNotIn('Seq Scan', plan, f'{query}\n{plan}')
+            if sql.startswith('SELECT COUNT(*)'):
+                # The filter columns are included in the sort indexes, so the
+                # page counts never read the table
+                self.assertIn('Index Only Scan', plan, f'{query}\n{plan}')
+
+
+def list_query_plans(client, url):
+    """(query, sql, plan) of every query the content list runs, for each filter, sort and pagination"""
+    filters = {
+        'rating': {'min_rating': 1, 'max_rating': 4},
+        'count': {'min_count': 2},
+        'created': {'created_after': '2020-01-01', 'created_before': '2100-01-01T00:00:00Z'},
+    }
+    combinations = [
+        {key: value for name in names for key, value in filters[name].items()}
+        for size in range(len(filters) + 1) for names in itertools.combinations(filters, size)
+    ]
+    for params in combinations:
+        for sort_by in ('created_at', 'rating_count', 'rating_average'):
+            for order in ('desc', 'asc'):
+                for pagination in ('page', 'cursor'):
+                    query = {**params, 'sort_by': sort_by, 'order': order, 'pagination': pagination}
+                    with CaptureQueriesContext(connection) as queries:
+                        assert client.get(url, query).status_code == status.HTTP_200_OK
+                    for captured in queries.captured_queries:
+                        with connection.cursor() as cursor:
+                            cursor.execute(f"EXPLAIN {captured['sql']}")
+                            plan = '\n'.join(row[0] for row in cursor.fetchall())
+                        yield query, captured['sql'], plan
+
+
+class ContentListPlanTests(TransactionTestCase):
+    """The content list plans with default planner settings, on a vacuumed and analyzed table"""
+
+    def setUp(self):
+        cache.clear()
+        table = Content._meta.db_table
+        with connection.cursor() as cursor:
+            # Long-tailed rating counts, titles and texts of a realistic width
+            cursor.execute('SELECT setseed(0.5)')
+            cursor.execute(f"""
+                INSERT INTO {table} (title, text, created_at, rating_count, average_rating,
+                                     weighted_sum, weight_sum)
+                SELECT left(repeat(md5(n::text), 2), 60), repeat(md5(n::text) || ' ', 40),
+                       now() - random() * interval '3 years', floor(power(random(), 4) * 1000),
+                       round((random() * 5)::numeric, 2), 0, 0
+                FROM generate_series(1, 20000) AS n
+            """)
+            # VACUUM sets the visibility map, as autovacuum does, which index-only scans rely on
+            cursor.execute(f'VACUUM ANALYZE {table}')
+
+    def test_every_combination_uses_an_index(self):
+        for query, sql, plan in list_query_plans(APIClient(), reverse('content-list')):
+            self.assertNotIn('Seq Scan', plan, f'{query}\n{plan}')
+            if sql.startswith('SELECT COUNT(*)'):
+                self.assertIn('Index Only Scan', plan, f'{query}\n{plan}')
+            else:
+                self.assertRegex(plan, r'Index (Only )?Scan', f'{query}\n{plan}')
+
+class ContentSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.url = reverse('content-search')
+
+    def search(self, query):
+        response = self.client.get(self.url, {'q': query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data['results']]
+
+    def test_title_matches_rank_first_and_vectors_follow_writes(self):
+        in_text = Content.objects.create(title='Tuning', text='Indexes for Postgres databases')
+        in_title = Content.objects.create(title='Postgres internals', text='Pages and tuples')
+        Content.objects.create(title='Cooking', text='Recipes')
+        self.assertEqual(self.search('postgres'), [in_title.id, in_text.id])
+        self.assertEqual(self.search('"postgres databases"'), [in_text.id])
+
+        in_text.title = 'Cooking with Postgres'
+        in_text.save()
+        cache.clear()
+        self.assertEqual(self.search('cooking -recipes'), [in_text.id])
+
+    def test_ranking_blends_in_the_score(self):
+        contents = [Content.objects.create(title='Django', text='Views and models') for _ in range(3)]
+        Content.objects.filter(id=contents[1].id).update(weighted_sum=50, weight_sum=10)  # Scores 4.2
+        Content.objects.filter(id=contents[2].id).update(weighted_sum=0, weight_sum=10)  # Scores 0.8
+        self.assertEqual(self.search('django'), [contents[1].id, contents[0].id, contents[2].id])
+
+    def test_pages_follow_the_rank(self):
+        for i in range(1, 8):
+            Content.objects.create(title='Kafka' if i % 2 else 'Streams', text='Kafka consumers ' * i)
+        expected = list(search_contents('kafka').values_list('id', flat=True))
+        self.assertEqual(len(expected), 7)
+
+        ids, url = [], f'{self.url}?q=kafka&page_size=3'
+        while url:
+            response = self.client.get(url)
+            ids.extend(item['id'] for item in response.data['results'])
+            url = response.data['next']
+        self.assertEqual(ids, expected)
+
+    def test_matches_are_found_with_the_gin_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        self.assertIn('content_search_idx', search_contents('kafka').explain())
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ContentCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.content = Content.objects.create(title='title', text='text')
+        self.user = User.objects.create(username='user')
+        with mock.patch('contents.services.transport.KafkaConsumer'):
+            self.processor = RatingProcessor()
+
+    def test_detail_is_served_from_cache_until_processed(self):
+        url = reverse('content-detail', args=[self.content.id])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data['rating_count'], 0)
+
+        Rating.objects.create(content=self.content, user=self.user, rating=4)
+        self.processor.process_ratings_batch(self.content.id)
+        response = self.client.get(url)
+        self.assertEqual((response.data['rating_count'], response.data['average_rating']), (1, 4.0))
+
+    def test_list_page_is_served_from_cache_until_generation_changes(self):
+        url = reverse('content-list') + '?sort_by=rating_count'
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.data['count'], 1)
+
+        Content.objects.create(title='other', text='text')
+        ContentCache().lists_changed()
+        self.assertEqual(self.client.get(url).data['count'], 2)
+
+    def test_missing_detail_is_not_cached(self):
+        url = reverse('content-detail', args=[self.content.id + 1])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        Content.objects.create(id=self.content.id + 1, title='late', text='text')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+    def test_conditional_detail_request(self):
+        url = reverse('content-detail', args=[self.content.id])
+        etag = self.client.get(url)['ETag']
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+        Rating.objects.create(content=self.content, user=self.user, rating=4)
+        self.processor.process_ratings_batch(self.content.id)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etags_expire_with_the_cache_timeout(self):
+        # Bumps from the processor do not reach a local-memory cache, the counters expire instead
+        url = reverse('content-detail', args=[self.content.id])
+        etag = self.client.get(url)['ETag']
+        later = timezone.now().timestamp() + settings.CONTENT_CACHE_TIMEOUT + 1
+        with mock.patch('django.core.cache.backends.locmem.time', mock.Mock(time=lambda: later)):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @mock.patch('contents.views.rating_producer')
+    def test_own_rating_changes_the_authenticated_etags(self, producer):
+        self.client.force_authenticate(self.user)
+        detail_url = reverse('content-detail', args=[self.content.id])
+        list_url = reverse('content-list')
+        detail_etag = self.client.get(detail_url)['ETag']
+        list_etag = self.client.get(list_url)['ETag']
+        self.assertEqual(self.client.get(detail_url, HTTP_IF_NONE_MATCH=detail_etag).status_code,
+                         status.HTTP_304_NOT_MODIFIED)
+
+        self.client.post(reverse('content-rate'), {'content_id': self.content.id, 'rating': 4})
+        response = self.client.get(detail_url, HTTP_IF_NONE_MATCH=detail_etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['user_rating'], 4)
+        self.assertEqual(self.client.get(list_url, HTTP_IF_NONE_MATCH=list_etag).status_code, status.HTTP_200_OK)
+
+        etag = response['ETag']
+        self.client.post(reverse('content-rate-bulk'), {'ratings': [{'content_id': self.content.id, 'rating': 2}]},
+                         format='json')
+        self.assertEqual(self.client.get(detail_url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_conditional_list_request(self):
+        url = reverse('content-list')
+        etag = self.client.get(url)['ETag']
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(self.client.get(url + '?order=asc', HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+        ContentCache().lists_changed()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_200_OK)
+
+    def test_concurrent_miss_waits_for_the_loading_caller(self):
+        content_cache = ContentCache()
+        version = content_cache._get_counter(content_cache.version_key(self.content.id))
+        key = f'content:{self.content.id}:v{version}'
+        cache.add(f'{key}:lock', 1)  # Another caller is loading
+
+        load = mock.Mock()
+        with mock.patch('contents.services.cache.time.sleep', side_effect=lambda _: cache.set(key, {'id': 1})):
+            self.assertEqual(content_cache.get_detail(self.content.id, load), {'id': 1})
+        load.assert_not_called()
+
+
+@override_settings(LEADERBOARD_SIZE=2)
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with mock.patch('contents.services.transport.KafkaConsumer'):
+            self.processor = RatingProcessor()
+        self.users = [User.objects.create(username=f'user{i}') for i in range(3)]
+        self.contents = [Content.objects.create(title=f'title{i}', text='text') for i in range(6)]
+        self.url = reverse('content-top')
+
+    def rate(self, content, *values):
+        for user, value in zip(self.users, values):
+            Rating.objects.update_or_create(content=content, user=user, defaults={'rating': value, 'processed': False})
+        self.processor.process_ratings_batch(content.id)
+
+    def expected(self, board):
+        return [item['id'] for _, item in Leaderboard().load(board)['items'][:2]]
+
+    def served(self, board):
+        return [item['id'] for item in self.client.get(f'{self.url}?by={board}&limit=2').data['results']]
+
+    def test_boards_follow_the_processed_ratings(self):
+        for board in BOARDS:
+            self.served(board)  # Built from the database
+        for content, values in zip(self.contents, [(5,), (4, 4, 4), (1, 2), (5, 5), (0,), (4, 4, 4)]):
+            self.rate(content, *values)
+        self.rate(self.contents[1], 0, 0, 0)  # Falls off every board
+
+        for board in BOARDS:
+            with self.assertNumQueries(0):
+                served = self.served(board)
+            self.assertEqual(served, self.expected(board), board)
+        self.assertEqual(self.served('rating_average'), [self.contents[3].id, self.contents[0].id])
+        self.assertEqual(self.served('score'), [self.contents[3].id, self.contents[5].id])
+
+    def test_board_is_rebuilt_once_too_short(self):
+        for content, values in zip(self.contents, [(5,), (4,), (3,), (2,)]):
+            self.rate(content, *values)
+        self.served('rating_average')
+        for content in self.contents[:3]:
+            self.rate(content, 0)
+        self.assertIsNone(cache.get(Leaderboard().key('rating_average')))
+        self.assertEqual(self.served('rating_average'), self.expected('rating_average'))
+
+    def test_reconcile_corrects_drift(self):
+        self.served('rating_count')
+        Content.objects.filter(id=self.contents[0].id).update(rating_count=10)  # Behind the processor's back
+        self.assertNotIn(self.contents[0].id, self.served('rating_count'))
+        self.assertEqual(Leaderboard().reconcile()['rating_count'], 1)
+        self.assertEqual(self.served('rating_count')[0], self.contents[0].id)
+
+    def test_results_match_the_list_items(self):
+        response = self.client.get(f'{self.url}?by=rating_count&limit=1')
+        listed = self.client.get(reverse('content-list') + '?sort_by=rating_count')
+        self.assertEqual(response.data['results'], listed.data['results'][:1])
+        self.assertEqual(self.client.get(f'{self.url}?by=title').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get(f'{self.url}?limit=3').status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class RatingRollupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        with mock.patch('contents.services.transport.KafkaConsumer'):
+            self.processor = RatingProcessor()
+        self.users = [User.objects.create(username=f'user{i}') for i in range(3)]
+        self.content = Content.objects.create(title='title', text='text')
+        self.now = timezone.now()
+
+    def rate(self, hours_ago, *values):
+        for user, value in zip(self.users, values):
+            if value is not None:
+                Rating.objects.update_or_create(content=self.content, user=user,
+                                                defaults={'rating': value, 'processed': False})
+        Rating.objects.filter(content=self.content, processed=False).update(
+            updated_at=self.now - timedelta(hours=hours_ago))
+        self.processor.process_ratings_batch(self.content.id)
+
+    def totals(self):
+        rollups = list(RatingRollup.objects.filter(content=self.content))
+        return {field: sum(getattr(rollup, field) for rollup in rollups) for field in RatingRollup.SUM_FIELDS}
+
+    def test_rollups_sum_up_to_the_aggregates(self):
+        self.rate(3, 5, 4)
+        self.rate(1, None, 1, 2)  # A re-rate and a new rating, two hours later
+        self.content.refresh_from_db()
+
+        totals = self.totals()
+        self.assertEqual([totals[f'count_{star}'] for star in RatingRollup.STARS], [0, 1, 1, 0, 0, 1])
+        self.assertEqual(totals['votes'], 4)
+        self.assertEqual(sum(totals[f'count_{star}'] for star in RatingRollup.STARS), self.content.rating_count)
+        self.assertAlmostEqual(totals['weighted_sum'], self.content.weighted_sum)
+        self.assertAlmostEqual(totals['weight_sum'], self.content.weight_sum)
+        self.assertEqual(RatingRollup.objects.filter(content=self.content).count(), 2)
+
+    def test_stats_endpoint(self):
+        self.rate(3, 5, 4)
+        self.rate(1, None, 1, 2)
+        url = reverse('content-stats', args=[self.content.id])
+
+        response = self.client.get(f'{url}?hours=24')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['histogram'], {'0': 0, '1': 1, '2': 1, '3': 0, '4': 0, '5': 1})
+        self.assertEqual(response.data['rating_count'], 3)
+        self.assertAlmostEqual(response.data['average_rating'], 8 / 3)
+        series = response.data['series']
+        self.assertEqual([point['votes'] for point in series], [2, 2])
+        self.assertEqual([point['rating_count'] for point in series], [2, 3])
+        self.assertAlmostEqual(series[0]['average_rating'], 4.5)
+        self.assertAlmostEqual(series[1]['average_rating'], 8 / 3)
+
+        # The window only covers the last hours, the histogram still covers everything
+        self.assertEqual(len(self.client.get(f'{url}?hours=2').data['series']), 1)
+        self.assertEqual(self.client.get(f'{url}?hours=0').status_code, status.HTTP_400_BAD_REQUEST)
+        missing = reverse('content-stats', args=[self.content.id + 1])
+        self.assertEqual(self.client.get(missing).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_backfill_matches_the_processor(self):
+        self.rate(3, 5, 4)
+        self.rate(1, 3, None, 2)
+        expected = self.totals()
+        RatingRollup.objects.all().delete()
+
+        call_command('backfill_rating_rollups', chunk_size=1, stdout=StringIO())
+        totals = self.totals()
+        self.assertEqual({field: value for field, value in totals.items() if field != 'votes'},
+                         {field: value for field, value in expected.items() if field != 'votes'})
+        self.assertEqual(totals['votes'], 3)  # The re-rated value is all that is left of a re-rate
+
+
+class UserRatingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create(username='user')
+        self.contents = [Content.objects.create(title=f'title{i}', text='text') for i in range(30)]
+        for content in self.contents[::2]:
+            Rating.objects.create(content=content, user=self.user, rating=content.id % 6)
+
+    def test_list_includes_own_ratings_with_constant_queries(self):
+        self.client.force_authenticate(self.user)
+        url = reverse('content-list')
+        for page_size in (5, 25):
+            cache.clear()
+            with self.assertNumQueries(3):  # Count, page and the caller's ratings
+                response = self.client.get(f'{url}?page_size={page_size}')
+            with self.assertNumQueries(1):  # Cached page, only the caller's ratings
+                self.client.get(f'{url}?page_size={page_size}')
+
+            expected = dict(Rating.objects.values_list('content_id', 'rating'))
+            for item in response.data['results']:
+                self.assertEqual(item['user_rating'], expected.get(item['id']))
+
+    def test_detail_includes_own_rating(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get(reverse('content-detail', args=[self.contents[0].id]))
+        self.assertEqual(response.data['user_rating'], self.contents[0].id % 6)
+
+    def test_anonymous_requests_skip_the_lookup(self):
+        url = reverse('content-list')
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertTrue(all(item['user_rating'] is None for item in response.data['results']))
+
+
+@override_settings(DATABASE_REPLICAS=['replica_0'])
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.replicas = ReplicaSet()
+        self.lag = mock.patch.object(ReplicaSet, 'lag', return_value=0.1)
+        self.lag.start()
+        self.addCleanup(self.lag.stop)
+
+    def read_alias(self, *scopes):
+        with self.replicas.reads(*scopes):
+            return router.db_for_read(Content)
+
+    def test_reads_go_to_a_replica_writes_to_the_primary(self):
+        self.assertEqual(self.read_alias('user:1'), 'replica_0')
+        with self.replicas.reads():
+            self.assertEqual(router.db_for_write(Content), 'default')
+        self.assertEqual(router.db_for_read(Content), 'default')  # Outside of a replica block
+
+    def test_pinned_scopes_read_from_the_primary(self):
+        self.replicas.pin('user:1')
+        self.assertEqual(self.read_alias('user:1'), 'default')
+        self.assertEqual(self.read_alias('user:2'), 'replica_0')
+        with self.replicas.reads('user:1'):
+            self.assertEqual(self.read_alias('content:1'), 'default')  # Never back to a replica
+
+    def test_lagging_replicas_are_skipped(self):
+        with override_settings(REPLICA_MAX_LAG_SECONDS=0.05):
+            self.assertEqual(self.read_alias(), 'default')
+        ReplicaSet.lag.return_value = None  # Unreachable
+        self.assertEqual(self.read_alias(), 'default')
+
+    def test_transactions_read_from_the_primary(self):
+        with mock.patch.object(connections['default'], 'in_atomic_block', True):
+            self.assertEqual(self.read_alias(), 'default')
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_no_replicas_no_pins(self):
+        self.replicas.pin('user:1')
+        self.assertEqual(self.read_alias('user:1'), 'default')
+        self.assertFalse(self.replicas.is_pinned('user:1'))
+
+
+@override_settings(DATABASE_REPLICAS=['replica_0'])
+class ReplicaPinningTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_writes_pin_the_writer_and_changed_contents(self):
+        user = User.objects.create(username='user')
+        content = Content.objects.create(title='title', text='text')
+        client = APIClient()
+        client.force_authenticate(user)
+        with mock.patch('contents.views.rating_producer'):
+            client.post(reverse('content-rate'), {'content_id': content.id, 'rating': 4}, format='json')
+        self.assertTrue(replicas.is_pinned(f'user:{user.id}'))
+        self.assertFalse(replicas.is_pinned(f'content:{content.id}'))
+
+        ContentCache().contents_changed([content.id])
+        self.assertTrue(replicas.is_pinned(f'content:{content.id}'))
+        self.assertTrue(replicas.is_pinned('contents:list'))
+
+
+@skipUnless(settings.DATABASE_REPLICAS, 'Set DATABASE_REPLICA_HOSTS to run against a replica')
+class ReplicaReadTests(TransactionTestCase):
+    databases = {'default', *settings.DATABASE_REPLICAS}
+
+    def setUp(self):
+        cache.clear()
+        self.replica = connections[settings.DATABASE_REPLICAS[0]]
+        self.content = Content.objects.create(title='title', text='text')
+
+    def test_detail_is_read_from_the_replica_until_changed(self):
+        url = reverse('content-detail', args=[self.content.id])
+        with CaptureQueriesContext(self.replica) as queries:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertTrue(any('contents_content' in query['sql'] for query in queries))
+
+        ContentCache().contents_changed([self.content.id])
+        with CaptureQueriesContext(self.replica) as queries:
+            self.client.get(url)
+        self.assertFalse(any('contents_content' in query['sql'] for query in queries))
+
+
+class LeanListSerializationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        titles = ['plain', 'ünïcødé \u2028 line \u2029 sep', 'quote " back \\ slash', 'ctrl \x01 \t tab', '']
+        for i, title in enumerate(titles):
+            Content.objects.create(title=title, text='text', rating_count=i * 1000, average_rating=i / 3)
+
+    def test_lean_rows_render_identically_to_model_serializer(self):
+        contents = Content.objects.order_by('id')
+        expected = JSONRenderer().render({'results': ContentSerializer(contents, many=True).data, 'count': 5})
+        rendered = FastJSONRenderer().render({'results': serialize_content_rows(contents.values(*CONTENT_LIST_VALUES)), 'count': 5})
+        self.assertEqual(rendered, expected)
+
+    def test_floats_render_identically(self):
+        for value in [9.999000099990002e-05, 1e16, -2.5e-7, 1e-4, 0.0, -0.0, 4.25, 123456789012345.6]:
+            for data in [{'results': [{'average_rating': value}]}, {value: 1}, value]:
+                self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data), value)
+        for value in [float('nan'), float('inf')]:
+            self.assertRaises(ValueError, FastJSONRenderer().render, {'average_rating': value})
+
+    def test_list_response_matches_model_serializer(self):
+        response = APIClient().get(reverse('content-list') + '?order=asc')
+        contents = Content.objects.order_by('created_at', 'id')
+        expected = JSONRenderer().render({**response.data, 'results': ContentSerializer(contents, many=True).data})
+        self.assertEqual(response.content, expected)
+
+
+class RatingProcessorTests(TestCase):
+    def setUp(self):
+        with mock.patch('contents.services.transport.KafkaConsumer'):
+            self.processor = RatingProcessor()
+        self.content = Content.objects.create(title='title', text='text')
+        self.users = [User.objects.create(username=f'user{i}') for i in range(4)]
+
+    def rate(self, user, value):
+        rating, _ = Rating.objects.update_or_create(
+            content=self.content, user=user,
+            defaults={'rating': value, 'processed': False},
+        )
+        return rating
+
+    def test_new_ratings_are_added_to_running_aggregates(self):
+        self.rate(self.users[0], 4)
+        self.rate(self.users[1], 2)
+        self.processor.process_ratings_batch(self.content.id)
+
+        self.content.refresh_from_db()
+        self.assertEqual(self.content.rating_count, 2)
+        self.assertAlmostEqual(self.content.weighted_sum, 6.0)
+        self.assertAlmostEqual(self.content.weight_sum, 2.0)
+        self.assertAlmostEqual(self.content.average_rating, 3.0)
+        self.assertFalse(Rating.objects.filter(processed=False).exists())
+
+    def test_updated_rating_replaces_previous_value(self):
+        self.rate(self.users[0], 4)
+        self.rate(self.users[1], 2)
+        self.processor.process_ratings_batch(self.content.id)
+
+        self.rate(self.users[0], 0)
+        self.processor.process_ratings_batch(self.content.id)
+
+        self.content.refresh_from_db()
+        self.assertEqual(self.content.rating_count, 2)
+        self.assertAlmostEqual(self.content.average_rating, 1.0)
+        self.assertEqual(find_aggregate_drift([self.content]), [])
+
+    def test_anomalous_rating_is_penalized_in_place(self):
+        with mock.patch.object(RatingProcessor, 'check_rating_anomaly', return_value=True):
+            self.rate(self.users[0], 5)
+            self.processor.process_ratings_batch(self.content.id)
+        self.rate(self.users[1], 1)
+        self.processor.process_ratings_batch(self.content.id)
+
+        self.content.refresh_from_db()
+        penalty = settings.ANOMALY_WEIGHT_PENALTY
+        self.assertAlmostEqual(self.content.weight_sum, 1 + penalty)
+        self.assertAlmostEqual(self.content.average_rating, (1 + 5 * penalty) / (1 + penalty))
+        self.assertEqual(find_aggregate_drift([self.content]), [])
+
+    def test_drift_is_detected(self):
+        self.rate(self.users[0], 3)
+        self.processor.process_ratings_batch(self.content.id)
+        Content.objects.filter(id=self.content.id).update(weighted_sum=100)
+
+        self.content.refresh_from_db()
+        drift = find_aggregate_drift([self.content])
+        self.assertEqual([(field, expected) for _, field, _, expected in drift], [('weighted_sum', 3.0)])
+
+    def test_polled_batch_is_coalesced_per_content(self):
+        other = Content.objects.create(title='other', text='text')
+        for user in self.users:
+            self.rate(user, 5)
+        Rating.objects.create(content=other, user=self.users[0], rating=1)
+
+        messages = [SimpleNamespace(value={'content_id': self.content.id}) for _ in self.users]
+        messages.append(SimpleNamespace(value={'content_id': other.id}))
+        self.processor.consumer.poll.side_effect = [{'ratings-0': messages}, KeyboardInterrupt]
+
+        with mock.patch.object(self.processor, 'process_contents',
+                               wraps=self.processor.process_contents) as process_contents:
+            with self.assertRaises(KeyboardInterrupt):
+                self.processor.run()
+
+        process_contents.assert_called_once_with({self.content.id, other.id})
+        self.processor.consumer.commit.assert_called_once()
+        self.content.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.content.rating_count, self.content.average_rating), (4, 5.0))
+        self.assertEqual((other.rating_count, other.average_rating), (1, 1.0))
+
+    def test_failed_write_leaves_the_offsets_uncommitted(self):
+        self.rate(self.users[0], 3)
+        messages = [SimpleNamespace(value={'content_id': self.content.id})]
+        self.processor.consumer.poll.return_value = {'ratings-0': messages}
+
+        with mock.patch.object(self.processor, 'process_contents', side_effect=OperationalError('connection lost')):
+            with self.assertRaises(OperationalError):
+                self.processor.poll_once()
+
+        self.processor.consumer.commit.assert_not_called()
+        self.assertTrue(Rating.objects.filter(content=self.content, processed=False).exists())
+
+        # The batch is polled again once the connection is back
+        self.processor.poll_once()
+        self.processor.consumer.commit.assert_called_once()
+        self.assertFalse(Rating.objects.filter(content=self.content, processed=False).exists())
+
+    def test_revoked_partitions_are_committed_and_windows_dropped(self):
+        self.rate(self.users[0], 3)
+        self.processor.process_ratings_batch(self.content.id)
+        self.assertIn(self.content.id, self.processor.anomaly_detector.windows)
+
+        listener = RatingRebalanceListener(self.processor)
+        listener.on_partitions_revoked([TopicPartition('ratings', 0)])
+
+        self.processor.consumer.commit.assert_called_once()
+        self.assertEqual(self.processor.anomaly_detector.windows, {})
+
+
+@mock.patch('contents.services.producer.threading.Thread')
+@mock.patch('contents.services.transport.KafkaProducer')
+class RatingProducerTests(TestCase):
+    def test_messages_are_spooled_until_connected(self, kafka_producer, thread):
+        producer = RatingProducer()
+        producer.send('ratings', {'content_id': 1}, key=1)
+        producer.send('ratings', {'content_id': 2}, key=2)
+        thread.return_value.start.assert_called_once()  # Connecting in the background
+        kafka_producer.return_value.send.assert_not_called()
+
+        producer._connect()
+        producer.send('ratings', {'content_id': 3}, key=3)
+
+        kafka_producer.assert_called_once()
+        sent = [call.kwargs['value']['content_id'] for call in kafka_producer.return_value.send.call_args_list]
+        self.assertEqual(sent, [1, 2, 3])
+
+    def test_producer_is_recreated_after_fork(self, kafka_producer, thread):
+        producer = RatingProducer()
+        producer.send('ratings', {'content_id': 1})
+        producer._connect()
+        parent = producer._producer
+
+        producer._pid = -1  # Simulate running in a forked child
+        producer.send('ratings', {'content_id': 2})
+
+        self.assertIsNone(producer._producer)
+        self.assertEqual(thread.return_value.start.call_count, 2)
+        parent.close.assert_not_called()
+
+    def test_failed_delivery_is_spooled(self, kafka_producer, thread):
+        producer = RatingProducer()
+        producer.send('ratings', {'content_id': 1})
+        producer._connect()
+        producer.send('ratings', {'content_id': 2})
+
+        future = kafka_producer.return_value.send.return_value
+        errback, *args = future.add_errback.call_args.args
+        errback(*args, Exception('broker down'))
+        self.assertEqual(list(producer._spool), [('ratings', {'content_id': 2}, None)])
+
+    @override_settings(RATING_SPOOL_MAX_SIZE=2)
+    def test_spool_is_bounded(self, kafka_producer, thread):
+        producer = RatingProducer()
+        for content_id in range(5):
+            producer.send('ratings', {'content_id': content_id})
+        self.assertEqual([value['content_id'] for _, value, _ in producer._spool], [3, 4])
+
+
+class EmbeddedTransportTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.broker = InMemoryBroker(track_latency=True)
+        self.transport = EmbeddedTransport(self.broker, run_processor=False)
+        self.content = Content.objects.create(title='title', text='text')
+        self.user = User.objects.create(username='user')
+
+    @mock.patch('contents.services.producer.threading.Thread')
+    def test_rating_flows_from_producer_to_processor(self, thread):
+        Rating.objects.upsert(self.content.id, self.user.id, 4)
+        producer = RatingProducer(transport=self.transport)
+        producer.send('ratings', {'content_id': self.content.id, 'rating': 4}, key=self.content.id)
+        producer._connect()  # Connect synchronously, replaying the spooled message
+        self.assertEqual(self.broker.pending('ratings', 'rating_processor_group'), 1)
+
+        processor = RatingProcessor(max_wait_ms=10, transport=self.transport)
+        self.assertEqual(processor.poll_once(), 1)
+        self.assertEqual(processor.poll_once(), 0)
+
+        self.content.refresh_from_db()
+        self.assertEqual(self.content.rating_count, 1)
+        self.assertEqual(self.broker.pending('ratings', 'rating_processor_group'), 0)
+        self.assertEqual(len(self.broker.commit_latencies), 1)
+
+    def test_uncommitted_records_are_redelivered_and_committed_ones_released(self):
+        producer = self.transport.producer()
+        for content_id in range(3):
+            producer.send('ratings', {'content_id': content_id}, key=b'1')
+        consumer = self.transport.consumer(group_id='group')
+        consumer.subscribe(['ratings'])
+        self.assertEqual(sum(len(records) for records in consumer.poll(max_records=2).values()), 2)
+        consumer.close(autocommit=False)
+
+        consumer = self.transport.consumer(group_id='group')
+        consumer.subscribe(['ratings'])
+        batch = consumer.poll(max_records=10)
+        self.assertEqual([record.value['content_id'] for records in batch.values() for record in records], [0, 1, 2])
+        consumer.commit()
+        self.assertEqual(self.broker.pending('ratings', 'group'), 0)
+        self.assertEqual(sum(len(log) for log in self.broker.logs.values()), 0)
+
+    def test_processor_reports_metrics(self):
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        before = {
+            'messages': sample('rating_processor_messages_total'),
+            'batches': sample('rating_processor_batch_size_count'),
+            'db_write': sample('rating_processor_stage_seconds_count', stage='db_write'),
+            'penalties': sample('rating_processor_anomaly_penalties_total'),
+        }
+        producer = self.transport.producer(value_serializer=lambda m: json.dumps(m).encode('utf-8'))
+        users = [self.user] + [User.objects.create(username=f'user{i}') for i in range(2)]
+        for user in users:
+            Rating.objects.upsert(self.content.id, user.id, 5)
+            producer.send('ratings', {'content_id': self.content.id}, key=b'1')
+
+        processor = RatingProcessor(max_records=2, max_wait_ms=10, transport=self.transport)
+        with mock.patch.object(processor.anomaly_detector, 'is_anomalous', return_value=True):
+            processor.poll_once()
+
+        self.assertEqual(sample('rating_processor_messages_total') - before['messages'], 2)
+        self.assertEqual(sample('rating_processor_batch_size_count') - before['batches'], 1)
+        self.assertEqual(sample('rating_processor_stage_seconds_count', stage='db_write') - before['db_write'], 1)
+        # Every pending rating of the content is applied, not only the polled ones
+        self.assertEqual(sample('rating_processor_anomaly_penalties_total') - before['penalties'], 3)
+        partition = str(self.broker.partition_for(b'1'))
+        self.assertEqual(sample('rating_processor_consumer_lag', partition=partition), 1)
+
+    def test_pending_ratings_without_messages_are_applied(self):
+        Rating.objects.upsert(self.content.id, self.user.id, 3)
+        RatingProcessor(transport=self.transport).process_pending()
+
+        self.content.refresh_from_db()
+        self.assertEqual(self.content.rating_count, 1)
+        self.assertFalse(Rating.objects.filter(processed=False).exists())
+
+    @mock.patch('contents.services.transport.threading.Thread')
+    def test_processor_thread_starts_with_the_first_producer(self, thread):
+        transport = EmbeddedTransport()
+        transport.producer()
+        transport.producer()
+        thread.return_value.start.assert_called_once()
+
+    def test_transport_follows_the_setting(self):
+        self.assertIsInstance(get_transport(), KafkaTransport)
+        with override_settings(RATING_TRANSPORT='embedded'):
+            self.assertIsInstance(get_transport(), EmbeddedTransport)
+            self.assertIs(get_transport(), get_transport())
+        with override_settings(RATING_TRANSPORT='carrier-pigeon'):
+            self.assertRaises(ValueError, get_transport)
+
+
+class PopulateDbTests(TestCase):
+    def test_populates_requested_scale(self):
+        call_command('populate_db', users=10, contents=200, ratings=200, seed=7, workers=1, chunk_size=50, stdout=StringIO())
+
+        self.assertGreaterEqual(User.objects.count(), 10)
+        self.assertEqual(Content.objects.count(), 200)
+        self.assertAlmostEqual(Rating.objects.count(), 200, delta=20)
+        self.assertTrue(User.objects.get(username='user').check_password('password'))
+        self.assertFalse(User.objects.filter(password='password').exists())
+        self.assertEqual(find_aggregate_drift(Content.objects.all()), [])
+        rollups = RatingRollup.objects.aggregate(votes=Sum('votes'), weight_sum=Sum('weight_sum'))
+        self.assertEqual(rollups['votes'], Rating.objects.count())
+        self.assertAlmostEqual(rollups['weight_sum'], sum(Content.objects.values_list('weight_sum', flat=True)))
+
+        # Popular contents get most of the ratings
+        counts = sorted(Content.objects.values_list('rating_count', flat=True), reverse=True)
+        self.assertGreater(sum(counts[:4]), sum(counts[-20:]))
+
+    def test_rows_per_task_are_bounded_by_the_chunk_size(self):
+        loaded = []
+
+        def load_ratings(cursor, rows):
+            loaded.append(len(rows))
+            return load(cursor, rows)
+
+        load = populate_db.load_ratings
+        # Two users share 200 ratings, more than a chunk each
+        with mock.patch.object(populate_db, 'load_ratings', load_ratings):
+            call_command('populate_db', users=2, contents=150, ratings=200, seed=3, workers=1, chunk_size=30,
+                         stdout=StringIO())
+        self.assertTrue(loaded)
+        self.assertLessEqual(max(loaded), 30)
+        self.assertAlmostEqual(Rating.objects.count(), 200, delta=20)
+        self.assertEqual(find_aggregate_drift(Content.objects.all()), [])
+
+    def test_tops_up_to_the_minimum_counts(self):
+        call_command('populate_db', users=5, contents=10, ratings=20, seed=1, workers=1, stdout=StringIO())
+        contents = Content.objects.count()
+        call_command('populate_db', users=5, contents=10, ratings=20, seed=2, workers=1, stdout=StringIO())
+        self.assertEqual(Content.objects.count(), contents)
+
+
+class RebuildAggregatesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create(username=f'user{i}') for i in range(12)]
+        self.contents = [Content.objects.create(title=f'title {i}', text='text') for i in range(3)]
+        for content in self.contents:
+            for user in self.users[:3]:
+                Rating.objects.create(content=content, user=user, rating=4, processed=True, applied_rating=4)
+        call_command('rebuild_aggregates', workers=1, stdout=StringIO())
+        # Drift the aggregates of the first content
+        Content.objects.filter(id=self.contents[0].id).update(rating_count=7, weighted_sum=1.0)
+
+    def rebuild(self, **options):
+        out = StringIO()
+        call_command('rebuild_aggregates', workers=1, chunk_size=1, stdout=out, **options)
+        return out.getvalue()
+
+    def test_rewrites_only_drifted_contents(self):
+        output = self.rebuild()
+        self.assertIn('1 contents changed', output)
+        self.assertIn(f'Content {self.contents[0].id}: rating_count 7 -> 3', output)
+        self.assertEqual(find_aggregate_drift(Content.objects.all()), [])
+        self.assertIn('0 contents changed', self.rebuild())
+
+    def test_dry_run_changes_nothing(self):
+        output = self.rebuild(dry_run=True)
+        self.assertIn('Dry run: 1 contents would change', output)
+        self.assertEqual(Content.objects.get(id=self.contents[0].id).rating_count, 7)
+
+    def test_resumes_from_the_state_file(self):
+        path = os.path.join(tempfile.mkdtemp(), 'rebuild.json')
+        first = self.contents[0].id
+        with open(path, 'w') as file:
+            json.dump({'chunk_size': 1, 'done': [first]}, file)
+
+        output = self.rebuild(state_file=path)
+        self.assertIn('Resuming, 1 chunks already rebuilt', output)
+        self.assertEqual(Content.objects.get(id=first).rating_count, 7)
+        self.assertFalse(os.path.exists(path))
+        with open(path, 'w') as file:
+            json.dump({'chunk_size': 2, 'done': []}, file)
+        self.assertRaises(CommandError, self.rebuild, state_file=path)
+
+    def test_rescores_anomaly_weights(self):
+        content = self.contents[1]
+        for user in self.users[3:]:
+            Rating.objects.create(content=content, user=user, rating=4, processed=True, applied_rating=4)
+        output = self.rebuild(rescore_anomalies=True)
+
+        # 12 ratings of 4 within the hour, the ones past MIN_RATE_COUNT are penalized
+        weights = sorted(Rating.objects.filter(content=content).values_list('weight', flat=True))
+        self.assertEqual(weights, [settings.ANOMALY_WEIGHT_PENALTY] * 3 + [1.0] * 9)
+        self.assertIn('3 ratings re-weighted', output)
+        self.assertEqual(find_aggregate_drift(Content.objects.all()), [])
+        self.assertAlmostEqual(RatingRollup.objects.filter(content=content).aggregate(total=Sum('weight_sum'))['total'],
+                               9 + 3 * settings.ANOMALY_WEIGHT_PENALTY)
+
 
 # Here, specifically focus on testing performance of the system
 
+class BenchmarkBaselineTests(TestCase):
+    baseline = {
+        'processor': {'messages_per_second': 1000.0},
+        'reads': {'1000': {'list': {'p50': 10.0, 'p99': 20.0}}},
+    }
+
+    def test_percentiles(self):
+        summary = percentiles([float(value) for value in range(1, 101)])
+        self.assertAlmostEqual(summary['p50'], 50.5)
+        self.assertAlmostEqual(summary['p95'], 95.05)
+        self.assertAlmostEqual(summary['mean'], 50.5)
+
+    def test_lower_throughput_and_higher_latency_are_regressions(self):
+        metrics = {
+            'processor': {'messages_per_second': 700.0},
+            'reads': {'1000': {'list': {'p50': 14.0, 'p99': 80.0}}},
+        }
+        regressions = compare_to_baseline(metrics, self.baseline, tolerance=0.25)
+        self.assertEqual(regressions, [
+            ('processor.messages_per_second', 1000.0, 700.0),
+            ('reads.1000.list.p50', 10.0, 14.0),
+        ])
+
+    def test_improvements_jitter_and_new_metrics_pass(self):
+        metrics = {
+            'processor': {'messages_per_second': 2000.0},
+            'reads': {'1000': {'list': {'p50': 11.5}}, '10000': {'list': {'p50': 500.0}}},
+        }
+        self.assertEqual(compare_to_baseline(metrics, self.baseline, tolerance=0.1, min_delta_ms=2), [])
+
+
 # Here, focos on anomaly rating
+
+class RatingWindowTests(TestCase):
+    def test_buckets_expire_as_the_window_slides(self):
+        window = RatingWindow(size=60)
+        window.add(100, 5)
+        window.add(130, 5)
+        window.add(130, 1)
+        self.assertEqual((window.total, window.totals[5]), (3, 2))
+
+        window.advance(160)  # Minute 100 falls out of the window
+        self.assertEqual((window.total, window.totals[5]), (2, 1))
+
+        window.add(10, 3)  # Older than the window
+        window.advance(1000)
+        self.assertEqual(window.total, 0)
+
+
+class AnomalyDetectorTests(TestCase):
+    def setUp(self):
+        with mock.patch('contents.services.transport.KafkaConsumer'):
+            self.processor = RatingProcessor()
+        self.content = Content.objects.create(title='title', text='text')
+        self.users = [User.objects.create(username=f'user{i}') for i in range(12)]
+
+    def test_rating_spike_is_penalized(self):
+        for user in self.users[:11]:
+            Rating.objects.create(content=self.content, user=user, rating=5)
+        Rating.objects.create(content=self.content, user=self.users[11], rating=2)
+        self.processor.process_ratings_batch(self.content.id)
+
+        weights = dict(Rating.objects.values_list('rating', 'weight').distinct())
+        self.assertEqual(weights, {5: settings.ANOMALY_WEIGHT_PENALTY, 2: 1.0})
+
+    def test_below_min_rate_count_is_not_anomalous(self):
+        for user in self.users[:settings.MIN_RATE_COUNT - 1]:
+            Rating.objects.create(content=self.content, user=user, rating=5)
+        self.processor.process_ratings_batch(self.content.id)
+
+        self.assertFalse(Rating.objects.exclude(weight=1.0).exists())
+
+    def test_evicted_window_is_rebuilt_from_the_database(self):
+        for user in self.users[:10]:
+            Rating.objects.create(content=self.content, user=user, rating=4)
+        self.processor.process_ratings_batch(self.content.id)
+        cached = self.processor.anomaly_detector.windows[self.content.id]
+
+        detector = AnomalyDetector()
+        self.assertFalse(detector.is_anomalous(self.content.id, 1, timezone.now()))
+        self.assertTrue(detector.is_anomalous(self.content.id, 4, timezone.now()))
+        self.assertEqual(detector.windows[self.content.id].totals, cached.totals)
+
+    def test_least_recently_used_windows_are_evicted(self):
+        detector = AnomalyDetector(max_contents=2)
+        now = timezone.now()
+        for content_id in (1, 2, 3):
+            detector.observe({content_id: []}, now)
+        detector.evict(now)
+        self.assertEqual(list(detector.windows), [2, 3])
+
+        detector.evict(now + timedelta(hours=2))
+        self.assertEqual(list(detector.windows), [])
@@ -1,13 +1,28 @@
+from django.conf import settings
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ContentListView, ContentRatingView, ContentCreateView, ContentDetailView
+from .views import ContentListView, ContentRatingView, ContentBulkRatingView, ContentCreateView, ContentDetailView, ContentTopView, ContentStatsView, ContentSearchView
+from . import async_views
 
 router = DefaultRouter()
 router.register(r'contents', ContentListView, basename='content')
 
+if settings.ASYNC_VIEWS:
+    content_list = async_views.ContentListView.as_view()
+    content_detail = async_views.ContentDetailView.as_view()
+    content_rate = async_views.ContentRatingView.as_view()
+else:
+    content_list = ContentListView.as_view({'get': 'list'})
+    content_detail = ContentDetailView.as_view()
+    content_rate = ContentRatingView.as_view()
+
 urlpatterns = [
-    path('contents/', ContentListView.as_view({'get': 'list'}), name='content-list'),
-    path('contents/<int:content_id>/', ContentDetailView.as_view(), name='content-detail'),
+    path('contents/', content_list, name='content-list'),
+    path('contents/<int:content_id>/', content_detail, name='content-detail'),
+    path('contents/<int:content_id>/stats/', ContentStatsView.as_view(), name='content-stats'),
+    path('contents/search/', ContentSearchView.as_view(), name='content-search'),
+    path('contents/top/', ContentTopView.as_view(), name='content-top'),
     path('contents/create/', ContentCreateView.as_view(), name='content-create'),
-    path('contents/rate/', ContentRatingView.as_view(), name='content-rate'),
+    path('contents/rate/', content_rate, name='content-rate'),
+    path('contents/rate/bulk/', ContentBulkRatingView.as_view(), name='content-rate-bulk'),
 ]
\ No newline at end of file
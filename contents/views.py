@@ -2,13 +2,118 @@ from rest_framework import viewsets, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from .models import Content, Rating
-from .serializers import ContentSerializer
+from .serializers import ContentSerializer, CONTENT_LIST_VALUES, serialize_content_rows
 from django.conf import settings
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import parse_etags
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from rest_framework_simplejwt.authentication import JWTAuthentication
-from .paginations import ContentsPagination
-from kafka import KafkaProducer
-import json
+from authentication.authentication import CachedJWTAuthentication
+from .paginations import ContentsPagination, ContentsCursorPagination, ContentSearchPagination
+from .services.producer import rating_producer
+from .services.cache import content_cache
+from .services.leaderboard import BOARDS, leaderboard
+from .services.rollups import content_stats, current_hour
+from .services.search import search_contents
+from .services.ratelimit import rating_limiter
+from rest_framework.exceptions import Throttled
+from django.utils import timezone
+from content_rating.routers import replicas
+import datetime
+
+def parse_datetime_param(value):
+    """An ISO 8601 date or datetime, naive values being in the current time zone"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError
+        parsed = datetime.datetime.combine(day, datetime.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+# Content ids are bigints, larger values cannot even be compared with them
+CONTENT_ID_RANGE = range(-2 ** 63, 2 ** 63)
+
+
+def parse_content_id(value):
+    """A content id given in a request body, ValueError if it is not an integer in range"""
+    try:
+        content_id = int(value)
+    except (TypeError, ValueError, OverflowError):  # JSON numbers like 1e400 are infinite floats
+        raise ValueError(f'Invalid content_id: {value!r}')
+    if content_id not in CONTENT_ID_RANGE:
+        raise ValueError(f'Invalid content_id: {value!r}')
+    return content_id
+
+
+# List filter parameter -> (lookup, parser)
+LIST_FILTERS = {
+    'min_rating': ('average_rating__gte', float),
+    'max_rating': ('average_rating__lte', float),
+    'min_count': ('rating_count__gte', int),
+    'created_after': ('created_at__gte', parse_datetime_param),
+    'created_before': ('created_at__lt', parse_datetime_param),
+}
+
+
+def parse_list_filters(params):
+    """ORM lookups of the list filters given in the query parameters, ValueError on invalid values"""
+    lookups = {}
+    for param, (lookup, parse) in LIST_FILTERS.items():
+        value = params.get(param)
+        if value in (None, ''):
+            continue
+        try:
+            lookups[lookup] = parse(value)
+        except (TypeError, ValueError, OverflowError):
+            raise ValueError(f'Invalid {param}: {value}')
+    return lookups
+
+
+def is_not_modified(request, etag):
+    """Check the If-None-Match header of a GET request against the current ETag"""
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    return '*' in etags or etag in etags
+
+
+def not_modified_response(etag):
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+
+def user_scopes(request):
+    """Replica pin scopes of the caller, evaluating the user before any read is routed"""
+    return [f'user:{request.user.pk}'] if request.user.is_authenticated else []
+
+
+def ratings_generation(request):
+    """Generation of the caller's ratings, part of the ETags of the responses including them"""
+    if not request.user.is_authenticated:
+        return None
+    return content_cache.ratings_generation(request.user.pk)
+
+
+def with_user_ratings(request, items):
+    """
+    Fill in the caller's own rating of each serialized content with a single query.
+    The cached responses are shared by every user, so this is applied on top of them.
+    """
+    if not request.user.is_authenticated or not items:
+        return items
+    ratings = dict(
+        Rating.objects
+        .filter(user=request.user, content_id__in=[item['id'] for item in items])
+        .values_list('content_id', 'rating')
+    )
+    return [
+        {**item, 'user_rating': float(ratings[item['id']]) if item['id'] in ratings else None}
+        for item in items
+    ]
+
 
 class ContentListView(viewsets.ReadOnlyModelViewSet):
     permission_classes = (AllowAny,)
@@ -16,42 +121,174 @@ class ContentListView(viewsets.ReadOnlyModelViewSet):
     serializer_class = ContentSerializer
     pagination_class = ContentsPagination
     
+    sort_fields = {
+        'created_at': 'created_at',
+        'rating_count': 'rating_count',
+        'rating_average': 'average_rating',
+    }
+    
+    @property
+    def paginator(self):
+        # Keyset pagination is opted into with ?pagination=cursor, and is implied by a cursor
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if params.get('pagination') == 'cursor' or 'cursor' in params:
+                self._paginator = ContentsCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+    
     def get_queryset(self):
         sort_by = self.request.query_params.get('sort_by', 'created_at')
         sort_order = self.request.query_params.get('order', 'desc')
         
-        queryset = Content.objects.all()
+        # Use the stored statistics for sorting, with the id as tie-breaker so the order is
+        # stable and matches the (field, id) indexes. Filters only bound indexed columns:
+        # pages walk the index of the sort field, and counts scan one of the indexes alone
+        order_field = self.sort_fields.get(sort_by, 'created_at')
+        prefix = '-' if sort_order == 'desc' else ''
+        queryset = Content.objects.filter(**parse_list_filters(self.request.query_params))
+        return queryset.order_by(f'{prefix}{order_field}', f'{prefix}id')
+    
+    def list(self, request, *args, **kwargs):
+        try:
+            parse_list_filters(request.query_params)
+        except ValueError as e:
+            return Response(
+                {'error': str(e)}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        # Use the stored statistics for sorting
-        if sort_by == 'rating_count':
-            order_field = '-rating_count' if sort_order == 'desc' else 'rating_count'
-            queryset = queryset.order_by(order_field)
-        elif sort_by == 'rating_average':
-            order_field = '-average_rating' if sort_order == 'desc' else 'average_rating'
-            queryset = queryset.order_by(order_field)
-        else:
-            order_field = '-created_at' if sort_order == 'desc' else 'created_at'
-            queryset = queryset.order_by(order_field)
+        # Pages only change when the processor or a new content bumps the list generation
+        params = [(key, request.query_params.getlist(key)) for key in request.query_params]
+        params.append(('host', request.get_host()))
+        generation = content_cache.list_generation()
+        etag = content_cache.list_etag(params, generation, request.user.pk, ratings_generation(request))
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
         
-        return queryset
+        with replicas.reads(*user_scopes(request)):
+            data = content_cache.get_list_page(params, self.load_page, generation=generation)
+            data = {**data, 'results': with_user_ratings(request, data['results'])}
+        return Response(data, headers={'ETag': etag, 'Vary': 'Authorization'})
+    
+    def load_page(self):
+        # Lean read path: plain rows for exactly the serialized fields instead of model
+        # instances going through ContentSerializer field by field
+        with replicas.reads('contents:list'):
+            queryset = self.filter_queryset(self.get_queryset()).values(*CONTENT_LIST_VALUES)
+            rows = self.paginator.paginate_queryset(queryset, self.request, view=self)
+            return self.paginator.get_paginated_response(serialize_content_rows(rows)).data
 
 class ContentDetailView(APIView):
     permission_classes = (AllowAny,)
     
     
     def get(self, request, content_id):
+        version = content_cache.detail_version(content_id)
+        etag = content_cache.detail_etag(content_id, version, request.user.pk, ratings_generation(request))
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+        
+        with replicas.reads(*user_scopes(request)):
+            data = content_cache.get_detail(content_id, lambda: self.load(content_id), version=version)
+            if data is None:
+                return Response(
+                    {'error': 'Content not found'}, 
+                    status=status.HTTP_404_NOT_FOUND
+                )
+            data = with_user_ratings(request, [data])[0]
+        return Response(data, headers={'ETag': etag, 'Vary': 'Authorization'})
+    
+    def load(self, content_id):
+        with replicas.reads(f'content:{content_id}'):
+            try:
+                content = Content.objects.defer('search_vector').get(id=content_id)
+            except Content.DoesNotExist:
+                return None
+            return ContentSerializer(content).data
+
+class ContentSearchView(APIView):
+    permission_classes = (AllowAny,)
+    
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response(
+                {'error': 'q is required'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Cached like list pages, results change with the same list generation
+        params = [(key, request.query_params.getlist(key)) for key in request.query_params]
+        params.extend([('host', request.get_host()), ('view', 'search')])
+        with replicas.reads(*user_scopes(request)):
+            data = content_cache.get_list_page(params, lambda: self.load_page(request, query))
+            data = {**data, 'results': with_user_ratings(request, data['results'])}
+        return Response(data)
+    
+    def load_page(self, request, query):
+        with replicas.reads('contents:list'):
+            paginator = ContentSearchPagination()
+            queryset = search_contents(query).values(*CONTENT_LIST_VALUES, 'rank')
+            rows = paginator.paginate_queryset(queryset, request, view=self)
+            return paginator.get_paginated_response(serialize_content_rows(rows)).data
+
+class ContentTopView(APIView):
+    permission_classes = (AllowAny,)
+    
+    def get(self, request):
+        board = request.query_params.get('by', 'score')
+        if board not in BOARDS:
+            return Response(
+                {'error': f'by must be one of {", ".join(BOARDS)}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
         try:
-            content = Content.objects.get(id=content_id)
-            serializer = ContentSerializer(content)
-            return Response(serializer.data)
-        except Content.DoesNotExist:
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            limit = 0
+        if not (1 <= limit <= settings.LEADERBOARD_SIZE):
             return Response(
-                {'error': 'Content not found'}, 
+                {'error': f'limit must be between 1 and {settings.LEADERBOARD_SIZE}'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Served from the leaderboard the processor maintains, no sorting of the table. Read
+        # from the primary: a board rebuilt from a lagging replica would be stored for everyone
+        results = with_user_ratings(request, leaderboard.top(board, limit))
+        return Response({'by': board, 'results': results})
+
+class ContentStatsView(APIView):
+    permission_classes = (AllowAny,)
+
+    def get(self, request, content_id):
+        try:
+            hours = int(request.query_params.get('hours', 168))
+        except ValueError:
+            hours = 0
+        if not (1 <= hours <= settings.CONTENT_STATS_MAX_HOURS):
+            return Response(
+                {'error': f'hours must be between 1 and {settings.CONTENT_STATS_MAX_HOURS}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Histogram and time series come from the hourly rollups, not from the ratings
+        hour = current_hour(timezone.now())
+        data = content_cache.get_stats(content_id, hours, hour, lambda: self.load(content_id, hours, hour))
+        if data is None:
+            return Response(
+                {'error': 'Content not found'},
                 status=status.HTTP_404_NOT_FOUND
             )
+        return Response(data)
+
+    def load(self, content_id, hours, hour):
+        with replicas.reads(f'content:{content_id}'):
+            return content_stats(content_id, hours, hour)
 
 class ContentCreateView(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [CachedJWTAuthentication]
     permission_classes = [IsAuthenticated]
 
     def post(self, request):
@@ -68,6 +305,9 @@ class ContentCreateView(APIView):
             title=title,
             text=text
         )
+        content_cache.lists_changed()
+        leaderboard.contents_changed([content])
+        replicas.pin(f'user:{request.user.pk}')
         
         serializer = ContentSerializer(content)
         return Response(
@@ -75,28 +315,41 @@ class ContentCreateView(APIView):
             status=status.HTTP_201_CREATED
         )
 
-class ContentRatingView(APIView):
-    authentication_classes = [JWTAuthentication]
-    permission_classes = [IsAuthenticated]
+class RatingRateLimitMixin:
+    """Rejects callers over their hourly rating budget before authentication queries the user"""
 
-    def __init__(self):
-        super().__init__()
-        self.producer = KafkaProducer(
-            bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS,
-            value_serializer=lambda m: json.dumps(m).encode('utf-8')
-        )
+    def initial(self, request, *args, **kwargs):
+        wait = rating_limiter.check(request, self.rating_cost(request))
+        if wait is not None:
+            raise Throttled(wait=wait)
+        super().initial(request, *args, **kwargs)
+
+    def rating_cost(self, request):
+        return 1
+
+class ContentRatingView(RatingRateLimitMixin, APIView):
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated]
 
     def post(self, request):
         content_id = request.data.get('content_id')
         rating_value = request.data.get('rating')
         user = request.user
         
-        if not all([content_id, rating_value, user]):
+        if content_id is None or rating_value is None:
             return Response(
                 {'error': 'Missing required fields'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        try:
+            content_id = parse_content_id(content_id)
+        except ValueError:
+            return Response(
+                {'error': 'content_id must be an integer id'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
         try:
             rating_value = int(rating_value)
             if not (0 <= rating_value <= 5):
@@ -104,47 +357,104 @@ class ContentRatingView(APIView):
                     {'error': 'Rating must be between 0 and 5'}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
-        except (TypeError, ValueError):
+        except (TypeError, ValueError, OverflowError):
             return Response(
                 {'error': 'Rating must be an integer'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        try:
-            content = Content.objects.get(id=content_id)
-        except Content.DoesNotExist:
+        # Create or update the rating in one round-trip; the processor owns weight/applied_rating
+        result = Rating.objects.upsert(content_id, user.id, rating_value)
+        if result is None:
             return Response(
                 {'error': 'Content not found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
+        rating_id, created = result
+        replicas.pin(f'user:{user.id}')
+        content_cache.user_ratings_changed(user.id)
+        action = 'created' if created else 'updated'
         
-        try:
-            # Try to get existing rating
-            rating = Rating.objects.get(content=content, user=user)
-            rating.rating = rating_value
-            rating.processed = False
-            rating.save()
-            action = 'updated'
-        except Rating.DoesNotExist:
-            # Create new rating
-            rating = Rating.objects.create(
-                content=content,
-                user=user,
-                rating=rating_value,
-                processed=False
-            )
-            action = 'created'
-        
-        # Send to Kafka for processing
-        self.producer.send('ratings', {
+        # Send to Kafka for processing, keyed by content so its ratings stay in order on one partition
+        rating_producer.send('ratings', {
             'content_id': content_id,
-            'rating_id': rating.id,
+            'rating_id': rating_id,
             'user_id': user.id,
             'rating': rating_value
-        })
+        }, key=content_id)
         
         return Response({
             'status': 'success',
             'message': f'Rating {action}',
             'rating': rating_value
-        })
\ No newline at end of file
+        })
+
+class ContentBulkRatingView(RatingRateLimitMixin, APIView):
+    authentication_classes = [CachedJWTAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def rating_cost(self, request):
+        # Every item counts, bodies rejected by post() (invalid or oversized) count once
+        items = request.data.get('ratings') if isinstance(request.data, dict) else None
+        if not isinstance(items, list) or not items or len(items) > settings.BULK_RATING_MAX_ITEMS:
+            return 1
+        return len(items)
+
+    def post(self, request):
+        items = request.data.get('ratings') if isinstance(request.data, dict) else None
+        if not isinstance(items, list) or not items:
+            return Response(
+                {'error': 'ratings must be a non-empty list'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > settings.BULK_RATING_MAX_ITEMS:
+            return Response(
+                {'error': f'At most {settings.BULK_RATING_MAX_ITEMS} ratings can be sent at once'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        # Validate every item in one pass; a later rating for the same content wins
+        results = [None] * len(items)
+        ratings = {}
+        positions = {}
+        for index, item in enumerate(items):
+            try:
+                content_id = parse_content_id(item['content_id'])
+                rating_value = int(item['rating'])
+            except (KeyError, TypeError, ValueError, OverflowError):
+                results[index] = {'status': 'invalid', 'error': 'content_id and an integer rating are required'}
+                continue
+            if not (0 <= rating_value <= 5):
+                results[index] = {'content_id': content_id, 'status': 'invalid', 'error': 'Rating must be between 0 and 5'}
+                continue
+            if content_id in positions:
+                results[positions[content_id]] = {'content_id': content_id, 'status': 'superseded'}
+            ratings[content_id] = rating_value
+            positions[content_id] = index
+        
+        written = Rating.objects.bulk_upsert(request.user.id, ratings)
+        if written:
+            replicas.pin(f'user:{request.user.id}')
+            content_cache.user_ratings_changed(request.user.id)
+        
+        messages = []
+        for content_id, index in positions.items():
+            if content_id not in written:
+                results[index] = {'content_id': content_id, 'status': 'not_found'}
+                continue
+            rating_id, created = written[content_id]
+            results[index] = {'content_id': content_id, 'status': 'created' if created else 'updated'}
+            messages.append((content_id, {
+                'content_id': content_id,
+                'rating_id': rating_id,
+                'user_id': request.user.id,
+                'rating': ratings[content_id]
+            }))
+        
+        # Send to Kafka for processing, as one producer batch
+        rating_producer.send_many('ratings', messages)
+        
+        return Response({
+            'status': 'success',
+            'results': results
+        })